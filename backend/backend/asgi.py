@@ -14,3 +14,9 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
 application = get_asgi_application()
+
+# Load colors, sizes, categories, brands and device models before the first
+# request (store/reference_data.py)
+from store.reference_data import warm_reference_data  # noqa: E402
+
+warm_reference_data()
@@ -107,7 +107,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    
+    'store.middleware.PriceMemoMiddleware',
 ]
 
 ROOT_URLCONF = 'backend.urls'
@@ -199,10 +199,68 @@ load_dotenv()
 STRIPE_TEST_PUBLIC_KEY = os.getenv("STRIPE_TEST_PUBLIC_KEY")
 STRIPE_TEST_SECRET_KEY = os.getenv("STRIPE_TEST_SECRET_KEY")
 
+# Cache
+# Local memory for development, a shared Redis cache in production (set REDIS_URL).
+# Carts get their own alias (store/cart_store.py). CacheCartStore needs it to
+# be shared by every worker and to have atomic add/incr, so it is only used
+# with Redis; without it the alias is a local memory cache for the tests.
+if os.getenv("REDIS_URL"):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv("REDIS_URL"),
+        },
+        'carts': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv("REDIS_URL"),
+            'KEY_PREFIX': 'carts',
+            'TIMEOUT': None,
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+        'carts': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'carts',
+            'TIMEOUT': None,
+        },
+    }
+
+# Where carts live between checkouts. CacheCartStore keeps them in the
+# 'carts' cache and writes the Cart/CartItem tables behind: schedule
+# `manage.py persist_carts` every few minutes with it, or carts only reach
+# the tables at checkout. DatabaseCartStore writes
+# every edit straight to the tables. The cache store needs Redis (or
+# Memcached): the startup checks refuse it on a file or database cache.
+if os.getenv("REDIS_URL"):
+    CART_STORE = 'store.cart_store.CacheCartStore'
+else:
+    CART_STORE = 'store.cart_store.DatabaseCartStore'
+CART_STORE_CACHE_ALIAS = 'carts'
+
+# Seconds a checkout keeps its stock on hold (store/reservations.py). Expired
+# holds go back to the stock with `manage.py release_stock_reservations`,
+# run every minute.
+STOCK_RESERVATION_TTL = 10 * 60
+
+# Seconds the first response to a request sent with an Idempotency-Key is
+# replayed for its retries (store/idempotency.py). Run
+# `manage.py purge_idempotency_keys` daily to drop the expired keys.
+IDEMPOTENCY_KEY_TTL = 60 * 60 * 24
+
+# Catalog response cache (store/response_cache.py). Entries are invalidated by
+# tag versions, the timeout only bounds memory use.
+RESPONSE_CACHE_ALIAS = 'default'
+RESPONSE_CACHE_TIMEOUT = 60 * 60 * 24
+
 CORS_ALLOW_HEADERS = [
     "content-type",
     "authorization",
     "x-csrftoken",
+    "idempotency-key",
 ]
 # # In settings.py for local dev
 # SESSION_COOKIE_SAMESITE = None
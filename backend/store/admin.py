@@ -11,7 +11,7 @@ from .models import (
 
 )
 from django.contrib.admin import TabularInline
-from django.db.models import Sum, Q
+from django.db.models import Prefetch, Sum, Q
 from datetime import timedelta
 from django.utils.timezone import localdate
 # store/admin.py
@@ -493,19 +493,18 @@ class OrderAdmin(admin.ModelAdmin):
     )
     search_fields = ('customer__user__username', 'product_description')
     list_filter = ('status', 'order_date', 'shop')
+    list_select_related = ('customer__user', 'shop')
     inlines = [OrderItemInline]
     readonly_fields = ('total_price', 'shop', 'customer')
 
-    # FIX: Override get_queryset to prefetch related data for list_display
+    # Prefetch the lines with their products for list_display; color and size
+    # names come from the reference data (see Order.get_order_colors)
     def get_queryset(self, request):
         qs = super().get_queryset(request)
-        
-        # Prefetch order_items and their related product, color, and size
         qs = qs.prefetch_related(
-            'order_items',
-            'order_items__product',
-            'order_items__color',
-            'order_items__size'
+            Prefetch('order_items', queryset=OrderItem.objects.select_related('product').only(
+                'id', 'order_id', 'product_id', 'color_id', 'size_id', 'quantity', 'product__name'
+            ))
         )
 
         # The existing user-based filtering logic
@@ -523,12 +522,11 @@ class OrderAdmin(admin.ModelAdmin):
     get_product_names.short_description = 'Products'
 
     def get_order_colors(self, obj):
-        return ", ".join([item.color.color_name for item in obj.order_items.all()])
+        return obj.get_order_colors()
     get_order_colors.short_description = 'Order Colors'
 
     def get_order_sizes(self, obj):
-        # This will now use the prefetched data, avoiding extra queries
-        return ", ".join([item.size.name for item in obj.order_items.all() if item.size])
+        return obj.get_order_sizes()
     get_order_sizes.short_description = 'Sizes'
 
     def get_quantity(self, obj):
@@ -556,14 +554,19 @@ class CartItemInline(admin.TabularInline):
 class CartAdmin(admin.ModelAdmin):
     list_display = (
         'id', 'customer', 'cart_date', 'total_price',
-        'product_description', 'get_cart_colors', 'get_cart_sizes', 'get_quantity'
+        'get_product_description', 'get_cart_colors', 'get_cart_sizes', 'get_quantity'
     )
-    search_fields = ('customer__user__username', 'product_description', 'cart_items__product__name')
+    search_fields = ('customer__user__username', 'cart_items__product__name')
     list_filter = ('cart_date', 'cart_items__product__category', 'cart_items__product__brand')
+    list_select_related = ('customer__user',)
     inlines = [CartItemInline]
 
     def get_queryset(self, request):
-        qs = super().get_queryset(request)
+        qs = super().get_queryset(request).prefetch_related(
+            Prefetch('cart_items', queryset=CartItem.objects.select_related('product').only(
+                'id', 'cart_id', 'product_id', 'color_id', 'size_id', 'quantity', 'product__name'
+            ))
+        )
         if request.user.is_superuser:
             return qs
         try:
@@ -578,12 +581,16 @@ class CartAdmin(admin.ModelAdmin):
             obj.save()
         super().save_model(request, obj, form, change)
 
+    def get_product_description(self, obj):
+        return obj.get_product_description()
+    get_product_description.short_description = 'Products'
+
     def get_cart_colors(self, obj):
-        return ", ".join([item.color.color_name for item in obj.cart_items.all()])
+        return obj.get_cart_colors()
     get_cart_colors.short_description = 'Cart Colors'
 
     def get_cart_sizes(self, obj):
-        return ", ".join([item.size.name for item in obj.cart_items.all() if item.size])
+        return obj.get_cart_sizes()
     get_cart_sizes.short_description = 'Sizes'
 
     def get_quantity(self, obj):
@@ -4,4 +4,7 @@ class StoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'store'
     def ready(self):
-        import store.signals  # Import the signals to make sure they're connected
\ No newline at end of file
+        import store.signals  # Import the signals to make sure they're connected
+        from django.core import checks
+        from .cart_store import check_cart_store
+        checks.register(check_cart_store)
\ No newline at end of file
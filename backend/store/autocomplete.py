@@ -0,0 +1,232 @@
+import threading
+import time
+import unicodedata
+from bisect import bisect_left, insort
+
+from django.core.cache import cache
+from django.db.models import FloatField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from .deferred import OnCommitBatch
+from .models import Product, ProductPopularity
+from .popularity import DEFAULT_WINDOW, GLOBAL
+from .serializers import ProductCardSerializer
+
+# In-process prefix index for type-ahead. Every product is reachable from its
+# name, its brand and category names, and every word inside them, all
+# normalized (lower case, no accents). Lookups are a bisect into a sorted list
+# of (key, product_id) pairs and never touch the database.
+#
+# Writes in this process update the index incrementally (store/signals.py)
+# and publish the changed product ids under a new version number in the
+# cache. Other processes notice the version move on their next lookup and
+# re-read just those products; only a gap in the change log (entries expired
+# or never written) makes them rebuild the whole index.
+VERSION_KEY = 'autocomplete:version'
+CHANGES_PREFIX = 'autocomplete:changes:'
+
+# Change log entries outlive any process that looks at the version every
+# VERSION_CHECK_INTERVAL; a process further behind than MAX_CATCH_UP versions
+# rebuilds instead of replaying.
+CHANGES_TIMEOUT = 60 * 60
+MAX_CATCH_UP = 500
+
+# Columns the index is built from: saves limited to other columns (the
+# rating after a review, stock rollups) leave it alone.
+PRODUCT_FIELDS = {'name', 'image1', 'brand', 'category'}
+COLOR_IMAGE_FIELDS = {'image', 'product'}
+
+# How often (seconds) a process looks at the shared version counter.
+VERSION_CHECK_INTERVAL = 5
+
+# Upper bound on keys scanned per lookup, so one-letter prefixes stay cheap.
+MAX_SCANNED = 2000
+
+
+def normalize(text):
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(text.lower().split())
+
+
+def touches_index(update_fields, fields):
+    """False for a save limited by update_fields to columns outside `fields`."""
+    return update_fields is None or any(field.removesuffix('_id') in fields for field in update_fields)
+
+
+def index_keys(*names):
+    """The full normalized names plus every word suffix ('iphone 16 pro' -> '16 pro', 'pro')."""
+    keys = set()
+    for name in names:
+        words = normalize(name).split()
+        for start in range(len(words)):
+            keys.add(' '.join(words[start:]))
+    return keys
+
+
+class AutocompleteIndex:
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._keys = []        # sorted (key, product_id)
+        self._entries = {}     # product_id -> {'id', 'name', 'thumbnail', 'popularity', 'keys'}
+        self._version = None
+        self._checked_at = 0.0
+        self._built = False
+
+    # -- loading --------------------------------------------------------------
+
+    def _load(self, product_ids=None):
+        popularity = ProductPopularity.objects.filter(
+            window=DEFAULT_WINDOW, scope=GLOBAL, scope_id=0, product=OuterRef('pk')
+        ).values('score')[:1]
+        products = Product.objects.for_cards().select_related('brand', 'category').only(
+            'id', 'name', 'image1', 'brand__name', 'category__name'
+        ).annotate(popularity=Coalesce(Subquery(popularity), Value(0.0), output_field=FloatField()))
+        if product_ids is not None:
+            products = products.filter(pk__in=product_ids)
+
+        thumbnails = ProductCardSerializer()
+        entries = {}
+        for product in products:
+            entries[product.pk] = {
+                'id': product.pk,
+                'name': product.name,
+                'thumbnail': thumbnails.get_thumbnail(product),
+                'popularity': product.popularity,
+                'keys': index_keys(
+                    product.name,
+                    product.brand.name if product.brand else '',
+                    product.category.name if product.category else '',
+                ),
+            }
+        return entries
+
+    def rebuild(self):
+        cache.add(VERSION_KEY, 0, timeout=None)
+        version = cache.get(VERSION_KEY)
+        entries = self._load()
+        keys = sorted((key, product_id) for product_id, entry in entries.items() for key in entry['keys'])
+        with self._lock:
+            self._entries = entries
+            self._keys = keys
+            self._version = version
+            self._checked_at = time.monotonic()
+            self._built = True
+
+    def _ensure_current(self):
+        if not self._built:
+            self.rebuild()
+            return
+        now = time.monotonic()
+        if now - self._checked_at < VERSION_CHECK_INTERVAL:
+            return
+        self._checked_at = now
+        version = cache.get(VERSION_KEY)
+        if version == self._version:
+            return
+        changed = self._changes_since(self._version, version)
+        if changed is None:
+            self.rebuild()
+            return
+        self._apply(changed, self._load(changed))
+        with self._lock:
+            self._version = version
+
+    def _changes_since(self, start, end):
+        """Product ids changed in versions start+1..end, or None when the log has a gap."""
+        if start is None or end is None or not 0 < end - start <= MAX_CATCH_UP:
+            return None
+        keys = [f'{CHANGES_PREFIX}{version}' for version in range(start + 1, end + 1)]
+        entries = cache.get_many(keys)
+        if len(entries) != len(keys):
+            return None
+        return {product_id for product_ids in entries.values() for product_id in product_ids}
+
+    # -- incremental updates ----------------------------------------------------
+
+    def _remove(self, product_id):
+        entry = self._entries.pop(product_id, None)
+        if entry is None:
+            return
+        for key in entry['keys']:
+            position = bisect_left(self._keys, (key, product_id))
+            if position < len(self._keys) and self._keys[position] == (key, product_id):
+                del self._keys[position]
+
+    def _apply(self, product_ids, entries):
+        with self._lock:
+            for product_id in product_ids:
+                self._remove(product_id)
+                entry = entries.get(product_id)
+                if entry is not None:
+                    self._entries[product_id] = entry
+                    for key in entry['keys']:
+                        insort(self._keys, (key, product_id))
+
+    def _publish(self, product_ids):
+        """Log the changed products under a new version; returns it (None if the counter was lost)."""
+        try:
+            version = cache.incr(VERSION_KEY)
+        except ValueError:
+            # Counter gone: everyone rebuilds once
+            cache.add(VERSION_KEY, 0, timeout=None)
+            return None
+        cache.set(f'{CHANGES_PREFIX}{version}', sorted(product_ids), timeout=CHANGES_TIMEOUT)
+        return version
+
+    def update_products(self, product_ids):
+        """Re-read the given products (missing ones are dropped from the index)."""
+        if not self._built:
+            # Nothing to patch; the first lookup builds the whole index.
+            self._publish(product_ids)
+            return
+        self._apply(product_ids, self._load(product_ids))
+        version = self._publish(product_ids)
+        with self._lock:
+            # Writes by other processes since our last look are replayed on
+            # the next check, our own included (re-reading them is harmless)
+            if version is None:
+                self._version = None
+            elif self._version is not None and version == self._version + 1:
+                self._version = version
+
+    # -- lookups --------------------------------------------------------------
+
+    def lookup(self, query, limit=10):
+        """
+        Products with a name, brand or category word starting with `query`,
+        most popular first (global popularity as of the last (re)load).
+        """
+        prefix = normalize(query)
+        if not prefix:
+            return []
+        self._ensure_current()
+
+        with self._lock:
+            matches = {}
+            position = bisect_left(self._keys, (prefix,))
+            end = min(position + MAX_SCANNED, len(self._keys))
+            while position < end:
+                key, product_id = self._keys[position]
+                if not key.startswith(prefix):
+                    break
+                matches[product_id] = self._entries[product_id]
+                position += 1
+
+        ranked = sorted(matches.values(), key=lambda entry: (-entry['popularity'], entry['name'], entry['id']))
+        return [
+            {'id': entry['id'], 'name': entry['name'], 'thumbnail': entry['thumbnail']}
+            for entry in ranked[:limit]
+        ]
+
+
+autocomplete_index = AutocompleteIndex()
+
+
+_pending_products = OnCommitBatch(autocomplete_index.update_products)
+
+
+def schedule_autocomplete_update(product_id):
+    """Re-read (or drop, if it was deleted) a product once the transaction commits."""
+    _pending_products.add(product_id)
@@ -0,0 +1,358 @@
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.cache.backends.memcached import PyLibMCCache, PyMemcacheCache
+from django.core.cache.backends.redis import RedisCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, transaction
+from django.db.models import F, Subquery
+from django.utils.module_loading import import_string
+
+from .models import Cart, CartItem, ProductColorSize
+from .pricing import CENT, adjust_cart_total, price_quantities, refresh_cart_total
+from .reference_data import reference_data
+
+# Cart storage used by the cart endpoints (store/carts.py).
+#
+# A cart state is a plain dict, cheap to pickle into a cache:
+#     {'cart_id': <Cart pk or None>,
+#      'lines': {(product_id, color_id, size_id):
+#                    {'quantity': int, 'color_name': str, 'size_name': str}},
+#      'total': Decimal}
+# `lines` keeps insertion order, which is the order the cart is listed in.
+# `total` is moved by the price of each edit's changed lines (adjusted_total)
+# and only recounted in full when the cart is read (carts.current_cart).
+
+
+class CartBusy(Exception):
+    """Another request is editing the same cart."""
+
+
+class NotEnoughStock(Exception):
+    """add_lines() would take lines past their stock; `shortages` lists (line_key, quantity in cart)."""
+
+    def __init__(self, shortages):
+        super().__init__(shortages)
+        self.shortages = shortages
+
+
+def empty_state():
+    return {'cart_id': None, 'lines': {}, 'total': Decimal('0')}
+
+
+def product_quantities(lines):
+    """{product_id: quantity} over the lines of a cart state (or the additions of add_lines)."""
+    quantities = {}
+    for (product_id, _, _), line in lines.items():
+        quantities[product_id] = quantities.get(product_id, 0) + line['quantity']
+    return quantities
+
+
+def adjusted_total(state, quantity_deltas):
+    """
+    The state's total moved by the price of {product_id: quantity change},
+    pricing only the changed products. Call it once the lines are changed:
+    a state without a total (stored before totals were kept) is priced in full.
+    """
+    if state.get('total') is None:
+        return price_quantities(product_quantities(state['lines']))
+    return (state['total'] + price_quantities(quantity_deltas)).quantize(CENT)
+
+
+class DatabaseCartStore:
+    """Carts live in the Cart/CartItem tables; every edit is written straight away."""
+
+    def load(self, customer_id):
+        cart = Cart.objects.filter(customer_id=customer_id).order_by('pk').only('id', 'total_price').first()
+        if cart is None:
+            return empty_state()
+        lines = {}
+        items = CartItem.objects.filter(cart=cart).order_by('pk').values_list(
+            'product_id', 'color_id', 'size_id', 'quantity'
+        )
+        for product_id, color_id, size_id, quantity in items:
+            line = lines.setdefault((product_id, color_id, size_id), {
+                'quantity': 0,
+                'color_name': reference_data.color(color_id).name,
+                'size_name': reference_data.size(size_id).name if size_id else None,
+            })
+            line['quantity'] += quantity
+        return {'cart_id': cart.pk, 'lines': lines, 'total': Decimal(cart.total_price or 0).quantize(CENT)}
+
+    def save(self, customer_id, state):
+        """Write the state to the tables: at most one bulk delete, update and insert."""
+        with transaction.atomic():
+            cart, _ = Cart.objects.get_or_create(customer_id=customer_id, defaults={'total_price': 0})
+            existing = {
+                (item.product_id, item.color_id, item.size_id): item
+                for item in CartItem.objects.filter(cart=cart)
+            }
+            to_update = []
+            to_create = []
+            for key, line in state['lines'].items():
+                item = existing.pop(key, None)
+                if item is None:
+                    product_id, color_id, size_id = key
+                    to_create.append(CartItem(
+                        cart=cart, product_id=product_id, color_id=color_id, size_id=size_id, quantity=line['quantity'],
+                    ))
+                elif item.quantity != line['quantity']:
+                    item.quantity = line['quantity']
+                    to_update.append(item)
+            if existing:
+                CartItem.objects.filter(pk__in=[item.pk for item in existing.values()]).delete()
+            if to_update:
+                CartItem.objects.bulk_update(to_update, ['quantity'])
+            if to_create:
+                CartItem.objects.bulk_create(to_create)
+            if state.get('total') is None:
+                state['total'] = refresh_cart_total(cart)
+            else:
+                Cart.objects.filter(pk=cart.pk).update(total_price=state['total'])
+        state['cart_id'] = cart.pk
+        return state
+
+    def add_lines(self, customer_id, additions):
+        """
+        Add quantities to lines and return the new state. `additions` maps
+        line keys to {'quantity', 'color_name', 'size_name', 'stock'}.
+
+        Each line is one guarded write: UPDATE ... SET quantity = quantity + n
+        WHERE quantity + n <= stock, or an INSERT when the line is new (the
+        unique constraint on CartItem turns a concurrent insert of the same
+        line into an update). Nothing is read first, so concurrent adds can
+        neither lose an increment nor pass the stock. Raises NotEnoughStock,
+        writing nothing, when a line would exceed its stock.
+        """
+        with transaction.atomic():
+            cart, _ = Cart.objects.get_or_create(customer_id=customer_id, defaults={'total_price': 0})
+            shortages = []
+            for line_key, addition in additions.items():
+                if not self._add_to_line(cart, line_key, addition):
+                    product_id, color_id, size_id = line_key
+                    in_cart = CartItem.objects.filter(
+                        cart=cart, product_id=product_id, color_id=color_id, size_id=size_id
+                    ).values_list('quantity', flat=True).first()
+                    shortages.append((line_key, in_cart or 0))
+            if shortages:
+                # Leaving the atomic block with an exception rolls back the other lines
+                raise NotEnoughStock(shortages)
+            adjust_cart_total(cart, product_quantities(additions))
+        return self.load(customer_id)
+
+    def _add_to_line(self, cart, line_key, addition):
+        product_id, color_id, size_id = line_key
+        quantity = addition['quantity']
+        line = CartItem.objects.filter(cart=cart, product_id=product_id, color_id=color_id, size_id=size_id)
+        stock = Subquery(ProductColorSize.objects.filter(
+            product_color_image__product_id=product_id, product_color_image__color_id=color_id, size_id=size_id,
+        ).values('stock')[:1])
+
+        if line.filter(quantity__lte=stock - quantity).update(quantity=F('quantity') + quantity):
+            return True
+        if quantity > addition['stock']:
+            return False
+        try:
+            with transaction.atomic():
+                CartItem.objects.create(
+                    cart=cart, product_id=product_id, color_id=color_id, size_id=size_id, quantity=quantity,
+                )
+            return True
+        except IntegrityError:
+            # The line exists after all (just inserted by a concurrent add, or
+            # refused by the guard above): one more guarded update decides
+            return bool(line.filter(quantity__lte=stock - quantity).update(quantity=F('quantity') + quantity))
+
+    def delete(self, customer_id):
+        Cart.objects.filter(customer_id=customer_id).delete()
+
+    @contextmanager
+    def locked(self, customer_id):
+        """Run a read-modify-write of the customer's cart without concurrent edits."""
+        with transaction.atomic():
+            list(Cart.objects.select_for_update().filter(customer_id=customer_id).values_list('pk', flat=True))
+            yield
+
+    def persist(self, customer_id):
+        """Make sure the tables hold the latest state (nothing to do here)."""
+
+    def persist_pending(self, batch_size=500):
+        return 0
+
+
+class CacheCartStore(DatabaseCartStore):
+    """
+    Carts live in a Django cache and are written to the tables behind:
+    by `persist_pending()` (manage.py persist_carts, run periodically) and by
+    `persist()` at checkout. Browsing and cart edits never write the database.
+
+    Every save appends the customer to a change log of numbered cache keys
+    (numbered with cache.incr); persist_pending() replays the log from where
+    the previous run stopped and deletes the entries it wrote. Entries never
+    expire, so a late run still writes every cart, but persist_carts must be
+    scheduled: until it runs, carts only live in the cache.
+    The cart lock is a cache.add. Both need a backend where add and incr are
+    atomic (ATOMIC_BACKENDS): the file and database caches implement them as
+    a read then a write, so two workers could both take a lock or get the
+    same sequence number.
+    """
+    state_prefix = 'cart-store:cart:'
+    log_prefix = 'cart-store:changed:'
+    log_sequence_key = 'cart-store:changed-seq'
+    persisted_sequence_key = 'cart-store:persisted-seq'
+    gap_key = 'cart-store:gap'
+    lock_prefix = 'cart-store:lock:'
+
+    lock_timeout = 10
+    lock_wait = 5
+
+    # Backends with atomic add and incr. LocMemCache is atomic within one
+    # process only, fine for a single worker and the tests.
+    ATOMIC_BACKENDS = (RedisCache, PyMemcacheCache, PyLibMCCache, LocMemCache)
+
+    def __init__(self, alias=None):
+        alias = alias or getattr(settings, 'CART_STORE_CACHE_ALIAS', 'default')
+        self.cache = caches[alias]
+        if not isinstance(self.cache, self.ATOMIC_BACKENDS):
+            raise ImproperlyConfigured(
+                f"CacheCartStore needs a cache with atomic add and incr (Redis, Memcached); "
+                f"the '{alias}' cache is a {type(self.cache).__name__}. Use DatabaseCartStore instead."
+            )
+
+    def _state_key(self, customer_id):
+        return f'{self.state_prefix}{customer_id}'
+
+    def load(self, customer_id):
+        state = self.cache.get(self._state_key(customer_id))
+        if state is None:
+            # First touch since the cache was emptied: start from the tables
+            state = super().load(customer_id)
+            self.cache.add(self._state_key(customer_id), state, timeout=None)
+        return state
+
+    def save(self, customer_id, state):
+        def write():
+            self.cache.set(self._state_key(customer_id), state, timeout=None)
+            self._log_change(customer_id)
+
+        # Inside a transaction (idempotent views, checkout) the cache is only
+        # written once it commits: a rollback, or a rerun of the transaction
+        # by retry_on_conflict, must not leave the edit applied
+        transaction.on_commit(write)
+        return state
+
+    def _log_change(self, customer_id):
+        self.cache.add(self.log_sequence_key, 0, timeout=None)
+        sequence = self.cache.incr(self.log_sequence_key)
+        self.cache.set(self._log_key(sequence), customer_id, timeout=None)
+
+    def _log_key(self, sequence):
+        return f'{self.log_prefix}{sequence}'
+
+    def add_lines(self, customer_id, additions):
+        # The cache holds the whole cart: add under the cart lock (an atomic
+        # cache.add, see ATOMIC_BACKENDS) instead of a guarded UPDATE
+        with self.locked(customer_id):
+            state = self.load(customer_id)
+            shortages = []
+            for line_key, addition in additions.items():
+                line = state['lines'].setdefault(line_key, {
+                    'quantity': 0, 'color_name': addition['color_name'], 'size_name': addition['size_name'],
+                })
+                if line['quantity'] + addition['quantity'] > addition['stock']:
+                    shortages.append((line_key, line['quantity']))
+                line['quantity'] += addition['quantity']
+            if shortages:
+                raise NotEnoughStock(shortages)
+            state['total'] = adjusted_total(state, product_quantities(additions))
+            return self.save(customer_id, state)
+
+    def delete(self, customer_id):
+        transaction.on_commit(lambda: self.cache.delete(self._state_key(customer_id)))
+        super().delete(customer_id)
+
+    @contextmanager
+    def locked(self, customer_id):
+        key = f'{self.lock_prefix}{customer_id}'
+        deadline = time.monotonic() + self.lock_wait
+        while not self.cache.add(key, 1, timeout=self.lock_timeout):
+            if time.monotonic() > deadline:
+                raise CartBusy()
+            time.sleep(0.01)
+        try:
+            yield
+        except BaseException:
+            self.cache.delete(key)
+            raise
+        # Held until the edit reaches the cache (see save). Should the
+        # transaction roll back later on, the lock expires after lock_timeout.
+        transaction.on_commit(lambda: self.cache.delete(key))
+
+    def persist(self, customer_id):
+        state = self.cache.get(self._state_key(customer_id))
+        if state is None:
+            return
+        state = super().save(customer_id, state)
+        # Remember the Cart id so snapshots can show it
+        transaction.on_commit(lambda: self.cache.set(self._state_key(customer_id), state, timeout=None))
+
+    def persist_pending(self, batch_size=500):
+        """Write every cart changed since the last run; returns how many were written."""
+        start = self.cache.get(self.persisted_sequence_key) or 0
+        end = self.cache.get(self.log_sequence_key) or 0
+        known_gap = self.cache.get(self.gap_key)
+        written = 0
+        while start < end:
+            sequences = range(start + 1, min(start + batch_size, end) + 1)
+            entries = self.cache.get_many([self._log_key(sequence) for sequence in sequences])
+            gap = next((
+                sequence for sequence in sequences
+                if self._log_key(sequence) not in entries and sequence != known_gap
+            ), None)
+            if gap is not None:
+                # Numbered by a save that has not written its entry yet: stop
+                # before it. Still missing on the next run, the save died and
+                # the number is skipped.
+                self.cache.set(self.gap_key, gap, timeout=None)
+                sequences = range(start + 1, gap)
+            written += self._persist_customers({
+                entries[self._log_key(sequence)] for sequence in sequences if self._log_key(sequence) in entries
+            })
+            if sequences:
+                self.cache.delete_many([self._log_key(sequence) for sequence in sequences])
+                start = sequences[-1]
+                self.cache.set(self.persisted_sequence_key, start, timeout=None)
+            if gap is not None:
+                break
+        return written
+
+    def _persist_customers(self, customer_ids):
+        written = 0
+        for customer_id in customer_ids:
+            try:
+                with self.locked(customer_id):
+                    self.persist(customer_id)
+            except CartBusy:
+                # Still being edited: the next run picks it up
+                self._log_change(customer_id)
+                continue
+            written += 1
+        return written
+
+
+def get_cart_store():
+    return import_string(getattr(settings, 'CART_STORE', 'store.cart_store.DatabaseCartStore'))()
+
+
+def check_cart_store(app_configs, **kwargs):
+    """System check: refuse to start with a cart store that cannot work on its cache."""
+    try:
+        get_cart_store()
+    except ImproperlyConfigured as error:
+        return [checks.Error(str(error), id='store.E001')]
+    return []
@@ -0,0 +1,270 @@
+from functools import reduce
+from operator import or_
+
+from django.db.models import Q
+
+from .cart_store import CartBusy, NotEnoughStock, adjusted_total, get_cart_store, product_quantities
+from .models import ProductColorSize
+from .pricing import CENT, price_quantities
+from .reference_data import reference_data
+
+# Cart edits. Every endpoint goes through apply_cart_operations(), which
+# works on the cart state of the configured cart store (store/cart_store.py)
+# and never reads or writes the Cart/CartItem tables itself.
+OPERATIONS = ('add', 'set', 'increment', 'decrement', 'remove')
+
+# Operations that can raise a quantity, and so need the SKU's stock
+GROWING_OPERATIONS = ('add', 'set', 'increment')
+
+
+class CartOperationError(Exception):
+    """An operation of a batch could not be applied; nothing was written."""
+
+    def __init__(self, detail, index=None, status_code=400):
+        super().__init__(detail)
+        self.detail = detail
+        self.index = index
+        self.status_code = status_code
+
+    def as_dict(self):
+        data = {'detail': self.detail}
+        if self.index is not None:
+            data['operation'] = self.index
+        return data
+
+
+def _parse(operations):
+    if not isinstance(operations, list) or not operations:
+        raise CartOperationError("operations must be a non-empty list")
+    parsed = []
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict):
+            raise CartOperationError("Each operation must be an object", index)
+        op = operation.get('op')
+        product_id = operation.get('product_id')
+        color_name = operation.get('color_name')
+        size_name = operation.get('size_name')
+        quantity = operation.get('quantity', 1 if op in ('add', 'increment', 'decrement') else None)
+        if op not in OPERATIONS:
+            raise CartOperationError(f"op must be one of {', '.join(OPERATIONS)}", index)
+        if not product_id or not color_name or not size_name:
+            raise CartOperationError("Missing product_id, color_name, or size_name", index)
+        if op == 'set' and (not isinstance(quantity, int) or quantity < 0):
+            raise CartOperationError("set needs a quantity >= 0", index)
+        if op in ('add', 'increment', 'decrement') and (not isinstance(quantity, int) or quantity <= 0):
+            raise CartOperationError("quantity must be a positive integer", index)
+        try:
+            product_id = int(product_id)
+        except (TypeError, ValueError):
+            raise CartOperationError("Invalid product_id", index)
+        parsed.append((index, op, (product_id, str(color_name), str(size_name)), quantity))
+    return parsed
+
+
+def _resolve_skus(keys):
+    """
+    Map (product_id, color_name, size_name) to its ProductColorSize row, in
+    one query; names are turned into ids from the reference data.
+    """
+    wanted = {}
+    for product_id, color_name, size_name in keys:
+        size_id = reference_data.size_id(size_name)
+        for color_id in reference_data.color_ids(color_name) if size_id else ():
+            wanted[(product_id, color_id, size_id)] = (product_id, color_name, size_name)
+    if not wanted:
+        return {}
+    conditions = [
+        Q(product_color_image__product_id=product_id, product_color_image__color_id=color_id, size_id=size_id)
+        for product_id, color_id, size_id in wanted
+    ]
+    rows = ProductColorSize.objects.filter(reduce(or_, conditions)).values(
+        'stock', 'size_id', 'product_color_image__product_id', 'product_color_image__color_id',
+    )
+    return {
+        wanted[(row['product_color_image__product_id'], row['product_color_image__color_id'], row['size_id'])]: row
+        for row in rows
+    }
+
+
+def apply_cart_operations(customer, operations, store=None):
+    """
+    Apply an ordered list of cart operations to the customer's cart and
+    return the new cart state. Quantities are worked out in memory, checked
+    against stock once (one query) for every line that grew, then saved to
+    the cart store in one go. 'add' and 'set' create missing lines;
+    'increment', 'decrement' and 'remove' need the line to be in the cart.
+    A batch of 'add' operations only goes through the store's add_lines(),
+    which increments lines in place.
+    Raises CartOperationError (and saves nothing) when an operation is
+    invalid or a line would exceed the available stock.
+    """
+    parsed = _parse(operations)
+    store = store or get_cart_store()
+    try:
+        if all(op == 'add' for _, op, _, _ in parsed):
+            return _add(customer, parsed, store)
+        return _apply(customer, parsed, store)
+    except CartBusy:
+        raise CartOperationError("The cart is being updated, please retry", status_code=409)
+
+
+def _shortage(key, stock, requested, in_cart):
+    return f"{key[1]} ({key[2]}). Available: {stock}, Requested: {requested}, In cart: {in_cart}"
+
+
+def _add(customer, parsed, store):
+    # Adding only: the store can increment the lines in place (add_lines)
+    skus = _resolve_skus({key for _, _, key, _ in parsed})
+    additions = {}
+    keys = {}
+    for index, _, key, quantity in parsed:
+        sku = skus.get(key)
+        if sku is None:
+            raise CartOperationError(f"No stock record available for {key[0]} - {key[1]} - {key[2]}", index)
+        line_key = (key[0], sku['product_color_image__color_id'], sku['size_id'])
+        addition = additions.setdefault(line_key, {
+            'quantity': 0, 'color_name': key[1], 'size_name': key[2], 'stock': sku['stock'],
+        })
+        addition['quantity'] += quantity
+        keys[line_key] = key
+    try:
+        return store.add_lines(customer.pk, additions)
+    except NotEnoughStock as error:
+        raise CartOperationError("Not enough stock for " + "; ".join(
+            _shortage(keys[line_key], additions[line_key]['stock'], additions[line_key]['quantity'], in_cart)
+            for line_key, in_cart in error.shortages
+        ))
+
+
+def _apply(customer, parsed, store):
+    with store.locked(customer.pk):
+        state = store.load(customer.pk)
+        # Work on copies so a failed batch leaves the stored state alone
+        lines = {line_key: dict(line) for line_key, line in state['lines'].items()}
+        original = {line_key: line['quantity'] for line_key, line in lines.items()}
+        by_name = {
+            (line_key[0], line['color_name'], line['size_name']): line_key
+            for line_key, line in lines.items()
+        }
+        skus = _resolve_skus({key for _, op, key, _ in parsed if op in GROWING_OPERATIONS})
+
+        for index, op, key, quantity in parsed:
+            line_key = by_name.get(key)
+            in_cart = line_key is not None and lines[line_key]['quantity'] > 0
+            if not in_cart and op not in ('add', 'set'):
+                raise CartOperationError("Cart item not found for this product, color, and size", index, 404)
+            if op in GROWING_OPERATIONS and key not in skus:
+                raise CartOperationError(f"No stock record available for {key[0]} - {key[1]} - {key[2]}", index)
+            if line_key is None:
+                sku = skus[key]
+                line_key = by_name[key] = (key[0], sku['product_color_image__color_id'], sku['size_id'])
+                lines[line_key] = {'quantity': 0, 'color_name': key[1], 'size_name': key[2]}
+
+            line = lines[line_key]
+            if op in ('add', 'increment'):
+                line['quantity'] += quantity
+            elif op == 'decrement':
+                line['quantity'] = max(line['quantity'] - quantity, 0)
+            elif op == 'set':
+                line['quantity'] = quantity
+            else:
+                line['quantity'] = 0
+
+        # One stock check over every line that grew
+        shortages = []
+        for key, sku in skus.items():
+            line_key = by_name.get(key)
+            if line_key is None:
+                continue
+            quantity, in_cart = lines[line_key]['quantity'], original.get(line_key, 0)
+            if quantity > in_cart and quantity > sku['stock']:
+                shortages.append(_shortage(key, sku['stock'], quantity - in_cart, in_cart))
+        if shortages:
+            raise CartOperationError("Not enough stock for " + "; ".join(shortages))
+
+        before = product_quantities(state['lines'])
+        new_state = {
+            'cart_id': state['cart_id'],
+            'lines': {line_key: line for line_key, line in lines.items() if line['quantity'] > 0},
+            'total': state.get('total'),
+        }
+        # Only the products whose quantity changed are priced
+        after = product_quantities(new_state['lines'])
+        new_state['total'] = adjusted_total(new_state, {
+            product_id: after.get(product_id, 0) - before.get(product_id, 0)
+            for product_id in before.keys() | after.keys()
+        })
+        return store.save(customer.pk, new_state)
+
+
+def current_cart(customer, store=None):
+    """
+    Load the customer's cart state with unavailable lines pruned (see
+    prune_lines) and the total recounted in full from the current prices;
+    the state is saved back when that changed it and nobody else is
+    editing the cart.
+    """
+    store = store or get_cart_store()
+    state = store.load(customer.pk)
+    if _refresh(state):
+        try:
+            with store.locked(customer.pk):
+                # Refresh what is stored now, not what was read before the lock
+                state = store.load(customer.pk)
+                _refresh(state)
+                store.save(customer.pk, state)
+        except CartBusy:
+            pass  # Refreshed again on the next read
+    return state
+
+
+def _refresh(state):
+    pruned = prune_lines(state)
+    total = price_quantities(product_quantities(state['lines']))
+    changed = pruned or total != state.get('total')
+    state['total'] = total
+    return changed
+
+
+def prune_lines(state):
+    """
+    Drop the lines whose SKU is gone or out of stock and clamp the others to
+    the stock left, with one availability query whatever the number of
+    lines. Returns True when the state changed.
+    """
+    if not state['lines']:
+        return False
+    product_ids, color_ids, size_ids = (set(ids) for ids in zip(*state['lines']))
+    rows = ProductColorSize.objects.filter(
+        product_color_image__product_id__in=product_ids,
+        product_color_image__color_id__in=color_ids,
+        size_id__in=size_ids,
+    ).values_list('product_color_image__product_id', 'product_color_image__color_id', 'size_id', 'stock')
+    available = {(product_id, color_id, size_id): stock for product_id, color_id, size_id, stock in rows}
+
+    changed = False
+    for line_key, line in list(state['lines'].items()):
+        stock = available.get(line_key) or 0
+        if stock <= 0:
+            del state['lines'][line_key]
+            changed = True
+        elif line['quantity'] > stock:
+            line['quantity'] = stock
+            changed = True
+    return changed
+
+
+def cart_snapshot(customer_id, state):
+    """The cart as CartSerializer renders it, built from a cart state."""
+    total = state.get('total')
+    if total is None:
+        total = price_quantities(product_quantities(state['lines']))
+    return {
+        'id': state['cart_id'],
+        'customer': customer_id,
+        'total_price': str(total.quantize(CENT)),
+        'cart_items': [
+            {'product': product_id, 'color': color_id, 'size_name': line['size_name'], 'quantity': line['quantity']}
+            for (product_id, color_id, _), line in state['lines'].items()
+        ],
+    }
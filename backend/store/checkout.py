@@ -0,0 +1,220 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+
+from . import leaderboard, popularity, reservations, stock
+from .models import Order, OrderItem, Product, ProductColorImage, StockMovement
+from .pricing import unit_prices
+from .reference_data import reference_data
+from .response_cache import bump_cache_tags_on_commit
+from .retry import retry_on_conflict
+
+# Checkout pipeline behind submit_cart. The cost is a fixed number of queries
+# whatever the number of lines:
+#   1. resolve  - products, prices and every SKU (color image + size rows) in bulk
+#   2. stock    - use the customer's stock holds (store/reservations.py), then
+#                 take what was not held with one conditional UPDATE per
+#                 stock table (store/stock.py); no stock row stays locked
+#   3. write    - pending orders, order lines and totals with bulk statements
+# A transaction that lost a conflict with a concurrent writer is rerun.
+
+
+class CheckoutError(Exception):
+    """The checkout was refused; nothing was written."""
+
+    def __init__(self, detail):
+        super().__init__(detail)
+        self.detail = detail
+
+
+class _Line:
+    __slots__ = ('product', 'color_name', 'size_name', 'quantity', 'color_id', 'size_id', 'image_id', 'size_row_id')
+
+    def __init__(self, product, color_name, size_name, quantity):
+        self.product = product
+        self.color_name = color_name
+        self.size_name = size_name
+        self.quantity = quantity
+        self.color_id = self.size_id = self.image_id = self.size_row_id = None
+
+    @property
+    def sku(self):
+        # Sized lines take stock from their ProductColorSize, the others from the color image
+        return (self.image_id, self.size_row_id)
+
+    @property
+    def label(self):
+        return f"{self.product.name} ({self.color_name}{' - ' + self.size_name if self.size_name else ''})"
+
+
+def resolve_lines(aggregated):
+    """Turn {(product_id, color_name, size_name): quantity} into checked lines."""
+    products = Product.objects.only('id', 'name', 'category_id', 'created_by_shop_id').in_bulk(
+        {product_id for product_id, _, _ in aggregated}
+    )
+    lines = []
+    for (product_id, color_name, size_name), quantity in aggregated.items():
+        product = products.get(product_id)
+        if product is None:
+            raise CheckoutError(f"Product {product_id} not found.")
+        if not reference_data.color_ids(color_name):
+            raise CheckoutError(f"Color {color_name} not found.")
+        lines.append(_Line(product, color_name, size_name, quantity))
+
+    # Every SKU of the requested product colors, sizes included, in one query
+    skus = ProductColorImage.objects.filter(
+        product_id__in=products,
+        color_id__in={color_id for line in lines for color_id in reference_data.color_ids(line.color_name)},
+    ).order_by('pk').values_list('pk', 'product_id', 'color_id', 'sizes__pk', 'sizes__size_id')
+    images = {}
+    sizes = defaultdict(dict)
+    for image_id, product_id, color_id, size_row_id, size_id in skus:
+        images.setdefault((product_id, color_id), image_id)
+        if size_row_id is not None:
+            sizes[image_id][size_id] = size_row_id
+
+    for line in lines:
+        for color_id in reference_data.color_ids(line.color_name):
+            if (line.product.pk, color_id) in images:
+                line.color_id = color_id
+                line.image_id = images[(line.product.pk, color_id)]
+                break
+        else:
+            raise CheckoutError(f"No stock entry for {line.product.name} - {line.color_name}.")
+        if sizes[line.image_id]:
+            if not line.size_name:
+                raise CheckoutError(f"Size required for {line.product.name} - {line.color_name}.")
+            line.size_id = reference_data.size_id(line.size_name, ignore_case=True)
+            line.size_row_id = sizes[line.image_id].get(line.size_id)
+            if line.size_row_id is None:
+                raise CheckoutError(f"No size '{line.size_name}' for {line.product.name} - {line.color_name}.")
+        if not line.product.created_by_shop_id:
+            raise CheckoutError(f"Product '{line.product.name}' is not linked to a shop.")
+    return lines
+
+
+def _requested(lines):
+    # Lines can share a SKU ('M' and 'm' resolve to the same size)
+    requested = defaultdict(int)
+    for line in lines:
+        requested[line.sku] += line.quantity
+    return requested
+
+
+def _not_enough_stock(lines, sku, available, requested):
+    line = next(line for line in lines if line.sku == sku)
+    return CheckoutError(f"Not enough stock for {line.label}. Available: {available}, requested: {requested}.")
+
+
+def reserve_checkout(customer, aggregated):
+    """
+    Start a checkout: hold the stock of the aggregated lines for the customer
+    (store/reservations.py), replacing the holds of an earlier start. Returns
+    the expiry of the holds. Raises CheckoutError, holding nothing, on the
+    same errors as place_orders().
+    """
+    if not aggregated:
+        raise CheckoutError("No valid items to reserve.")
+    lines = resolve_lines(aggregated)
+    requested = _requested(lines)
+    try:
+        return reservations.hold(customer, requested)
+    except reservations.NotEnoughStock as error:
+        sku, available = next(iter(error.shortages.items()))
+        raise _not_enough_stock(lines, sku, available, requested[sku])
+
+
+@retry_on_conflict
+def place_orders(customer, aggregated):
+    """
+    Merge the aggregated checkout lines into the customer's pending orders
+    (one per shop) and take the quantities off the stock, using the
+    customer's holds first. Returns the orders. Raises CheckoutError,
+    writing nothing, on an unknown product, color or size, a product without
+    a shop, or missing stock.
+    """
+    if not aggregated:
+        raise CheckoutError("No valid items to add to the order.")
+
+    with transaction.atomic():
+        lines = resolve_lines(aggregated)
+        prices = unit_prices({line.product.pk for line in lines})
+        requested = _requested(lines)
+
+        # Held quantities already left the stock; the rest is taken now
+        held = reservations.consume(customer, requested)
+        shortages = stock.take(
+            {sku: quantity - held.get(sku, 0) for sku, quantity in requested.items()}, StockMovement.Reason.SALE,
+        )
+        if shortages:
+            sku, available = next(iter(shortages.items()))
+            raise _not_enough_stock(lines, sku, available + held.get(sku, 0), requested[sku])
+
+        orders = _pending_orders(customer, {line.product.created_by_shop_id for line in lines})
+        _write_order_items(orders, lines)
+
+        totals = defaultdict(Decimal)
+        for line in lines:
+            totals[line.product.created_by_shop_id] += prices[line.product.pk] * line.quantity
+        for shop_id, order in orders.items():
+            order.total_price = totals[shop_id]
+        Order.objects.bulk_update(orders.values(), ['total_price'])
+
+        sold = [
+            (line.product.pk, line.product.created_by_shop_id, line.product.category_id, line.quantity)
+            for line in lines
+        ]
+        popularity.record_sales(sold)
+        leaderboard.record_sales(sold)
+
+        # Stock and sales counts changed through bulk updates, which send no signals
+        bump_cache_tags_on_commit('products', 'orders')
+
+    return list(orders.values())
+
+
+def _pending_orders(customer, shop_ids):
+    """{shop_id: pending order}, locked, creating the missing ones."""
+    orders = {}
+    pending = Order.objects.select_for_update().filter(
+        customer=customer, shop_id__in=shop_ids, status=Order.Status.PENDING
+    ).order_by('pk')
+    for order in pending:
+        orders.setdefault(order.shop_id, order)
+    missing = [
+        Order(customer=customer, shop_id=shop_id, status=Order.Status.PENDING, total_price=Decimal('0.00'))
+        for shop_id in sorted(shop_ids - orders.keys())
+    ]
+    for order in Order.objects.bulk_create(missing):
+        orders[order.shop_id] = order
+    return orders
+
+
+def _write_order_items(orders, lines):
+    """Add the lines to the orders: one bulk update for lines already ordered, one bulk insert for the others."""
+    existing = {}
+    items = OrderItem.objects.filter(order__in=orders.values()).order_by('pk').only(
+        'id', 'order_id', 'product_id', 'color_id', 'size_id', 'quantity'
+    )
+    for item in items:
+        existing.setdefault((item.order_id, item.product_id, item.color_id, item.size_id), item)
+
+    to_update = []
+    to_create = []
+    for line in lines:
+        order = orders[line.product.created_by_shop_id]
+        key = (order.pk, line.product.pk, line.color_id, line.size_id)
+        item = existing.get(key)
+        if item is None:
+            item = existing[key] = OrderItem(
+                order=order, product_id=line.product.pk, color_id=line.color_id, size_id=line.size_id, quantity=0,
+            )
+            to_create.append(item)
+        elif item.pk and item not in to_update:
+            to_update.append(item)
+        item.quantity += line.quantity
+    if to_update:
+        OrderItem.objects.bulk_update(to_update, ['quantity'])
+    if to_create:
+        OrderItem.objects.bulk_create(to_create)
@@ -0,0 +1,32 @@
+from functools import reduce
+from operator import or_
+
+from django.db.models import Case, F, Q, Value, When
+
+
+def add_to_counters(model, key_fields, value_field, increments):
+    """
+    Add amounts to counter rows, creating the missing ones.
+    `increments` maps tuples of `key_fields` values to the amount to add, e.g.
+    {(day, shop_id, product_id): 3}. The model needs a unique constraint on
+    `key_fields` and a default on `value_field`.
+
+    Two queries whatever the number of counters: one INSERT ... ON CONFLICT DO
+    NOTHING, then one UPDATE ... SET value = value + CASE ... END, which stays
+    correct under concurrent writers.
+    """
+    if not increments:
+        return
+    model.objects.bulk_create(
+        [model(**dict(zip(key_fields, key))) for key in increments],
+        ignore_conflicts=True,
+    )
+    conditions = [Q(**dict(zip(key_fields, key))) for key in increments]
+    output_field = model._meta.get_field(value_field)
+    model.objects.filter(reduce(or_, conditions)).update(**{
+        value_field: F(value_field) + Case(
+            *[When(condition, then=Value(amount)) for condition, amount in zip(conditions, increments.values())],
+            default=Value(0),
+            output_field=output_field,
+        )
+    })
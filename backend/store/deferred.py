@@ -0,0 +1,35 @@
+import threading
+
+from django.db import transaction
+
+
+class OnCommitBatch:
+    """
+    Collect keys (usually product ids) during a transaction and hand them to
+    `handler` once, after the transaction commits. Several writes touching the
+    same key in one transaction cost a single call for that key.
+    Outside a transaction the handler runs immediately.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self._local = threading.local()
+
+    def pending(self):
+        if not hasattr(self._local, 'keys'):
+            self._local.keys = set()
+        return self._local.keys
+
+    def add(self, key):
+        if key is None:
+            return
+        self.pending().add(key)
+        transaction.on_commit(self.flush)
+
+    def flush(self):
+        pending = self.pending()
+        if not pending:
+            return
+        keys = set(pending)
+        pending.clear()
+        self.handler(keys)
@@ -0,0 +1,78 @@
+from django.core.exceptions import ValidationError
+
+from .deferred import OnCommitBatch
+from .models import Product, ProductDocument
+from .serializers import ProductSerializer
+
+
+def build_product_document(product):
+    """
+    Serialize a product (loaded with Product.objects.with_details()) the way
+    the detail routes return it. Image URLs are left relative so the document
+    does not depend on the request host.
+    """
+    return ProductSerializer(product).data
+
+
+def refresh_product_documents(product_ids):
+    """Rebuild and upsert the documents for the given products in one write."""
+    products = Product.objects.with_details().filter(pk__in=list(product_ids))
+    documents = [
+        ProductDocument(product=product, data=build_product_document(product))
+        for product in products
+    ]
+    if documents:
+        ProductDocument.objects.bulk_create(
+            documents,
+            update_conflicts=True,
+            unique_fields=['product'],
+            update_fields=['data', 'updated_at'],
+        )
+    return documents
+
+
+# Product ids whose document must be rebuilt once the current transaction commits.
+_pending_documents = OnCommitBatch(refresh_product_documents)
+
+
+def schedule_document_refresh(product_id):
+    """
+    Queue a product for a rebuild after commit. Several writes to the same
+    product in one transaction (nested admin saves, stock rollups) rebuild its
+    document only once.
+    """
+    _pending_documents.add(product_id)
+
+
+def invalidate_documents(**product_filter):
+    """
+    Drop the documents of every product matching the filter. Used for shared
+    rows (category, brand, color, ...) where a rebuild could touch many
+    products; the documents are rebuilt lazily on the next read.
+    """
+    ProductDocument.objects.filter(**{f'product__{key}': value for key, value in product_filter.items()}).delete()
+
+
+def get_product_document(request=None, **lookup):
+    """
+    Return the ready-to-serve document for the product matching `lookup`
+    (e.g. pk=1 or name='iPhone 16'), building it on a miss. Returns None when
+    no such product exists.
+    """
+    document_lookup = {f'product__{key}': value for key, value in lookup.items()}
+    try:
+        data = ProductDocument.objects.filter(**document_lookup).values_list('data', flat=True).first()
+    except (TypeError, ValueError, ValidationError):
+        return None
+    if data is None:
+        product = Product.objects.filter(**lookup).values_list('pk', flat=True).first()
+        if product is None:
+            return None
+        data = refresh_product_documents([product])[0].data
+
+    if request is not None:
+        # Match what the live serializer returns when it has a request.
+        for color_image in data.get('color_images', []):
+            if color_image.get('image'):
+                color_image['image'] = request.build_absolute_uri(color_image['image'])
+    return data
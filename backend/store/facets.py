@@ -0,0 +1,120 @@
+from bisect import bisect_right
+
+from django.db import transaction
+from django.db.models import Count, QuerySet
+
+from .deferred import OnCommitBatch
+from .models import Product, ProductColorImage, ProductColorSize, ProductFacet
+
+# Facet index: one ProductFacet row per (product, facet, value). Kept current
+# from model signals (store/signals.py); `manage.py rebuild_product_facets`
+# fills it from scratch.
+FACET_NAMES = ('category', 'brand', 'device_model', 'color', 'size', 'price')
+
+# Lower bounds of the price buckets, the last one is open-ended.
+PRICE_BUCKETS = (0, 100, 250, 500, 1000, 2000)
+
+# Query parameters shared by the product list, search and facet counts.
+CATALOG_FILTERS = ('category_id', 'brand_id', 'device_model_id')
+
+
+def catalog_filters(params):
+    """Filter kwargs for the category/brand/device model query parameters ('All' means no filter)."""
+    filters = {}
+    for name in CATALOG_FILTERS:
+        value = params.get(name)
+        if value and value != 'All':
+            filters[name] = value
+    return filters
+
+
+def price_bucket(price):
+    """Return (lower bound, label) of the bucket a price falls in."""
+    index = max(bisect_right(PRICE_BUCKETS, price) - 1, 0)
+    lower = PRICE_BUCKETS[index]
+    if index + 1 < len(PRICE_BUCKETS):
+        return lower, f'{lower}-{PRICE_BUCKETS[index + 1]}'
+    return lower, f'{lower}+'
+
+
+def refresh_product_facets(product_ids):
+    """Rewrite the facet rows of the given products."""
+    product_ids = list(product_ids)
+    rows = {}
+
+    def add(product_id, name, value, label):
+        rows[(product_id, name, value)] = ProductFacet(product_id=product_id, name=name, value=value, label=label)
+
+    products = Product.objects.filter(pk__in=product_ids).select_related(
+        'category', 'brand', 'device_model'
+    ).only('id', 'category__name', 'brand__name', 'device_model__name').with_prices()
+    for product in products:
+        for name in ('category', 'brand', 'device_model'):
+            related = getattr(product, name)
+            if related is not None:
+                add(product.pk, name, related.pk, related.name)
+        # Bucketed on the price the product is listed at (ShopInventory override included)
+        lower, label = price_bucket(product.effective_price)
+        add(product.pk, 'price', lower, label)
+
+    colors = ProductColorImage.objects.filter(product_id__in=product_ids).values_list(
+        'product_id', 'color_id', 'color__color_name'
+    )
+    for product_id, color_id, color_name in colors:
+        add(product_id, 'color', color_id, color_name)
+
+    sizes = ProductColorSize.objects.filter(product_color_image__product_id__in=product_ids).values_list(
+        'product_color_image__product_id', 'size_id', 'size__name'
+    )
+    for product_id, size_id, size_name in sizes:
+        add(product_id, 'size', size_id, size_name)
+
+    with transaction.atomic():
+        ProductFacet.objects.filter(product_id__in=product_ids).delete()
+        ProductFacet.objects.bulk_create(rows.values())
+
+
+_pending_facets = OnCommitBatch(refresh_product_facets)
+
+
+def schedule_facet_refresh(product_id):
+    _pending_facets.add(product_id)
+
+
+def relabel_facet(name, value, label):
+    """A category, brand, ... was renamed: update the stored labels in place."""
+    ProductFacet.objects.filter(name=name, value=value).exclude(label=label).update(label=label)
+
+
+def drop_facet(name, value):
+    ProductFacet.objects.filter(name=name, value=value).delete()
+
+
+def facet_counts(products):
+    """
+    Count products per facet value in a single GROUP BY over the facet index.
+    `products` is a Product queryset or any expression usable with `__in`
+    (e.g. a RawSQL subquery of search hits). Returns
+    {facet: [{'value': ..., 'label': ..., 'count': ...}, ...]} for every
+    facet in FACET_NAMES, most common values first (price buckets in price order).
+    """
+    if isinstance(products, QuerySet):
+        products = products.order_by().values('pk')
+    rows = (
+        ProductFacet.objects.filter(product_id__in=products)
+        .values('name', 'value', 'label')
+        .annotate(count=Count('product_id'))
+        .order_by('name', '-count', 'value')
+    )
+
+    facets = {name: [] for name in FACET_NAMES}
+    for row in rows:
+        facets.setdefault(row['name'], []).append(
+            {'value': row['value'], 'label': row['label'], 'count': row['count']}
+        )
+    facets['price'].sort(key=lambda bucket: bucket['value'])
+    return facets
+
+
+def facets_requested(request):
+    return request.query_params.get('facets') in ('1', 'true', 'True')
@@ -0,0 +1,120 @@
+import hashlib
+import json
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+from .retry import retry_on_conflict
+
+# Idempotency-Key support for the endpoints that write (checkout, cart
+# edits). A client sends the same key with every retry of a request; the
+# first request to run claims the key, and its response, once successful, is
+# stored with the key and replayed for the retries without running the view
+# again. Responses are kept IDEMPOTENCY_KEY_TTL seconds.
+#
+# A failed request gives its key back, so the client can retry it. A claim
+# whose request died is taken over after CLAIM_TIMEOUT seconds.
+HEADER = 'Idempotency-Key'
+CLAIM_TIMEOUT = 60
+
+
+def key_ttl():
+    return timedelta(seconds=getattr(settings, 'IDEMPOTENCY_KEY_TTL', 60 * 60 * 24))
+
+
+def _request_hash(request):
+    body = json.dumps(request.data, sort_keys=True, default=str)
+    return hashlib.sha256(f'{request.method} {request.path} {body}'.encode()).hexdigest()
+
+
+def _claim(user, scope, key, request_hash):
+    """(record, True) when this request claimed the key, (record or None, False) when another one has it."""
+    now = timezone.now()
+    record = IdempotencyKey.objects.filter(user=user, scope=scope, key=key).first()
+    if record is not None:
+        if record.expires_at > now:
+            return record, False
+        record.delete()
+    try:
+        with transaction.atomic():
+            return IdempotencyKey.objects.create(
+                user=user, scope=scope, key=key, request_hash=request_hash,
+                expires_at=now + timedelta(seconds=CLAIM_TIMEOUT),
+            ), True
+    except IntegrityError:
+        # Claimed by a concurrent retry
+        return IdempotencyKey.objects.filter(user=user, scope=scope, key=key).first(), False
+
+
+def _replay(record, request_hash):
+    if record is None or record.response_status is None:
+        return Response({"detail": "A request with this Idempotency-Key is still running, please retry."},
+                        status=status.HTTP_409_CONFLICT)
+    if record.request_hash != request_hash:
+        return Response({"detail": "This Idempotency-Key was used for a different request."},
+                        status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+    return Response(record.response_body, status=record.response_status, headers={'Idempotent-Replayed': 'true'})
+
+
+def idempotent(scope):
+    """
+    Make a function view idempotent for requests carrying an Idempotency-Key
+    header; requests without one run as usual. Put it under @api_view and
+    @permission_classes: keys belong to the authenticated user.
+    The view runs in a transaction that also stores its response, so the
+    writes and the stored response commit together; the transaction is
+    rerun when it loses a conflict with a concurrent writer. Views must not
+    have side effects outside the database that a rollback cannot undo
+    (CacheCartStore defers its cache writes to the commit for this).
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            key = request.headers.get(HEADER)
+            if not key or not request.user.is_authenticated:
+                return view(request, *args, **kwargs)
+            if len(key) > 255:
+                return Response({"detail": "Idempotency-Key is too long."}, status=status.HTTP_400_BAD_REQUEST)
+
+            request_hash = _request_hash(request)
+            record, claimed = _claim(request.user, scope, key, request_hash)
+            if not claimed:
+                return _replay(record, request_hash)
+
+            @retry_on_conflict
+            def run():
+                with transaction.atomic():
+                    response = view(request, *args, **kwargs)
+                    if status.is_success(response.status_code):
+                        record.response_status = response.status_code
+                        record.response_body = response.data
+                        record.expires_at = timezone.now() + key_ttl()
+                        record.save(update_fields=['response_status', 'response_body', 'expires_at'])
+                return response
+
+            try:
+                response = run()
+            except BaseException:
+                record.delete()
+                raise
+            if not status.is_success(response.status_code):
+                record.delete()
+            return response
+        return wrapper
+    return decorator
+
+
+def purge_expired(batch_size=1000):
+    """Delete the expired keys, `batch_size` per statement. Returns the number deleted."""
+    deleted = 0
+    while True:
+        pks = list(IdempotencyKey.objects.filter(expires_at__lte=timezone.now()).values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return deleted
+        deleted += IdempotencyKey.objects.filter(pk__in=pks).delete()[0]
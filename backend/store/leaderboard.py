@@ -0,0 +1,70 @@
+import datetime
+from collections import defaultdict
+
+from django.db.models import Sum
+from django.utils import timezone
+
+from .counters import add_to_counters
+from .models import Product, ProductSalesBucket
+
+# Best-seller counters. Every sold line adds its quantity to four scopes
+# (any shop / its shop x any category / its category), both in today's bucket
+# and in the ALL_TIME_DAY bucket. The all-time top-N is then one index range
+# scan; a windowed top-N sums at most `window` daily buckets of one scope.
+ALL_TIME_DAY = datetime.date(1, 1, 1)
+
+WINDOWS = {
+    '1d': 1,
+    '7d': 7,
+    '30d': 30,
+    'all': None,
+}
+DEFAULT_WINDOW = 'all'
+
+
+def record_sales(lines, at=None):
+    """
+    Count sold units. `lines` is an iterable of
+    (product_id, shop_id, category_id, quantity); call it inside the
+    transaction that writes the order items.
+    """
+    day = timezone.localdate(at or timezone.now())
+    increments = defaultdict(int)
+    for product_id, shop_id, category_id, quantity in lines:
+        for scope_shop in {0, shop_id or 0}:
+            for scope_category in {0, category_id or 0}:
+                for bucket in (day, ALL_TIME_DAY):
+                    increments[(bucket, scope_shop, scope_category, product_id)] += quantity
+    add_to_counters(ProductSalesBucket, ('day', 'shop_id', 'category_id', 'product_id'), 'quantity', increments)
+
+
+def top_products(limit=5, shop_id=0, category_id=0, window=DEFAULT_WINDOW):
+    """
+    The `limit` best-selling products as cards, best first, each with a
+    `total_quantity_sold` attribute.
+    """
+    buckets = ProductSalesBucket.objects.filter(shop_id=shop_id or 0, category_id=category_id or 0)
+    days = WINDOWS[window]
+    if days is None:
+        ranking = buckets.filter(day=ALL_TIME_DAY).order_by('-quantity', 'product_id').values_list(
+            'product_id', 'quantity'
+        )[:limit]
+    else:
+        since = timezone.localdate() - datetime.timedelta(days=days - 1)
+        ranking = (
+            buckets.filter(day__gte=since)
+            .values('product_id')
+            .annotate(total=Sum('quantity'))
+            .order_by('-total', 'product_id')
+            .values_list('product_id', 'total')[:limit]
+        )
+    ranking = list(ranking)
+
+    products = Product.objects.for_cards().in_bulk([product_id for product_id, _ in ranking])
+    best_selling = []
+    for product_id, quantity in ranking:
+        product = products.get(product_id)
+        if product is not None:
+            product.total_quantity_sold = quantity
+            best_selling.append(product)
+    return best_selling
@@ -0,0 +1,133 @@
+from datetime import timedelta
+from functools import reduce
+from operator import or_
+
+from django.db import transaction
+from django.db.models import Max, OuterRef, Q, Subquery, Sum
+from django.utils import timezone
+
+from .models import CommandCheckpoint, StockMovement, StockSnapshot
+
+# Stock ledger: every change to a SKU's stock is added as a StockMovement row
+# (sales, restocks, returns, admin adjustments, checkout holds), next to the
+# stock columns it explains. `manage.py compact_stock_ledger` sums the new
+# movements into StockSnapshot rows, so the stock of a SKU at any time is its
+# last snapshot before that time plus the few movements after it, two index
+# range scans whatever the length of the history.
+#
+# SKUs are (product_color_image_id, product_color_size_id), as in store/stock.py.
+CHECKPOINT = 'compact_stock_ledger'
+
+# Movements younger than this are left for the next compaction: a transaction
+# still running may commit a movement with a lower id.
+SETTLE_TIME = timedelta(minutes=1)
+
+
+def record(changes, reason, at=None):
+    """Add one movement per SKU of {sku: change} (zero changes are skipped), in one INSERT."""
+    at = at or timezone.now()
+    StockMovement.objects.bulk_create([
+        StockMovement(
+            product_color_image_id=image_id, product_color_size_id=size_row_id,
+            change=change, reason=reason, created_at=at,
+        )
+        for (image_id, size_row_id), change in changes.items() if change
+    ])
+
+
+def _sku_filter(skus):
+    return reduce(or_, (
+        Q(product_color_size_id=size_row_id) if size_row_id
+        else Q(product_color_image_id=image_id, product_color_size__isnull=True)
+        for image_id, size_row_id in skus
+    ))
+
+
+def _sku(row):
+    return (row.product_color_image_id, row.product_color_size_id)
+
+
+def latest_snapshots(skus, at=None):
+    """{sku: its last StockSnapshot, or the last one taken at or before `at`}, two queries at most."""
+    taken = Q() if at is None else Q(taken_at__lte=at)
+    sized = {size_row_id for _, size_row_id in skus if size_row_id}
+    unsized = {image_id for image_id, size_row_id in skus if not size_row_id}
+    snapshots = {}
+    if sized:
+        latest = StockSnapshot.objects.filter(
+            taken, product_color_size=OuterRef('product_color_size'),
+        ).order_by('-last_movement_id').values('pk')[:1]
+        for snapshot in StockSnapshot.objects.filter(product_color_size__in=sized, pk=Subquery(latest)):
+            snapshots[_sku(snapshot)] = snapshot
+    if unsized:
+        latest = StockSnapshot.objects.filter(
+            taken, product_color_image=OuterRef('product_color_image'), product_color_size__isnull=True,
+        ).order_by('-last_movement_id').values('pk')[:1]
+        for snapshot in StockSnapshot.objects.filter(
+            product_color_image__in=unsized, product_color_size__isnull=True, pk=Subquery(latest),
+        ):
+            snapshots[_sku(snapshot)] = snapshot
+    return snapshots
+
+
+def ledger_stock(skus, at=None):
+    """
+    {sku: stock according to the ledger at `at` (default: now)}: the last
+    snapshot before it plus the movements since, in at most three queries
+    whatever the number of SKUs.
+    """
+    skus = list(skus)
+    if not skus:
+        return {}
+    at = at or timezone.now()
+    snapshots = latest_snapshots(skus, at)
+    tail = reduce(or_, (
+        _sku_filter([sku]) & Q(pk__gt=snapshots[sku].last_movement_id) if sku in snapshots else _sku_filter([sku])
+        for sku in skus
+    ))
+    changes = {
+        (image_id, size_row_id): total for image_id, size_row_id, total in
+        StockMovement.objects.filter(tail, created_at__lte=at).order_by()
+        .values_list('product_color_image_id', 'product_color_size_id').annotate(total=Sum('change'))
+    }
+    return {
+        sku: (snapshots[sku].stock if sku in snapshots else 0) + changes.get(sku, 0)
+        for sku in skus
+    }
+
+
+def compact(batch_size=5000, rebuild=False, now=None):
+    """
+    Sum the movements added since the last run into one new snapshot per SKU,
+    `batch_size` movements per transaction; `rebuild` drops the snapshots and
+    starts again from the first movement. Returns the number of snapshots.
+    """
+    settled = (now or timezone.now()) - SETTLE_TIME
+    if rebuild:
+        with transaction.atomic():
+            StockSnapshot.objects.all().delete()
+            CommandCheckpoint.objects.filter(name=CHECKPOINT).delete()
+    checkpoint, _ = CommandCheckpoint.objects.get_or_create(name=CHECKPOINT)
+    upto = StockMovement.objects.filter(created_at__lte=settled).aggregate(last=Max('pk'))['last'] or 0
+    taken = 0
+    while checkpoint.position < upto:
+        end = min(checkpoint.position + batch_size, upto)
+        with transaction.atomic():
+            rows = StockMovement.objects.filter(pk__gt=checkpoint.position, pk__lte=end).order_by().values_list(
+                'product_color_image_id', 'product_color_size_id',
+            ).annotate(total=Sum('change'), last=Max('pk'), last_at=Max('created_at'))
+            rows = {(image_id, size_row_id): (total, last, last_at) for image_id, size_row_id, total, last, last_at in rows}
+            # The previous snapshot of each SKU covers everything before this range
+            previous = latest_snapshots(rows)
+            StockSnapshot.objects.bulk_create([
+                StockSnapshot(
+                    product_color_image_id=image_id, product_color_size_id=size_row_id,
+                    stock=(previous[image_id, size_row_id].stock if (image_id, size_row_id) in previous else 0) + total,
+                    last_movement_id=last, taken_at=last_at,
+                )
+                for (image_id, size_row_id), (total, last, last_at) in rows.items()
+            ])
+            checkpoint.position = end
+            checkpoint.save(update_fields=['position', 'updated_at'])
+        taken += len(rows)
+    return taken
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from store.models import ProductPopularity
+from store.popularity import WINDOWS, compact_window
+
+
+class Command(BaseCommand):
+    help = "Rebase the popularity scores on the current time and prune faded-out products. Run daily."
+
+    def handle(self, *args, **options):
+        for window in WINDOWS:
+            compact_window(window)
+            remaining = ProductPopularity.objects.filter(window=window).count()
+            self.stdout.write(f"{window}: {remaining} ranking rows")
+        self.stdout.write(self.style.SUCCESS("Popularity compacted."))
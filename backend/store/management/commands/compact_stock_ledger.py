@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from store.ledger import compact
+
+
+class Command(BaseCommand):
+    help = (
+        "Sum the stock movements added since the last run into snapshots, so stock reads only scan a short "
+        "tail of movements. Run hourly."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help="Movements handled per transaction.")
+        parser.add_argument('--rebuild', action='store_true', help="Drop the snapshots and start from the first movement.")
+
+    def handle(self, *args, **options):
+        snapshots = compact(batch_size=options['batch_size'], rebuild=options['rebuild'])
+        self.stdout.write(self.style.SUCCESS(f"{snapshots} stock snapshots taken."))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from store.cart_store import get_cart_store
+
+
+class Command(BaseCommand):
+    help = (
+        "Write the carts changed since the last run to the Cart/CartItem tables. "
+        "Must be scheduled every few minutes with CacheCartStore."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        written = get_cart_store().persist_pending(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"{written} carts persisted."))
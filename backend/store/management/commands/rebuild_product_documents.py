@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from store.documents import refresh_product_documents
+from store.models import Product
+
+
+class Command(BaseCommand):
+    help = "Rebuild the precomputed product documents in chunks."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help="Products rebuilt per batch.")
+        parser.add_argument('--start-after', type=int, default=0, help="Resume after this product id.")
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        last_id = options['start_after']
+        total = 0
+
+        while True:
+            product_ids = list(
+                Product.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:chunk_size]
+            )
+            if not product_ids:
+                break
+            refresh_product_documents(product_ids)
+            total += len(product_ids)
+            last_id = product_ids[-1]
+            self.stdout.write(f"Rebuilt {total} documents (last product id {last_id})")
+
+        self.stdout.write(self.style.SUCCESS(f"Done, {total} product documents rebuilt."))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from store.facets import refresh_product_facets
+from store.models import Product
+from store.response_cache import bump_cache_tags
+
+
+class Command(BaseCommand):
+    help = "Rebuild the product facet index in chunks."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help="Products rebuilt per batch.")
+        parser.add_argument('--start-after', type=int, default=0, help="Resume after this product id.")
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        last_id = options['start_after']
+        total = 0
+
+        while True:
+            product_ids = list(
+                Product.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:chunk_size]
+            )
+            if not product_ids:
+                break
+            refresh_product_facets(product_ids)
+            total += len(product_ids)
+            last_id = product_ids[-1]
+            self.stdout.write(f"Indexed facets of {total} products (last product id {last_id})")
+
+        # Cached listings carry facet counts from the old rows.
+        bump_cache_tags('products')
+        self.stdout.write(self.style.SUCCESS(f"Done, facets of {total} products rebuilt."))
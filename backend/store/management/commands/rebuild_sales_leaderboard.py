@@ -0,0 +1,39 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from store.leaderboard import record_sales
+from store.models import OrderItem, ProductSalesBucket
+
+
+class Command(BaseCommand):
+    help = "Recompute the best-seller counters from the order history."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help="Order items replayed per batch.")
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        with transaction.atomic():
+            ProductSalesBucket.objects.all().delete()
+            last_id = 0
+            total = 0
+            while True:
+                items = list(
+                    OrderItem.objects.filter(pk__gt=last_id).order_by('pk').values_list(
+                        'pk', 'product_id', 'order__shop_id', 'product__category_id', 'quantity', 'order__order_date'
+                    )[:chunk_size]
+                )
+                if not items:
+                    break
+                by_date = defaultdict(list)
+                for _, product_id, shop_id, category_id, quantity, order_date in items:
+                    by_date[order_date].append((product_id, shop_id, category_id, quantity))
+                for order_date, lines in by_date.items():
+                    record_sales(lines, at=order_date)
+                total += len(items)
+                last_id = items[-1][0]
+                self.stdout.write(f"Replayed {total} order items")
+
+        self.stdout.write(self.style.SUCCESS(f"Done, {total} order items replayed."))
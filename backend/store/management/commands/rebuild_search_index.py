@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from store.models import Product
+from store.response_cache import bump_cache_tags
+from store.search import SHADOW_TABLE, finish_rebuild, get_backend, index_products, start_rebuild
+
+
+class Command(BaseCommand):
+    help = "Rebuild the product full-text search index in a shadow table, filled in chunks, and swap it in."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help="Products indexed per batch.")
+
+    def handle(self, *args, **options):
+        backend = get_backend()
+        if backend is None:
+            self.stderr.write(f"No full-text search backend for '{connection.vendor}'.")
+            return
+
+        start_rebuild(backend)
+
+        chunk_size = options['chunk_size']
+        last_id = 0
+        total = 0
+        while True:
+            product_ids = list(
+                Product.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:chunk_size]
+            )
+            if not product_ids:
+                break
+            index_products(product_ids, SHADOW_TABLE)
+            total += len(product_ids)
+            last_id = product_ids[-1]
+
+        finish_rebuild(backend)
+        # Cached search responses were built from the old table.
+        bump_cache_tags('products')
+        self.stdout.write(self.style.SUCCESS(f"Indexed {total} products."))
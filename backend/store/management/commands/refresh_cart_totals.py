@@ -0,0 +1,59 @@
+from decimal import Decimal
+from itertools import islice
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+
+from store.models import Cart, CartItem, CommandCheckpoint
+from store.pricing import CENT, PRICE_FIELD, with_line_totals
+
+CHECKPOINT = 'refresh_cart_totals'
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the stored cart totals from the current prices, in chunks. "
+        "Resumes after the last chunk done when interrupted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help="Carts handled per transaction.")
+        parser.add_argument('--restart', action='store_true', help="Ignore the checkpoint and start from the first cart.")
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        checkpoint, _ = CommandCheckpoint.objects.get_or_create(name=CHECKPOINT)
+        if options['restart']:
+            checkpoint.position = 0
+        if checkpoint.position:
+            self.stdout.write(f"Resuming after cart {checkpoint.position}")
+
+        cart_ids = (
+            Cart.objects.filter(pk__gt=checkpoint.position).order_by('pk')
+            .values_list('pk', flat=True).iterator(chunk_size=chunk_size)
+        )
+        carts = 0
+        while chunk := list(islice(cart_ids, chunk_size)):
+            with transaction.atomic():
+                self.refresh_totals(chunk)
+                checkpoint.position = chunk[-1]
+                checkpoint.save(update_fields=['position', 'updated_at'])
+            carts += len(chunk)
+            self.stdout.write(f"Recomputed {carts} carts (last cart id {chunk[-1]})")
+
+        # A finished run leaves no checkpoint behind, the next one starts over
+        checkpoint.delete()
+        self.stdout.write(self.style.SUCCESS(f"Done, totals of {carts} carts recomputed."))
+
+    def refresh_totals(self, cart_ids):
+        totals = dict(
+            with_line_totals(CartItem.objects.filter(cart_id__in=cart_ids))
+            .values('cart_id')
+            .annotate(total=Sum('line_total', output_field=PRICE_FIELD))
+            .values_list('cart_id', 'total')
+        )
+        carts = list(Cart.objects.filter(pk__in=cart_ids).only('pk', 'total_price'))
+        for cart in carts:
+            cart.total_price = Decimal(totals.get(cart.pk) or 0).quantize(CENT)
+        Cart.objects.bulk_update(carts, ['total_price'])
@@ -0,0 +1,12 @@
+from .pricing import price_memo
+
+
+class PriceMemoMiddleware:
+    """Memoize effective prices for the duration of each request (store/pricing.py)."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with price_memo():
+            return self.get_response(request)
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.7 on 2026-10-18 17:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0043_aboutpagecontent_image'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['price', 'id'], name='store_produ_price_aba1d8_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['rating', 'id'], name='store_produ_rating_f3c648_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-18 17:59
+
+import django.db.models.deletion
+import rest_framework.utils.encoders
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0044_product_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductDocument',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='document', serialize=False, to='store.product')),
+                ('data', models.JSONField(encoder=rest_framework.utils.encoders.JSONEncoder)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
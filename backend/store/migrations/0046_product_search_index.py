@@ -0,0 +1,36 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    from store.search import get_backend
+
+    backend = get_backend(schema_editor.connection.vendor)
+    if backend is None:
+        return
+    Product = apps.get_model('store', 'Product')
+    with schema_editor.connection.cursor() as cursor:
+        backend.create_index(cursor)
+        rows = list(Product.objects.values_list('pk', 'name', 'description'))
+        if rows:
+            backend.index_products(cursor, rows)
+
+
+def drop_search_index(apps, schema_editor):
+    from store.search import get_backend
+
+    backend = get_backend(schema_editor.connection.vendor)
+    if backend is None:
+        return
+    with schema_editor.connection.cursor() as cursor:
+        backend.drop_index(cursor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0045_productdocument'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.2.7 on 2026-10-18 18:06
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def fill_facets(apps, schema_editor):
+    from store.facets import price_bucket
+
+    Product = apps.get_model('store', 'Product')
+    ProductColorImage = apps.get_model('store', 'ProductColorImage')
+    ProductColorSize = apps.get_model('store', 'ProductColorSize')
+    ProductFacet = apps.get_model('store', 'ProductFacet')
+
+    rows = {}
+    products = Product.objects.values_list(
+        'pk', 'price', 'category_id', 'category__name', 'brand_id', 'brand__name',
+        'device_model_id', 'device_model__name',
+    )
+    for pk, price, *related in products.iterator():
+        for name, (value, label) in zip(('category', 'brand', 'device_model'), zip(related[::2], related[1::2])):
+            if value is not None:
+                rows[(pk, name, value)] = label
+        lower, label = price_bucket(price)
+        rows[(pk, 'price', lower)] = label
+    for pk, value, label in ProductColorImage.objects.values_list('product_id', 'color_id', 'color__color_name').iterator():
+        rows[(pk, 'color', value)] = label
+    sizes = ProductColorSize.objects.values_list('product_color_image__product_id', 'size_id', 'size__name')
+    for pk, value, label in sizes.iterator():
+        rows[(pk, 'size', value)] = label
+
+    ProductFacet.objects.bulk_create(
+        [ProductFacet(product_id=pk, name=name, value=value, label=label) for (pk, name, value), label in rows.items()],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0046_product_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductFacet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=20)),
+                ('value', models.IntegerField()),
+                ('label', models.CharField(blank=True, max_length=255)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='facets', to='store.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['name', 'value'], name='store_produ_name_2e6c7b_idx')],
+                'constraints': [models.UniqueConstraint(fields=('product', 'name', 'value'), name='unique_product_facet')],
+            },
+        ),
+        migrations.RunPython(fill_facets, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.7 on 2026-10-18 18:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0047_productfacet'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PopularityEpoch',
+            fields=[
+                ('window', models.CharField(max_length=10, primary_key=True, serialize=False)),
+                ('epoch', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ProductPopularity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('window', models.CharField(max_length=10)),
+                ('scope', models.CharField(max_length=10)),
+                ('scope_id', models.IntegerField(default=0)),
+                ('score', models.FloatField(default=0)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='popularity_scores', to='store.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['window', 'scope', 'scope_id', '-score', '-product'], name='store_produ_window_9aac97_idx')],
+                'constraints': [models.UniqueConstraint(fields=('window', 'scope', 'scope_id', 'product'), name='unique_product_popularity')],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.7 on 2026-10-18 18:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0048_product_popularity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSalesBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('shop_id', models.IntegerField(default=0)),
+                ('category_id', models.IntegerField(default=0)),
+                ('quantity', models.PositiveIntegerField(default=0)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sales_buckets', to='store.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['shop_id', 'category_id', 'day', '-quantity'], name='store_produ_shop_id_ecb72f_idx')],
+                'constraints': [models.UniqueConstraint(fields=('day', 'shop_id', 'category_id', 'product'), name='unique_product_sales_bucket')],
+            },
+        ),
+    ]
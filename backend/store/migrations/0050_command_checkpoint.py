@@ -0,0 +1,21 @@
+# Generated by Django 5.2.7 on 2026-10-18 18:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0049_product_sales_bucket'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommandCheckpoint',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('position', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.7 on 2026-10-18 18:31
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_lines(apps, schema_editor):
+    """Fold every group of duplicate cart lines into its oldest line before the constraints go in."""
+    CartItem = apps.get_model('store', 'CartItem')
+    line = ('cart_id', 'product_id', 'color_id', 'size_id')
+    groups = list(
+        CartItem.objects.values(*line)
+        .annotate(keep=Min('pk'), total=Sum('quantity'), lines=Count('pk'))
+        .filter(lines__gt=1)
+        .values_list('cart_id', 'keep', 'total')
+    )
+    if not groups:
+        return
+    kept = CartItem.objects.in_bulk([keep for _, keep, _ in groups])
+    for _, keep, total in groups:
+        kept[keep].quantity = total
+    CartItem.objects.bulk_update(kept.values(), ['quantity'], batch_size=1000)
+
+    cart_ids = {cart_id for cart_id, _, _ in groups}
+    first_lines = CartItem.objects.filter(cart_id__in=cart_ids).values(*line).annotate(first=Min('pk')).values('first')
+    CartItem.objects.filter(cart_id__in=cart_ids).exclude(pk__in=first_lines).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0050_command_checkpoint'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_lines, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(condition=models.Q(('size__isnull', False)), fields=('cart', 'product', 'color', 'size'), name='unique_cart_line'),
+        ),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(condition=models.Q(('size__isnull', True)), fields=('cart', 'product', 'color'), name='unique_cart_line_without_size'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.7 on 2026-10-18 18:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0051_cartitem_unique_line'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockReservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_reservations', to='store.customerprofile')),
+                ('product_color_image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='store.productcolorimage')),
+                ('product_color_size', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='store.productcolorsize')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(condition=models.Q(('product_color_size__isnull', False)), fields=('customer', 'product_color_image', 'product_color_size'), name='unique_sized_reservation'), models.UniqueConstraint(condition=models.Q(('product_color_size__isnull', True)), fields=('customer', 'product_color_image'), name='unique_reservation')],
+            },
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.7 on 2026-10-18 18:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0053_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='productcolorimage',
+            constraint=models.CheckConstraint(condition=models.Q(('stock__gte', 0)), name='color_image_stock_not_negative'),
+        ),
+        migrations.AddConstraint(
+            model_name='productcolorsize',
+            constraint=models.CheckConstraint(condition=models.Q(('stock__gte', 0)), name='color_size_stock_not_negative'),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 5.2.7 on 2026-10-18 18:56
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def record_opening_stock(apps, schema_editor):
+    """One movement per SKU for the stock it holds before the ledger starts."""
+    ProductColorImage = apps.get_model('store', 'ProductColorImage')
+    ProductColorSize = apps.get_model('store', 'ProductColorSize')
+    StockMovement = apps.get_model('store', 'StockMovement')
+    now = django.utils.timezone.now()
+    sized = ProductColorSize.objects.filter(stock__gt=0).values_list('product_color_image_id', 'pk', 'stock')
+    unsized = ProductColorImage.objects.filter(stock__gt=0, sizes__isnull=True).values_list('pk', 'stock')
+    StockMovement.objects.bulk_create([
+        StockMovement(product_color_image_id=image_id, product_color_size_id=size_row_id, change=stock,
+                      reason='adjustment', created_at=now)
+        for image_id, size_row_id, stock in sized.iterator()
+    ] + [
+        StockMovement(product_color_image_id=image_id, change=stock, reason='adjustment', created_at=now)
+        for image_id, stock in unsized.iterator()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0054_stock_not_negative'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('change', models.IntegerField()),
+                ('reason', models.CharField(choices=[('sale', 'Sale'), ('restock', 'Restock'), ('return', 'Return'), ('adjustment', 'Adjustment'), ('hold', 'Checkout hold'), ('release', 'Hold released')], max_length=20)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('product_color_image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_movements', to='store.productcolorimage')),
+                ('product_color_size', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='stock_movements', to='store.productcolorsize')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['product_color_size', 'created_at'], name='movement_size_time'), models.Index(fields=['product_color_image', 'created_at'], name='movement_image_time')],
+            },
+        ),
+        migrations.CreateModel(
+            name='StockSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stock', models.IntegerField()),
+                ('last_movement_id', models.BigIntegerField()),
+                ('taken_at', models.DateTimeField()),
+                ('product_color_image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_snapshots', to='store.productcolorimage')),
+                ('product_color_size', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='stock_snapshots', to='store.productcolorsize')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['product_color_size', 'taken_at'], name='snapshot_size_time'), models.Index(fields=['product_color_image', 'taken_at'], name='snapshot_image_time')],
+            },
+        ),
+        migrations.RunPython(record_opening_stock, migrations.RunPython.noop),
+    ]
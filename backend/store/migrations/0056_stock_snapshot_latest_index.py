@@ -0,0 +1,29 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0055_stock_ledger'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='stocksnapshot',
+            name='snapshot_size_time',
+        ),
+        migrations.RemoveIndex(
+            model_name='stocksnapshot',
+            name='snapshot_image_time',
+        ),
+        migrations.AddIndex(
+            model_name='stocksnapshot',
+            index=models.Index(fields=['product_color_size', '-last_movement_id'], name='snapshot_size_latest'),
+        ),
+        migrations.AddIndex(
+            model_name='stocksnapshot',
+            index=models.Index(fields=['product_color_image', '-last_movement_id'], name='snapshot_image_latest'),
+        ),
+    ]
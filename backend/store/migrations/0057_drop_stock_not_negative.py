@@ -0,0 +1,21 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:30
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0056_stock_snapshot_latest_index'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='productcolorimage',
+            name='color_image_stock_not_negative',
+        ),
+        migrations.RemoveConstraint(
+            model_name='productcolorsize',
+            name='color_size_stock_not_negative',
+        ),
+    ]
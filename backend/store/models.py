@@ -1,9 +1,11 @@
 # products/models.py
 
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User, Group
+from django.utils import timezone
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from rest_framework.utils.encoders import JSONEncoder
 
 class Shop(models.Model):
     name = models.CharField(max_length=255, unique=True)
@@ -75,6 +77,49 @@ class Size(models.Model):
 
     def __str__(self):
         return self.name
+
+class ProductQuerySet(models.QuerySet):
+    def with_details(self):
+        """
+        Load everything ProductSerializer touches in a fixed number of queries,
+        no matter how many products are in the page.
+        """
+        return self.select_related('category', 'brand', 'device_model').prefetch_related(
+            models.Prefetch(
+                'color_images',
+                queryset=ProductColorImage.objects.select_related('color').order_by('id'),
+            ),
+            models.Prefetch(
+                'color_images__sizes',
+                queryset=ProductColorSize.objects.select_related('size'),
+            ),
+            'reviews__liked_by',
+            'reviews__replies',
+        ).with_prices()
+
+    def with_prices(self, shop_id=None):
+        """
+        Annotate the effective price, discount, final price and stock, with
+        the ShopInventory overrides of `shop_id` (default: the listing shop).
+        """
+        from .pricing import price_annotations
+
+        relations, prices = price_annotations(shop_id)
+        return self.annotate(**relations).annotate(**prices)
+
+    def for_cards(self):
+        """
+        Just the columns ProductCardSerializer needs, plus the color images
+        used to pick a thumbnail, and the rating the list can be ordered by
+        (the pagination cursor reads it from the last card).
+        """
+        return self.only('id', 'name', 'price', 'discount', 'stock', 'rating', 'image1').prefetch_related(
+            models.Prefetch(
+                'color_images',
+                queryset=ProductColorImage.objects.only('id', 'product_id', 'image').order_by('id'),
+            ),
+        ).with_prices()
+
 class Product(models.Model):
     name = models.CharField(max_length=255)
     description = models.TextField()
@@ -94,6 +139,15 @@ class Product(models.Model):
     # 👇 Add this field
     created_by_shop = models.ForeignKey('Shop', on_delete=models.SET_NULL, null=True, blank=True, related_name='created_products')
 
+    objects = ProductQuerySet.as_manager()
+
+    class Meta:
+        # Keyset pagination orders by (key, id); see store/pagination.py
+        indexes = [
+            models.Index(fields=['price', 'id']),
+            models.Index(fields=['rating', 'id']),
+        ]
+
     def __str__(self):
         return self.name
 
@@ -117,7 +171,7 @@ class ProductColorImage(models.Model):
     def update_stock(self):
         total = sum(size.stock for size in self.sizes.all())
         self.stock = total
-        self.save()
+        self.save(update_fields=['stock'])
 class ProductColorSize(models.Model):
     product_color_image = models.ForeignKey(
         ProductColorImage,
@@ -133,6 +187,109 @@ class ProductColorSize(models.Model):
     def __str__(self):
         return f"{self.product_color_image.product.name} - {self.product_color_image.color.color_name} - {self.size.name} (Stock: {self.stock})"
 
+    def save(self, *args, **kwargs):
+        # Admin edits go to the stock ledger (store/ledger.py) as the change from
+        # the stored row, re-read under a lock: the value loaded with the form may
+        # be stale if a sale ran since, and the ledger would count it twice.
+        update_fields = kwargs.get('update_fields')
+        with transaction.atomic():
+            self._stock_before = None
+            if not self._state.adding and (update_fields is None or 'stock' in update_fields):
+                self._stock_before = (
+                    ProductColorSize.objects.select_for_update()
+                    .filter(pk=self.pk).values_list('stock', flat=True).first()
+                )
+            super().save(*args, **kwargs)
+
+class ProductDocument(models.Model):
+    """
+    Ready-to-serve ProductSerializer output for one product.
+    Kept current from model signals, see store/documents.py.
+    """
+    product = models.OneToOneField(Product, primary_key=True, on_delete=models.CASCADE, related_name='document')
+    data = models.JSONField(encoder=JSONEncoder)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Document for product {self.product_id}"
+
+class ProductFacet(models.Model):
+    """
+    One (facet, value) pair a product can be filtered by: its category,
+    brand, device model, each color and size it comes in, and its price
+    bucket. Facet counts are a single GROUP BY over this table, see
+    store/facets.py.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='facets')
+    name = models.CharField(max_length=20)
+    value = models.IntegerField()  # related object id, or the price bucket's lower bound
+    label = models.CharField(max_length=255, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'name', 'value'], name='unique_product_facet'),
+        ]
+        indexes = [
+            models.Index(fields=['name', 'value']),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} {self.name}={self.value}"
+
+class PopularityEpoch(models.Model):
+    """
+    Reference time of a popularity window. Scores in that window are stored
+    as exp((t - epoch) / window) sums, see store/popularity.py.
+    """
+    window = models.CharField(max_length=10, primary_key=True)
+    epoch = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.window} since {self.epoch}"
+
+class ProductPopularity(models.Model):
+    """Time-decayed units sold of a product, per window and scope (global, shop or category)."""
+    window = models.CharField(max_length=10)
+    scope = models.CharField(max_length=10)
+    scope_id = models.IntegerField(default=0)  # shop or category id, 0 for the global ranking
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='popularity_scores')
+    score = models.FloatField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['window', 'scope', 'scope_id', 'product'], name='unique_product_popularity'),
+        ]
+        indexes = [
+            # One index range scan per ranking page
+            models.Index(fields=['window', 'scope', 'scope_id', '-score', '-product']),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} {self.window}/{self.scope}:{self.scope_id} = {self.score:.2f}"
+
+class ProductSalesBucket(models.Model):
+    """
+    Units sold of a product on one day, within one shop and category
+    (0 = any). Rows dated ALL_TIME_DAY hold the running totals.
+    Maintained by store/leaderboard.py at checkout.
+    """
+    day = models.DateField()
+    shop_id = models.IntegerField(default=0)
+    category_id = models.IntegerField(default=0)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='sales_buckets')
+    quantity = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'shop_id', 'category_id', 'product'], name='unique_product_sales_bucket'),
+        ]
+        indexes = [
+            models.Index(fields=['shop_id', 'category_id', 'day', '-quantity']),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} on {self.day}: {self.quantity}"
+
 class ShopInventory(models.Model):
     shop = models.ForeignKey('Shop', on_delete=models.CASCADE, related_name='inventories')
     product = models.ForeignKey('Product', on_delete=models.CASCADE, related_name='inventories')
@@ -223,6 +380,17 @@ class Reply(models.Model):
 from django.db import models
 
 
+def color_names(lines):
+    """Comma-joined color names of order or cart lines."""
+    from .reference_data import reference_data
+    return ", ".join(reference_data.color(line.color_id).name for line in lines)
+
+
+def size_names(lines):
+    from .reference_data import reference_data
+    return ", ".join(reference_data.size(line.size_id).name for line in lines if line.size_id)
+
+
 class Order(models.Model):
     # Defining choices for the order status field
     class Status(models.TextChoices):
@@ -246,13 +414,15 @@ class Order(models.Model):
     def __str__(self):
         return f"Order {self.id} by {self.customer.user.username}"
 
+    # Color and size names come from the in-process reference data, so with
+    # order_items prefetched these run no query.
     def get_order_colors(self):
-        return ", ".join([item.color.color_name for item in self.order_items.all()])
+        return color_names(self.order_items.all())
     get_order_colors.short_description = 'Order Colors'
 
     def get_order_sizes(self):
-        # FIX: Ensure this method also handles `None` size values.
-        return ", ".join([item.size.name for item in self.order_items.all() if item.size])
+        # Lines without a size are skipped.
+        return size_names(self.order_items.all())
     get_order_sizes.short_description = 'Sizes'
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, related_name='order_items', on_delete=models.CASCADE)
@@ -278,23 +448,27 @@ class Cart(models.Model):
     brand = models.ForeignKey(Brand, related_name='carts', on_delete=models.SET_NULL, null=True, blank=True)
     total_price = models.DecimalField(max_digits=20, decimal_places=2)
     cart_date = models.DateTimeField(auto_now_add=True)  # Renamed to cart_date to reflect the cart creation time
-    product_description = models.TextField(blank=True, null=True)  # Store product description in the cart
-
-    def save(self, *args, **kwargs):
-        # Only save the cart items description after the cart is created and saved
-        if self.pk is not None:  # Make sure the object has been saved and has a primary key
-            if self.cart_items.exists():
-                self.product_description = ", ".join([str(item.product.name) for item in self.cart_items.all()])
-        super(Cart, self).save(*args, **kwargs)
+    product_description = models.TextField(blank=True, null=True)  # Legacy, see get_product_description
 
     def __str__(self):
         return f"Cart {self.id} by {self.customer.user.username}"
 
+    # Built when shown (admin) instead of on every save; prefetch cart_items
+    # with their products to list many carts.
+    def get_product_description(self):
+        return ", ".join(item.product.name for item in self.cart_items.all())
+    get_product_description.short_description = 'Products'
+
     def get_cart_colors(self):
-        return ", ".join([item.color.color_name for item in self.cart_items.all()])
+        return color_names(self.cart_items.all())
 
     get_cart_colors.short_description = 'Cart Colors'
 
+    def get_cart_sizes(self):
+        return size_names(self.cart_items.all())
+
+    get_cart_sizes.short_description = 'Sizes'
+
 class CartItem(models.Model):
     cart = models.ForeignKey(Cart, related_name='cart_items', on_delete=models.CASCADE)
     product = models.ForeignKey(Product, related_name='cart_items', on_delete=models.CASCADE)
@@ -302,11 +476,147 @@ class CartItem(models.Model):
     size = models.ForeignKey('Size', related_name='cart_items', on_delete=models.CASCADE, null=True, blank=True)  # NEW
     quantity = models.PositiveIntegerField(default=1)
 
+    class Meta:
+        # One line per product, color and size; adding more of it increments
+        # the line (store/cart_store.py). NULL sizes never collide in a plain
+        # unique index, hence the second constraint.
+        constraints = [
+            models.UniqueConstraint(
+                fields=['cart', 'product', 'color', 'size'], condition=models.Q(size__isnull=False),
+                name='unique_cart_line',
+            ),
+            models.UniqueConstraint(
+                fields=['cart', 'product', 'color'], condition=models.Q(size__isnull=True),
+                name='unique_cart_line_without_size',
+            ),
+        ]
+
     def __str__(self):
         size_name = f" - {self.size.name}" if self.size else ""
         return f"{self.quantity} x {self.product.name} ({self.color.color_name}{size_name})"
 
 
+class StockReservation(models.Model):
+    """
+    Stock held for a customer between the start of a checkout and
+    submit_cart (store/reservations.py). The quantity is already taken off the
+    stock row; it goes back when the hold expires.
+    """
+    customer = models.ForeignKey(CustomerProfile, related_name='stock_reservations', on_delete=models.CASCADE)
+    product_color_image = models.ForeignKey(ProductColorImage, related_name='reservations', on_delete=models.CASCADE)
+    # Set for sized SKUs, whose stock is kept on the size row
+    product_color_size = models.ForeignKey(
+        ProductColorSize, related_name='reservations', on_delete=models.CASCADE, null=True, blank=True,
+    )
+    quantity = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        # One hold per customer and SKU; holding again replaces it
+        constraints = [
+            models.UniqueConstraint(
+                fields=['customer', 'product_color_image', 'product_color_size'],
+                condition=models.Q(product_color_size__isnull=False), name='unique_sized_reservation',
+            ),
+            models.UniqueConstraint(
+                fields=['customer', 'product_color_image'],
+                condition=models.Q(product_color_size__isnull=True), name='unique_reservation',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} held for {self.customer_id} until {self.expires_at:%Y-%m-%d %H:%M}"
+
+
+class IdempotencyKey(models.Model):
+    """
+    The first successful response to a request sent with an Idempotency-Key
+    header, replayed for the retries of that request (store/idempotency.py).
+    """
+    user = models.ForeignKey(User, related_name='idempotency_keys', on_delete=models.CASCADE)
+    scope = models.CharField(max_length=50)  # the endpoint
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64)
+    # Empty while the first request runs
+    response_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.JSONField(null=True, blank=True, encoder=JSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'scope', 'key'], name='unique_idempotency_key'),
+        ]
+
+    def __str__(self):
+        return f"{self.scope} {self.key}"
+
+
+class StockMovement(models.Model):
+    """
+    One change to a SKU's stock, negative when stock left. Rows are only
+    ever added; see store/ledger.py.
+    """
+    class Reason(models.TextChoices):
+        SALE = 'sale', 'Sale'
+        RESTOCK = 'restock', 'Restock'
+        RETURN = 'return', 'Return'
+        ADJUSTMENT = 'adjustment', 'Adjustment'
+        HOLD = 'hold', 'Checkout hold'
+        RELEASE = 'release', 'Hold released'
+
+    product_color_image = models.ForeignKey(ProductColorImage, related_name='stock_movements', on_delete=models.CASCADE)
+    # Set for sized SKUs, whose stock is kept on the size row
+    product_color_size = models.ForeignKey(
+        ProductColorSize, related_name='stock_movements', on_delete=models.CASCADE, null=True, blank=True,
+    )
+    change = models.IntegerField()
+    reason = models.CharField(max_length=20, choices=Reason.choices)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['product_color_size', 'created_at'], name='movement_size_time'),
+            models.Index(fields=['product_color_image', 'created_at'], name='movement_image_time'),
+        ]
+
+    def __str__(self):
+        return f"{self.change:+d} ({self.reason})"
+
+
+class StockSnapshot(models.Model):
+    """A SKU's stock once every movement up to `last_movement_id` is counted."""
+    product_color_image = models.ForeignKey(ProductColorImage, related_name='stock_snapshots', on_delete=models.CASCADE)
+    product_color_size = models.ForeignKey(
+        ProductColorSize, related_name='stock_snapshots', on_delete=models.CASCADE, null=True, blank=True,
+    )
+    stock = models.IntegerField()
+    last_movement_id = models.BigIntegerField()
+    taken_at = models.DateTimeField()  # created_at of that last movement
+
+    class Meta:
+        # A SKU's latest snapshot is the one with the highest last_movement_id
+        # (store/ledger.py): one backward index scan, no sort
+        indexes = [
+            models.Index(fields=['product_color_size', '-last_movement_id'], name='snapshot_size_latest'),
+            models.Index(fields=['product_color_image', '-last_movement_id'], name='snapshot_image_latest'),
+        ]
+
+    def __str__(self):
+        return f"{self.stock} at {self.taken_at:%Y-%m-%d %H:%M}"
+
+
+class CommandCheckpoint(models.Model):
+    """Last primary key handled by a resumable management command (e.g. refresh_cart_totals)."""
+    name = models.CharField(max_length=50, primary_key=True)
+    position = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} at {self.position}"
+
+
 class Wishlist(models.Model):
     name = models.CharField(max_length=255)
     description = models.TextField()
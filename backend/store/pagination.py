@@ -0,0 +1,213 @@
+import base64
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+def estimate_count(queryset):
+    """
+    Cheap row count for a queryset.
+    On Postgres this reads the planner's row estimate instead of running COUNT(*),
+    other databases fall back to an exact count.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return queryset.count()
+
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination over a fixed, indexed ordering key.
+
+    The cursor stores the ordering values of the last row on the page, and the
+    next page is fetched with a `WHERE (key, id) > (...)` style filter, so deep
+    pages cost the same as the first one. Every ordering ends with the primary
+    key to keep the order total and stable.
+
+    Pagination is opt-in: clients that send neither `page_size` nor `cursor`
+    keep getting the full, unpaginated list.
+    """
+    page_size = None
+    default_page_size = 20
+    max_page_size = 100
+    page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+    ordering_query_param = 'ordering'
+    count_query_param = 'include_count'
+
+    # Allowed ?ordering= values mapped to the order_by() fields they stand for.
+    ordering_fields = {
+        'id': ('id',),
+        '-id': ('-id',),
+    }
+    default_ordering = '-id'
+
+    def get_page_size(self, request):
+        page_size = request.query_params.get(self.page_size_query_param)
+        if page_size is not None:
+            try:
+                page_size = int(page_size)
+            except ValueError:
+                page_size = self.default_page_size
+            return max(1, min(page_size, self.max_page_size))
+        if self.cursor_query_param in request.query_params:
+            return self.default_page_size
+        return self.page_size
+
+    def get_ordering(self, request):
+        ordering = request.query_params.get(self.ordering_query_param, self.default_ordering)
+        return self.ordering_fields.get(ordering, self.ordering_fields[self.default_ordering])
+
+    def encode_cursor(self, values):
+        raw = json.dumps(values, cls=DjangoJSONEncoder).encode('utf-8')
+        return base64.urlsafe_b64encode(raw).decode('ascii')
+
+    def decode_cursor(self, cursor):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound('Invalid cursor')
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise NotFound('Invalid cursor')
+        return values
+
+    def get_keyset_filter(self, values):
+        """
+        Build the lexicographic "after this row" filter:
+        (a > x) OR (a = x AND b > y) OR ...
+        """
+        keyset = Q()
+        equal_so_far = Q()
+        for field, value in zip(self.ordering, values):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            keyset |= equal_so_far & Q(**{f'{name}__{lookup}': value})
+            equal_so_far &= Q(**{name: value})
+        return keyset
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.request = request
+        self.ordering = self.get_ordering(request)
+        self.count = None
+        if request.query_params.get(self.count_query_param) in ('1', 'true', 'True'):
+            self.count = estimate_count(queryset)
+
+        queryset = queryset.order_by(*self.ordering)
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            queryset = queryset.filter(self.get_keyset_filter(self.decode_cursor(cursor)))
+
+        results = list(queryset[:self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        return self.page
+
+    def get_next_cursor(self):
+        if not self.has_next or not self.page:
+            return None
+        last = self.page[-1]
+        return self.encode_cursor([getattr(last, field.lstrip('-')) for field in self.ordering])
+
+    def get_next_link(self):
+        cursor = self.get_next_cursor()
+        if cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.page_size_query_param, self.page_size)
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def get_paginated_data(self, data):
+        paginated = {'next': self.get_next_link(), 'results': data}
+        if self.count is not None:
+            paginated['count'] = self.count
+        return paginated
+
+    def get_paginated_response(self, data):
+        return Response(self.get_paginated_data(data))
+
+
+class ProductKeysetPagination(KeysetPagination):
+    # effective_price is annotated by Product.objects.with_prices(), so price
+    # orderings follow the ShopInventory overrides the cards show.
+    ordering_fields = {
+        'id': ('id',),
+        '-id': ('-id',),
+        'price': ('effective_price', 'id'),
+        '-price': ('-effective_price', '-id'),
+        'rating': ('rating', 'id'),
+        '-rating': ('-rating', '-id'),
+    }
+
+
+class PopularProductPagination(KeysetPagination):
+    # popularity_score is annotated by store.popularity.ranked_products
+    ordering_fields = {
+        'popularity': ('-popularity_score', '-id'),
+    }
+    default_ordering = 'popularity'
+
+
+class SearchPagination(KeysetPagination):
+    # Search results were always paginated, keep a default page size.
+    page_size = 10
+    ordering_fields = {
+        'id': ('id',),
+    }
+    default_ordering = 'id'
+
+    def paginate_search(self, query, queryset, request, within=None):
+        """
+        Page through full-text hits ranked by relevance. The keyset is
+        (search_score, id) as returned by store.search.ranked_product_ids;
+        each returned product gets a `search_score` attribute. `within`
+        restricts the hits to a filtered Product queryset.
+        """
+        from .search import count_matches, ranked_product_ids
+
+        self.page_size = self.get_page_size(request)
+        self.request = request
+        self.ordering = ('search_score', 'id')
+        self.count = None
+        if request.query_params.get(self.count_query_param) in ('1', 'true', 'True'):
+            self.count = count_matches(query, within=within)
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        after = self.decode_cursor(cursor) if cursor else None
+        hits = ranked_product_ids(query, self.page_size + 1, after=after, within=within)
+        self.has_next = len(hits) > self.page_size
+        hits = hits[:self.page_size]
+
+        products = queryset.in_bulk([product_id for product_id, _ in hits])
+        self.page = []
+        for product_id, score in hits:
+            product = products.get(product_id)
+            if product is not None:
+                product.search_score = score
+                self.page.append(product)
+        return self.page
+
+
+class ReviewKeysetPagination(KeysetPagination):
+    # Newest reviews first; id follows creation order.
+    ordering_fields = {
+        '-id': ('-id',),
+        'id': ('id',),
+    }
@@ -0,0 +1,125 @@
+import logging
+import math
+from collections import defaultdict
+from datetime import timedelta
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .counters import add_to_counters
+from .models import PopularityEpoch, Product, ProductPopularity
+
+logger = logging.getLogger(__name__)
+
+# Popularity ranking with exponential time decay.
+#
+# A unit sold at time t counts exp(-(now - t) / window) towards the score, so
+# sales older than a window fade out smoothly. Every row of a window shares
+# the same `now`-independent factor, so the table stores
+#     score = sum(quantity * exp((t - epoch) / window))
+# and ordering by the stored score is ordering by the decayed score: new sales
+# are a plain `score + x` UPDATE and a ranking page is an index range scan.
+#
+# The stored values grow with time since the epoch; `manage.py
+# compact_popularity` (run it daily) rebases them on a fresh epoch and prunes
+# products that have faded out.
+WINDOWS = {
+    '24h': timedelta(hours=24),
+    '7d': timedelta(days=7),
+    '30d': timedelta(days=30),
+}
+DEFAULT_WINDOW = '30d'
+
+GLOBAL, SHOP, CATEGORY = 'global', 'shop', 'category'
+
+# Rows whose decayed score drops below this are removed on compaction.
+PRUNE_BELOW = 0.01
+
+# Past this many window lengths since the epoch (compact_popularity has not
+# run for that long), sales are left out of the window: their weight would
+# lose the older scores' precision.
+MAX_EPOCH_AGE = 50
+
+
+def get_epochs(lock=False):
+    """
+    {window: epoch}. With `lock`, the rows are read with select_for_update,
+    so a compaction cannot rebase them until the transaction ends.
+    """
+    epochs = PopularityEpoch.objects.select_for_update() if lock else PopularityEpoch.objects.all()
+    current = dict(epochs.values_list('window', 'epoch'))
+    missing = [window for window in WINDOWS if window not in current]
+    if missing:
+        now = timezone.now()
+        PopularityEpoch.objects.bulk_create(
+            [PopularityEpoch(window=window, epoch=now) for window in missing], ignore_conflicts=True
+        )
+        current = dict(epochs.values_list('window', 'epoch'))
+    return current
+
+
+def _epoch_age(window, epoch, at):
+    return (at - epoch).total_seconds() / WINDOWS[window].total_seconds()
+
+
+def record_sales(lines, at=None):
+    """
+    Add sold units to every window and scope. `lines` is an iterable of
+    (product_id, shop_id, category_id, quantity). Call it inside the
+    transaction that writes the order items: three queries whatever the
+    size of the order. The epochs stay locked until that transaction ends,
+    so the weights cannot land on scores rebased by a concurrent compaction.
+    """
+    at = at or timezone.now()
+    with transaction.atomic(savepoint=False):
+        epochs = get_epochs(lock=True)
+        windows = [window for window in WINDOWS if _epoch_age(window, epochs[window], at) <= MAX_EPOCH_AGE]
+        for window in WINDOWS.keys() - windows:
+            # Never compacted here: that rewrites the whole window inside a checkout
+            logger.warning("Popularity window %s is over %s windows past its epoch, sales are left out "
+                           "until compact_popularity runs.", window, MAX_EPOCH_AGE)
+
+        increments = defaultdict(float)
+        for product_id, shop_id, category_id, quantity in lines:
+            scopes = [(GLOBAL, 0)]
+            if shop_id:
+                scopes.append((SHOP, shop_id))
+            if category_id:
+                scopes.append((CATEGORY, category_id))
+            for window in windows:
+                weight = quantity * math.exp(_epoch_age(window, epochs[window], at))
+                for scope, scope_id in scopes:
+                    increments[(window, scope, scope_id, product_id)] += weight
+        add_to_counters(ProductPopularity, ('window', 'scope', 'scope_id', 'product_id'), 'score', increments)
+
+
+def compact_window(window, now=None):
+    """
+    Rebase a window on `now`: scale every score by the decay since the old
+    epoch and drop the rows that have faded out. Returns the new epoch.
+    The epoch row is locked first, so this waits for the checkouts that
+    read the old epoch (record_sales) and they wait for it.
+    """
+    now = now or timezone.now()
+    get_epochs()
+    with transaction.atomic():
+        row = PopularityEpoch.objects.select_for_update().get(window=window)
+        factor = math.exp(-_epoch_age(window, row.epoch, now))
+        ProductPopularity.objects.filter(window=window).update(score=F('score') * factor)
+        ProductPopularity.objects.filter(window=window, score__lt=PRUNE_BELOW).delete()
+        row.epoch = now
+        row.save(update_fields=['epoch'])
+    return now
+
+
+def ranked_products(window=DEFAULT_WINDOW, scope=GLOBAL, scope_id=0):
+    """
+    Product cards ranked by decayed popularity, best first; each product has
+    a `popularity_score` attribute. Only products sold within (roughly) the
+    window are listed.
+    """
+    return Product.objects.for_cards().filter(
+        popularity_scores__window=window,
+        popularity_scores__scope=scope,
+        popularity_scores__scope_id=scope_id,
+    ).annotate(popularity_score=F('popularity_scores__score')).order_by('-popularity_score', '-id')
@@ -0,0 +1,177 @@
+from collections import namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+from decimal import Decimal
+
+from django.db.models import DecimalField, F, FilteredRelation, Q, Sum, Value
+from django.db.models.functions import Coalesce, Round
+
+from .models import Cart, CartItem, Product
+
+# Pricing. A unit costs the product's price minus its discount (percent),
+# rounded to the cent like submit_cart does; the ShopInventory row of the
+# shop that lists the product overrides price and discount when set.
+CENT = Decimal('0.01')
+PRICE_FIELD = DecimalField(max_digits=20, decimal_places=2)
+
+EffectivePrice = namedtuple('EffectivePrice', 'price discount final_price stock')
+PRICE_ANNOTATIONS = ('effective_price', 'effective_discount', 'effective_final_price', 'effective_stock')
+
+# {(shop_id, product_id): EffectivePrice} for the current request, see price_memo()
+_memo = ContextVar('effective_prices', default=None)
+
+
+def _discounted(price, discount):
+    return Round(price - price * discount / Value(Decimal('100')), 2, output_field=PRICE_FIELD)
+
+
+@contextmanager
+def price_memo():
+    """
+    Remember the effective_prices() results inside the block. Every request
+    runs in one (PriceMemoMiddleware), so catalog, cart and checkout code can
+    ask for the same prices again for free; nested blocks share the outer memo.
+    """
+    if _memo.get() is not None:
+        yield
+        return
+    token = _memo.set({})
+    try:
+        yield
+    finally:
+        _memo.reset(token)
+
+
+def forget_prices():
+    """Drop the memoized prices (a price or a ShopInventory row changed)."""
+    memo = _memo.get()
+    if memo is not None:
+        memo.clear()
+
+
+def price_annotations(shop_id=None, product_path=''):
+    """
+    Annotations giving the effective price, discount, final price and stock,
+    named as in PRICE_ANNOTATIONS: a LEFT JOIN on the selling shop's
+    ShopInventory row and COALESCE with the product's own columns.
+    `product_path` is the lookup from the queried model to the product, e.g.
+    'product__' for CartItem rows. See ProductQuerySet.with_prices().
+    """
+    shop = F(f'{product_path}created_by_shop_id') if shop_id is None else Value(shop_id)
+    price = Coalesce('inventory__custom_price', f'{product_path}price', output_field=PRICE_FIELD)
+    discount = Coalesce(
+        'inventory__custom_discount', f'{product_path}discount', Value(Decimal('0')), output_field=PRICE_FIELD,
+    )
+    inventory = FilteredRelation(
+        f'{product_path}inventories', condition=Q(**{f'{product_path}inventories__shop_id': shop}),
+    )
+    return (
+        {'inventory': inventory},
+        {
+            'effective_price': price,
+            'effective_discount': discount,
+            'effective_final_price': _discounted(price, discount),
+            'effective_stock': Coalesce('inventory__custom_stock', f'{product_path}stock'),
+        },
+    )
+
+
+def with_line_totals(cart_items):
+    """Annotate CartItem rows with `line_total`: effective unit price x quantity."""
+    relations, prices = price_annotations(product_path='product__')
+    return cart_items.annotate(**relations).annotate(
+        line_total=prices['effective_final_price'] * F('quantity'),
+    )
+
+
+def _price(price, discount, final_price, stock):
+    return EffectivePrice(
+        Decimal(price).quantize(CENT), Decimal(discount).quantize(CENT), Decimal(final_price).quantize(CENT), stock,
+    )
+
+
+def effective_prices(product_ids, shop_id=None):
+    """
+    {product_id: EffectivePrice(price, discount, final_price, stock)} for the
+    products as sold by `shop_id`, or by the shop listing each product when
+    None. ShopInventory overrides win over the product's own values, in one
+    query (LEFT JOIN on ShopInventory, COALESCE) for the products not
+    memoized yet. Products that do not exist are left out.
+    """
+    memo = _memo.get()
+    prices = {}
+    missing = set()
+    for product_id in product_ids:
+        if memo is not None and (shop_id, product_id) in memo:
+            prices[product_id] = memo[shop_id, product_id]
+        else:
+            missing.add(product_id)
+    if not missing:
+        return prices
+
+    rows = Product.objects.filter(pk__in=missing).with_prices(shop_id).values_list('pk', *PRICE_ANNOTATIONS)
+    for product_id, *values in rows:
+        prices[product_id] = _price(*values)
+        if memo is not None:
+            memo[shop_id, product_id] = prices[product_id]
+    return prices
+
+
+def price_of(product, shop_id=None):
+    """
+    EffectivePrice of one product, read from the annotations when it was
+    loaded with Product.objects.with_prices() (for_cards() and
+    with_details() do), else through effective_prices().
+    """
+    if shop_id is None and hasattr(product, 'effective_final_price'):
+        return _price(*(getattr(product, name) for name in PRICE_ANNOTATIONS))
+    return effective_prices([product.pk], shop_id)[product.pk]
+
+
+def unit_prices(product_ids, shop_id=None):
+    """{product_id: unit price} for the given products (see effective_prices)."""
+    return {
+        product_id: price.final_price
+        for product_id, price in effective_prices(product_ids, shop_id).items()
+    }
+
+
+def cart_total(cart_id):
+    """Sum of unit price x quantity over the cart's lines, as one aggregate query."""
+    total = with_line_totals(CartItem.objects.filter(cart_id=cart_id)).aggregate(
+        total=Sum('line_total', output_field=PRICE_FIELD)
+    )['total']
+    return Decimal(total or 0).quantize(CENT)
+
+
+def refresh_cart_total(cart):
+    """Recompute the stored total from scratch (picks up price changes)."""
+    cart.total_price = cart_total(cart.pk)
+    Cart.objects.filter(pk=cart.pk).update(total_price=cart.total_price)
+    return cart.total_price
+
+
+def price_quantities(quantities):
+    """
+    Sum of unit price x quantity for {product_id: quantity}, one price query
+    for just these products. Quantities may be negative: pricing the change
+    of a few lines moves a cart total without rescanning the cart.
+    """
+    prices = unit_prices([product_id for product_id, quantity in quantities.items() if quantity])
+    return sum(
+        (prices.get(product_id, Decimal('0')) * quantity for product_id, quantity in quantities.items()),
+        Decimal('0'),
+    ).quantize(CENT)
+
+
+def adjust_cart_total(cart, quantity_deltas):
+    """
+    Apply the quantity changes {product_id: delta} to the stored total without
+    rescanning the cart: one price lookup and one UPDATE ... SET total + x.
+    """
+    amount = price_quantities(quantity_deltas)
+    if amount:
+        Cart.objects.filter(pk=cart.pk).update(total_price=F('total_price') + amount)
+    cart.total_price = (Decimal(cart.total_price or 0) + amount).quantize(CENT)
+    return cart.total_price
+
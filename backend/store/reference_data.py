@@ -0,0 +1,133 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+
+from django.core.cache import cache
+from django.db import DatabaseError, transaction
+
+from .models import Brand, Category, Color, DeviceModel, Size
+
+logger = logging.getLogger(__name__)
+
+# In-process copy of the small reference tables (colors, sizes, categories,
+# brands, device models), so cart, checkout and order code can turn names
+# into ids and back without a query.
+#
+# Writes to those tables bump a version counter in the cache (store/signals.py).
+# Every process compares it with the version of its copy at most every
+# VERSION_CHECK_INTERVAL seconds, and on any name it does not know, and
+# reloads when it moved.
+VERSION_KEY = 'reference-data:version'
+VERSION_CHECK_INTERVAL = 5
+
+ColorRecord = namedtuple('ColorRecord', 'id name code')
+SizeRecord = namedtuple('SizeRecord', 'id name')
+CategoryRecord = namedtuple('CategoryRecord', 'id name')
+BrandRecord = namedtuple('BrandRecord', 'id name category_id')
+DeviceModelRecord = namedtuple('DeviceModelRecord', 'id name brand_id')
+
+
+class ReferenceData:
+    """One loaded copy of the reference tables; never changes once built."""
+
+    def __init__(self, version):
+        self.version = version
+        self.colors = {pk: ColorRecord(pk, name, code) for pk, name, code in
+                       Color.objects.order_by('pk').values_list('pk', 'color_name', 'color_code')}
+        self.sizes = {pk: SizeRecord(pk, name) for pk, name in Size.objects.values_list('pk', 'name')}
+        self.categories = {pk: CategoryRecord(pk, name) for pk, name in Category.objects.values_list('pk', 'name')}
+        self.brands = {pk: BrandRecord(pk, name, category_id) for pk, name, category_id in
+                       Brand.objects.values_list('pk', 'name', 'category_id')}
+        self.device_models = {pk: DeviceModelRecord(pk, name, brand_id) for pk, name, brand_id in
+                              DeviceModel.objects.values_list('pk', 'name', 'brand_id')}
+
+        # Color names are not unique: a name maps to every color carrying it
+        self.color_ids_by_name = {}
+        for color in self.colors.values():
+            self.color_ids_by_name.setdefault(color.name, []).append(color.id)
+        self.size_ids_by_name = {size.name: size.id for size in self.sizes.values()}
+        self.size_ids_by_folded_name = {size.name.casefold(): size.id for size in self.sizes.values()}
+        self.category_ids_by_name = {category.name: category.id for category in self.categories.values()}
+        self.brand_ids_by_name = {brand.name: brand.id for brand in self.brands.values()}
+
+
+class ReferenceDataCache:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = None
+        self._checked_at = 0.0
+
+    def get(self, recheck=False):
+        """The current reference data; `recheck` forces a look at the shared version."""
+        data = self._data
+        now = time.monotonic()
+        if data is not None and not recheck and now - self._checked_at < VERSION_CHECK_INTERVAL:
+            return data
+        # Seeded with the clock, so a counter that fell out of the cache never
+        # comes back to the version of an old copy
+        cache.add(VERSION_KEY, time.time_ns(), timeout=None)
+        version = cache.get(VERSION_KEY)
+        self._checked_at = now
+        if data is None or data.version != version:
+            with self._lock:
+                if self._data is None or self._data.version != version:
+                    self._data = ReferenceData(version)
+                data = self._data
+        return data
+
+    def drop(self):
+        """Forget this process's copy; the next lookup reloads it."""
+        self._data = None
+
+    def invalidate(self):
+        """Drop this process's copy and tell the other processes to drop theirs."""
+        try:
+            cache.incr(VERSION_KEY)
+        except ValueError:
+            cache.add(VERSION_KEY, time.time_ns(), timeout=None)
+        self._data = None
+
+    # -- lookups ---------------------------------------------------------------
+
+    def _find(self, lookup):
+        # A name we do not know may have been added since the last check
+        found = lookup(self.get())
+        if not found:
+            found = lookup(self.get(recheck=True))
+        return found
+
+    def color_ids(self, color_name):
+        """Ids of the colors named `color_name` (an empty list if none)."""
+        return self._find(lambda data: data.color_ids_by_name.get(color_name, []))
+
+    def size_id(self, size_name, ignore_case=False):
+        if ignore_case:
+            return self._find(lambda data: data.size_ids_by_folded_name.get((size_name or '').casefold()))
+        return self._find(lambda data: data.size_ids_by_name.get(size_name))
+
+    def color(self, color_id):
+        return self._find(lambda data: data.colors.get(color_id))
+
+    def size(self, size_id):
+        return self._find(lambda data: data.sizes.get(size_id))
+
+
+reference_data = ReferenceDataCache()
+
+
+def invalidate_reference_data_on_commit():
+    # This process may read its own writes before the commit; the others are
+    # told after it, so none of them reloads the old rows under the new version
+    reference_data.drop()
+    transaction.on_commit(reference_data.invalidate)
+
+
+def warm_reference_data():
+    """Load the reference tables before the first request (called from wsgi.py)."""
+    try:
+        reference_data.get()
+    except DatabaseError:
+        # e.g. migrations not applied yet; the first lookup loads them instead
+        logger.warning("Could not preload reference data", exc_info=True)
@@ -0,0 +1,147 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import StockMovement, StockReservation
+from .retry import retry_on_conflict
+from .stock import give_back, take
+
+# Stock holds taken when a customer starts checking out (store/checkout.py).
+# The held quantity leaves the stock row at once (store/stock.py), so the
+# stock column is always what is left to sell and availability checks stay
+# plain reads. submit_cart then consumes the customer's own holds and only
+# takes from the stock rows what was not held. Holds not used in time go
+# back to the stock with the release_stock_reservations command.
+#
+# SKUs are (product_color_image_id, product_color_size_id), as in store/stock.py.
+
+
+class NotEnoughStock(Exception):
+    """A hold could not be taken; `shortages` maps the SKUs to what the customer could get."""
+
+    def __init__(self, shortages):
+        super().__init__(shortages)
+        self.shortages = shortages
+
+
+def reservation_ttl():
+    return timedelta(seconds=getattr(settings, 'STOCK_RESERVATION_TTL', 600))
+
+
+def _sku(reservation):
+    return (reservation.product_color_image_id, reservation.product_color_size_id)
+
+
+@retry_on_conflict
+def hold(customer, requested):
+    """
+    Hold {sku: quantity} for the customer until now + STOCK_RESERVATION_TTL,
+    replacing the holds of an earlier checkout start: SKUs already held only
+    take or give back the difference, SKUs no longer requested are released.
+    Returns the expiry. Raises NotEnoughStock, holding nothing, when a SKU
+    does not have enough stock left.
+    """
+    expires_at = timezone.now() + reservation_ttl()
+    with transaction.atomic():
+        held = {_sku(reservation): reservation for reservation in
+                StockReservation.objects.select_for_update().filter(customer=customer).order_by('pk')}
+
+        taking = {}
+        released = {}
+        for sku, quantity in requested.items():
+            difference = quantity - (held[sku].quantity if sku in held else 0)
+            if difference > 0:
+                taking[sku] = difference
+            elif difference < 0:
+                released[sku] = -difference
+        shortages = take(taking, StockMovement.Reason.HOLD)
+        if shortages:
+            raise NotEnoughStock({
+                sku: stock + (held[sku].quantity if sku in held else 0) for sku, stock in shortages.items()
+            })
+
+        dropped = [reservation for sku, reservation in held.items() if sku not in requested]
+        for reservation in dropped:
+            released[_sku(reservation)] = reservation.quantity
+        give_back(released, StockMovement.Reason.RELEASE)
+        StockReservation.objects.filter(pk__in=[reservation.pk for reservation in dropped]).delete()
+
+        kept = []
+        for sku, reservation in held.items():
+            if sku in requested:
+                reservation.quantity = requested[sku]
+                reservation.expires_at = expires_at
+                kept.append(reservation)
+        StockReservation.objects.bulk_update(kept, ['quantity', 'expires_at'])
+        StockReservation.objects.bulk_create([
+            StockReservation(
+                customer=customer, product_color_image_id=image_id, product_color_size_id=size_row_id,
+                quantity=quantity, expires_at=expires_at,
+            )
+            for (image_id, size_row_id), quantity in requested.items() if (image_id, size_row_id) not in held
+        ])
+    return expires_at
+
+
+def consume(customer, requested):
+    """
+    Use the customer's holds for a checkout of {sku: quantity}; call inside
+    the checkout's transaction. Holds of the requested SKUs are deleted, what
+    they held beyond the checkout goes back to the stock. Returns {sku: quantity
+    taken from holds}. Expired holds still count until the sweeper releases them.
+    """
+    reservations = list(StockReservation.objects.select_for_update().filter(
+        customer=customer, product_color_image_id__in={image_id for image_id, _ in requested},
+    ).order_by('pk'))
+    used = {}
+    leftovers = {}
+    consumed = []
+    for reservation in reservations:
+        sku = _sku(reservation)
+        if sku not in requested:
+            continue
+        used[sku] = min(reservation.quantity, requested[sku])
+        leftovers[sku] = reservation.quantity - used[sku]
+        consumed.append(reservation.pk)
+    if consumed:
+        give_back(leftovers, StockMovement.Reason.RELEASE)
+        StockReservation.objects.filter(pk__in=consumed).delete()
+    return used
+
+
+def release(customer):
+    """Give back every hold of the customer (checkout abandoned). Returns the number of holds."""
+    with transaction.atomic():
+        reservations = list(StockReservation.objects.select_for_update().filter(customer=customer).values_list(
+            'pk', 'product_color_image_id', 'product_color_size_id', 'quantity',
+        ))
+        _release(reservations)
+    return len(reservations)
+
+
+def release_expired(batch_size=500, now=None):
+    """Give back the holds that expired, `batch_size` per transaction. Returns the number released."""
+    now = now or timezone.now()
+    released = 0
+    while True:
+        with transaction.atomic():
+            # Holds being consumed by a checkout right now are left to it
+            reservations = list(
+                StockReservation.objects.select_for_update(skip_locked=True).filter(expires_at__lte=now)
+                .order_by('pk').values_list('pk', 'product_color_image_id', 'product_color_size_id', 'quantity')
+                [:batch_size]
+            )
+            _release(reservations)
+        released += len(reservations)
+        if len(reservations) < batch_size:
+            return released
+
+
+def _release(reservations):
+    give_back(
+        {(image_id, size_row_id): quantity for _, image_id, size_row_id, quantity in reservations},
+        StockMovement.Reason.RELEASE,
+    )
+    StockReservation.objects.filter(pk__in=[pk for pk, *_ in reservations]).delete()
@@ -0,0 +1,128 @@
+import hashlib
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+
+# Tags used by the catalog endpoints. A write to any model behind a tag bumps
+# its version (see store/signals.py), which changes the cache key of every
+# response that depends on it.
+PRODUCT_TAGS = ('products', 'categories', 'brands', 'device_models', 'colors', 'sizes')
+
+
+def get_response_cache():
+    return caches[getattr(settings, 'RESPONSE_CACHE_ALIAS', 'default')]
+
+
+def _version_key(tag):
+    return f'response-cache:tag:{tag}'
+
+
+def get_tag_versions(tags):
+    cache = get_response_cache()
+    keys = [_version_key(tag) for tag in tags]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # Seed with the clock rather than 1, so a version that fell out of
+            # the cache can never come back to an old value.
+            cache.add(key, time.time_ns(), timeout=None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def bump_cache_tags(*tags):
+    """Invalidate every cached response depending on one of these tags."""
+    cache = get_response_cache()
+    for tag in tags:
+        try:
+            cache.incr(_version_key(tag))
+        except ValueError:
+            cache.set(_version_key(tag), time.time_ns(), timeout=None)
+
+
+def bump_cache_tags_on_commit(*tags):
+    # Bumping before commit would let a concurrent reader cache the old rows
+    # under the new version.
+    transaction.on_commit(lambda: bump_cache_tags(*tags))
+
+
+def response_cache_key(request, tags):
+    query = sorted(request.GET.lists())
+    versions = get_tag_versions(tags)
+    # Absolute URL, not just the path: serializers embed the host in image links.
+    url = request.build_absolute_uri(request.path)
+    raw = repr((url, query, request.META.get('HTTP_ACCEPT', ''), list(zip(tags, versions))))
+    return 'response-cache:' + hashlib.md5(raw.encode('utf-8')).hexdigest()
+
+
+def _has_credentials(request):
+    # Cached responses are served before DRF authenticates the request, and
+    # the key ignores who is asking: only anonymous requests may share them.
+    return 'HTTP_AUTHORIZATION' in request.META or settings.SESSION_COOKIE_NAME in request.COOKIES
+
+
+def _response_from_entry(entry):
+    response = HttpResponse(entry['content'], content_type=entry['content_type'])
+    response['ETag'] = entry['etag']
+    response['Last-Modified'] = http_date(entry['last_modified'])
+    patch_vary_headers(response, ['Accept', 'Authorization', 'Cookie'])
+    return response
+
+
+def serve_cached(request, tags, view):
+    """
+    Return the cached response for this request, calling `view()` on a miss.
+    Only successful GET/HEAD responses of anonymous requests are stored;
+    requests carrying credentials (Authorization header, session cookie)
+    always run the view. Conditional requests (If-None-Match /
+    If-Modified-Since) are answered with a 304.
+    """
+    if request.method not in ('GET', 'HEAD') or _has_credentials(request):
+        return view()
+
+    cache = get_response_cache()
+    key = response_cache_key(request, tags)
+    entry = cache.get(key)
+    if entry is None:
+        response = view()
+        if response.status_code != 200:
+            return response
+        if hasattr(response, 'render') and not response.is_rendered:
+            response.render()
+        entry = {
+            'content': response.content,
+            'content_type': response['Content-Type'],
+            'etag': '"%s"' % hashlib.md5(response.content).hexdigest(),
+            'last_modified': int(time.time()),
+        }
+        cache.set(key, entry, getattr(settings, 'RESPONSE_CACHE_TIMEOUT', 60 * 60 * 24))
+
+    response = _response_from_entry(entry)
+    return get_conditional_response(
+        request, etag=entry['etag'], last_modified=entry['last_modified'], response=response
+    )
+
+
+def cache_response(*tags):
+    """Decorator for function views (put it above @api_view)."""
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapped(request, *args, **kwargs):
+            return serve_cached(request, tags, lambda: view_func(request, *args, **kwargs))
+        return wrapped
+    return decorator
+
+
+class CachedResponseMixin:
+    """Response caching for APIViews and ViewSets, keyed on `cache_tags`."""
+    cache_tags = ()
+
+    def dispatch(self, request, *args, **kwargs):
+        parent_dispatch = super().dispatch
+        return serve_cached(request, self.cache_tags, lambda: parent_dispatch(request, *args, **kwargs))
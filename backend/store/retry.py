@@ -0,0 +1,38 @@
+import random
+import time
+from functools import wraps
+
+from django.db import OperationalError, transaction
+
+# Rerun a whole transaction when the database gave up on it because of a
+# concurrent writer: "database is locked" on SQLite, a serialization failure
+# or a deadlock on Postgres. Waits grow exponentially, with jitter so the
+# retries of competing requests spread out.
+ATTEMPTS = 4
+BACKOFF = 0.05  # seconds before the first retry
+
+CONFLICT_CODES = ('40001', '40P01')  # Postgres serialization failure, deadlock
+
+
+def is_conflict(error):
+    code = getattr(error.__cause__, 'pgcode', None) or getattr(error.__cause__, 'sqlstate', None)
+    return code in CONFLICT_CODES or 'database is locked' in str(error)
+
+
+def retry_on_conflict(func):
+    """
+    Decorator for functions running their own transaction. Inside an outer
+    transaction nothing can be retried, so the error goes up to whoever
+    owns it.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(ATTEMPTS):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as error:
+                last_attempt = attempt == ATTEMPTS - 1
+                if last_attempt or not is_conflict(error) or transaction.get_connection().in_atomic_block:
+                    raise
+            time.sleep(BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+    return wrapper
@@ -0,0 +1,250 @@
+import re
+
+from django.core.cache import cache
+from django.db import DatabaseError, connection, transaction
+from django.db.models.expressions import RawSQL
+
+from .models import Product
+
+# Full-text index over product name and description.
+# SQLite uses an FTS5 virtual table, Postgres a tsvector column with a GIN index.
+# The table is maintained from product signals (store/signals.py) and can be
+# rebuilt with `manage.py rebuild_search_index`, which fills a shadow table and
+# swaps it in so searches keep working during the rebuild.
+SEARCH_TABLE = 'store_product_search'
+SHADOW_TABLE = 'store_product_search_rebuild'
+
+# Set while a rebuild runs: product writes go to the shadow table too, or an
+# edit made after its chunk was copied would be lost by the swap.
+REBUILDING_KEY = 'search:rebuilding'
+REBUILDING_TIMEOUT = 6 * 3600
+
+
+def search_terms(query):
+    return re.findall(r'\w+', query.lower())
+
+
+class SQLiteSearchBackend:
+    """FTS5 table keyed by product id (rowid). bm25(): lower is better."""
+
+    def create_index(self, cursor, table=SEARCH_TABLE):
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5("
+            "name, description, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        )
+
+    def drop_index(self, cursor, table=SEARCH_TABLE):
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+
+    def swap_in(self, cursor, table):
+        cursor.execute(f"DROP TABLE IF EXISTS {SEARCH_TABLE}")
+        cursor.execute(f"ALTER TABLE {table} RENAME TO {SEARCH_TABLE}")
+
+    def index_products(self, cursor, rows, table=SEARCH_TABLE):
+        cursor.executemany(f"DELETE FROM {table} WHERE rowid = %s", [(row[0],) for row in rows])
+        cursor.executemany(f"INSERT INTO {table} (rowid, name, description) VALUES (%s, %s, %s)", rows)
+
+    def remove_product(self, cursor, product_id, table=SEARCH_TABLE):
+        cursor.execute(f"DELETE FROM {table} WHERE rowid = %s", [product_id])
+
+    def match_expression(self, terms):
+        return ' '.join(f'"{term}"*' for term in terms)
+
+    def ranked_sql(self):
+        # Name matches weigh ten times more than description matches.
+        return (
+            f"SELECT rowid AS product_id, bm25({SEARCH_TABLE}, 10.0, 1.0) AS score "
+            f"FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s"
+        )
+
+    score_order = 'ASC'
+
+
+class PostgresSearchBackend:
+    """tsvector per product with a GIN index. ts_rank(): higher is better."""
+
+    def create_index(self, cursor, table=SEARCH_TABLE):
+        cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "product_id bigint PRIMARY KEY REFERENCES store_product (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+            "document tsvector NOT NULL)"
+        )
+        cursor.execute(
+            f"CREATE INDEX IF NOT EXISTS {table}_document_gin ON {table} USING GIN (document)"
+        )
+
+    def drop_index(self, cursor, table=SEARCH_TABLE):
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+
+    def swap_in(self, cursor, table):
+        cursor.execute(f"DROP TABLE IF EXISTS {SEARCH_TABLE}")
+        cursor.execute(f"ALTER TABLE {table} RENAME TO {SEARCH_TABLE}")
+        cursor.execute(f"ALTER INDEX {table}_document_gin RENAME TO {SEARCH_TABLE}_document_gin")
+
+    def index_products(self, cursor, rows, table=SEARCH_TABLE):
+        cursor.executemany(
+            f"INSERT INTO {table} (product_id, document) VALUES (%s, "
+            "setweight(to_tsvector('simple', %s), 'A') || setweight(to_tsvector('simple', %s), 'B')) "
+            "ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document",
+            rows,
+        )
+
+    def remove_product(self, cursor, product_id, table=SEARCH_TABLE):
+        cursor.execute(f"DELETE FROM {table} WHERE product_id = %s", [product_id])
+
+    def match_expression(self, terms):
+        return ' & '.join(f'{term}:*' for term in terms)
+
+    def ranked_sql(self):
+        return (
+            f"SELECT product_id, ts_rank(document, to_tsquery('simple', %s)) AS score "
+            f"FROM {SEARCH_TABLE} WHERE document @@ to_tsquery('simple', %s)"
+        )
+
+    score_order = 'DESC'
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+
+def get_backend(vendor=None):
+    backend_class = BACKENDS.get(vendor or connection.vendor)
+    return backend_class() if backend_class else None
+
+
+_index_seen = False
+
+
+def search_index_available():
+    global _index_seen
+    if not _index_seen:
+        backend = get_backend()
+        _index_seen = backend is not None and SEARCH_TABLE in connection.introspection.table_names()
+    return _index_seen
+
+
+def _write_shadow(write):
+    # Written before the live table: if the rebuild swaps the shadow in between
+    # the two writes, the second one lands in the new live table. A shadow
+    # table that is already gone was swapped in, so the error is harmless.
+    if not cache.get(REBUILDING_KEY):
+        return
+    try:
+        with transaction.atomic(), connection.cursor() as cursor:
+            write(cursor)
+    except DatabaseError:
+        pass
+
+
+def index_products(product_ids, table=SEARCH_TABLE):
+    backend = get_backend()
+    if backend is None:
+        return
+    rows = list(Product.objects.filter(pk__in=list(product_ids)).values_list('pk', 'name', 'description'))
+    if rows:
+        if table == SEARCH_TABLE:
+            _write_shadow(lambda cursor: backend.index_products(cursor, rows, SHADOW_TABLE))
+        with connection.cursor() as cursor:
+            backend.index_products(cursor, rows, table)
+
+
+def index_product_on_commit(product_id):
+    transaction.on_commit(lambda: index_products([product_id]))
+
+
+def remove_product(product_id):
+    backend = get_backend()
+    if backend is None:
+        return
+    _write_shadow(lambda cursor: backend.remove_product(cursor, product_id, SHADOW_TABLE))
+    with connection.cursor() as cursor:
+        backend.remove_product(cursor, product_id)
+
+
+def start_rebuild(backend):
+    """Create an empty shadow table; fill it with index_products(ids, SHADOW_TABLE)."""
+    with connection.cursor() as cursor:
+        backend.drop_index(cursor, SHADOW_TABLE)
+        backend.create_index(cursor, SHADOW_TABLE)
+    cache.set(REBUILDING_KEY, True, timeout=REBUILDING_TIMEOUT)
+
+
+def finish_rebuild(backend):
+    """Replace the live table with the filled shadow table in one transaction."""
+    global _index_seen
+    with transaction.atomic(), connection.cursor() as cursor:
+        backend.swap_in(cursor, SHADOW_TABLE)
+    cache.delete(REBUILDING_KEY)
+    _index_seen = False
+
+
+def _params(backend, expression):
+    # The Postgres query repeats the tsquery in SELECT and WHERE.
+    return [expression, expression] if isinstance(backend, PostgresSearchBackend) else [expression]
+
+
+def _hits_sql(backend, terms, within=None):
+    """
+    SQL and params selecting (product_id, score) for every hit. `within` is an
+    optional Product queryset (e.g. filtered by category) the hits must belong to.
+    """
+    expression = backend.match_expression(terms)
+    sql = f"SELECT product_id, score FROM ({backend.ranked_sql()}) AS hits"
+    params = _params(backend, expression)
+    if within is not None:
+        within_sql, within_params = within.order_by().values('pk').query.sql_with_params()
+        sql += f" WHERE product_id IN ({within_sql})"
+        params += list(within_params)
+    return sql, params
+
+
+def ranked_product_ids(query, limit, after=None, within=None):
+    """
+    Return up to `limit` (product_id, score) pairs for `query`, best match
+    first. `after` is the (score, product_id) of the last hit of the previous
+    page, used as a keyset so deep pages cost the same as the first.
+    """
+    backend = get_backend()
+    terms = search_terms(query)
+    if not terms:
+        return []
+    hits_sql, params = _hits_sql(backend, terms, within)
+
+    comparison = '>' if backend.score_order == 'ASC' else '<'
+    sql = f"SELECT product_id, score FROM ({hits_sql}) AS page"
+    if after is not None:
+        sql += f" WHERE score {comparison} %s OR (score = %s AND product_id > %s)"
+        params += [after[0], after[0], after[1]]
+    sql += f" ORDER BY score {backend.score_order}, product_id ASC LIMIT %s"
+    params.append(limit)
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def count_matches(query, within=None):
+    backend = get_backend()
+    terms = search_terms(query)
+    if not terms:
+        return 0
+    hits_sql, params = _hits_sql(backend, terms, within)
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT COUNT(*) FROM ({hits_sql}) AS counted", params)
+        return cursor.fetchone()[0]
+
+
+def matching_products(query, within=None):
+    """
+    Subquery of the product ids matching `query`, for use in a `__in` lookup
+    (facet counts over every hit, not just the current page).
+    """
+    backend = get_backend()
+    terms = search_terms(query)
+    if not terms:
+        return RawSQL("SELECT NULL WHERE 1 = 0", [])
+    hits_sql, params = _hits_sql(backend, terms, within)
+    return RawSQL(f"SELECT product_id FROM ({hits_sql}) AS matched", params)
@@ -2,6 +2,9 @@ from rest_framework import serializers
 from rest_framework import serializers
 from .models import Banner, Logo, BannerImage, Cart, CartItem, Color, CustomerProfile, Order, OrderItem, Product, Category, Brand, DeviceModel, ProductColorImage, ProductColorSize, Reply, Review, Size, Wishlist
 from django.contrib.auth.models import User
+from django.db import models
+from .pricing import effective_prices, price_memo, price_of
+from .reference_data import reference_data
 
 class CategorySerializer(serializers.ModelSerializer):
     class Meta:
@@ -57,7 +60,36 @@ class ReviewSerializer(serializers.ModelSerializer):
         model = Review
         fields = ['id', 'product', 'user', 'rating', 'comment', 'created_at', 'like_count', 'replies']
         read_only_fields = ['user', 'product']  # Ensure these fields are read-only
-class ProductSerializer(serializers.ModelSerializer):
+class PricedListSerializer(serializers.ListSerializer):
+    """
+    Resolves the prices of the items not loaded with with_prices() in one
+    query before the list is rendered.
+    """
+
+    def to_representation(self, data):
+        items = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        with price_memo():
+            effective_prices([item.pk for item in items if not hasattr(item, 'effective_final_price')])
+            return super().to_representation(items)
+
+
+class EffectivePriceMixin:
+    """
+    Serve price, discount and stock as the listing shop sells the product:
+    its ShopInventory override when set, else the product's own columns
+    (store/pricing.py). Writes still go to the product columns.
+    """
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        price = price_of(instance)
+        data['price'] = self.fields['price'].to_representation(price.price)
+        data['discount'] = self.fields['discount'].to_representation(price.discount)
+        data['stock'] = price.stock
+        return data
+
+
+class ProductSerializer(EffectivePriceMixin, serializers.ModelSerializer):
     category = CategorySerializer(read_only=True)
     reviews = ReviewSerializer(many=True, read_only=True)
     brand = BrandSerializer(read_only=True)
@@ -75,29 +107,63 @@ class ProductSerializer(serializers.ModelSerializer):
             'image1', 'image2', 'image3', 'category', 'brand', 'device_model', 'reviews',
             'final_price', 'color_images'
         ]
+        list_serializer_class = PricedListSerializer
 
     def get_image1(self, obj):
-        first_color = obj.color_images.first()
-        if first_color and first_color.image:
-            return first_color.image.url
-        return None
+        return self._color_image_url(obj, 0)
 
     def get_image2(self, obj):
-        second_color = obj.color_images.all()[1] if obj.color_images.count() > 1 else None
-        if second_color and second_color.image:
-            return second_color.image.url
-        return None
+        return self._color_image_url(obj, 1)
 
     def get_image3(self, obj):
-        third_color = obj.color_images.all()[2] if obj.color_images.count() > 2 else None
-        if third_color and third_color.image:
-            return third_color.image.url
+        return self._color_image_url(obj, 2)
+
+    def _color_image_url(self, obj, index):
+        # Works off the prefetched color_images (see ProductQuerySet.with_details)
+        # instead of issuing a count() and a sliced query per image.
+        color_images = sorted(obj.color_images.all(), key=lambda color_image: color_image.pk)
+        if len(color_images) > index and color_images[index].image:
+            return color_images[index].image.url
         return None
 
     def get_final_price(self, obj):
-        if obj.discount:
-            return obj.price - (obj.price * obj.discount / 100)
-        return obj.price
+        # Honours the listing shop's ShopInventory override (store/pricing.py)
+        return price_of(obj).final_price
+
+class ProductCardSerializer(EffectivePriceMixin, serializers.ModelSerializer):
+    """
+    Compact product representation for list screens.
+    The full nested ProductSerializer is only used on detail routes.
+    """
+    final_price = serializers.SerializerMethodField()
+    thumbnail = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Product
+        fields = ['id', 'name', 'price', 'final_price', 'discount', 'stock', 'thumbnail']
+        list_serializer_class = PricedListSerializer
+
+    def get_final_price(self, obj):
+        # Honours the listing shop's ShopInventory override (store/pricing.py)
+        return price_of(obj).final_price
+
+    def get_thumbnail(self, obj):
+        # First color image (same one ProductSerializer exposes as image1),
+        # falling back to the product's own image.
+        color_images = sorted(obj.color_images.all(), key=lambda color_image: color_image.pk)
+        image = color_images[0].image if color_images and color_images[0].image else obj.image1
+        if not image:
+            return None
+        request = self.context.get('request')
+        if request:
+            return request.build_absolute_uri(image.url)
+        return image.url
+
+class BestSellingProductSerializer(ProductCardSerializer):
+    total_quantity_sold = serializers.IntegerField(read_only=True)
+
+    class Meta(ProductCardSerializer.Meta):
+        fields = ProductCardSerializer.Meta.fields + ['total_quantity_sold']
 
 # BannerImage Serializer
 class BannerImageSerializer(serializers.ModelSerializer):
@@ -179,13 +245,22 @@ from .serializers import CustomerProfileSerializer, CategorySerializer, BrandSer
 # Serializer for OrderItem
 class OrderItemSerializer(serializers.ModelSerializer):
     product_name = serializers.CharField(source='product.name', read_only=True)
-    color_name = serializers.CharField(source='color.color_name', read_only=True)
-    size_name = serializers.CharField(source='size.name', read_only=True)  # NEW
+    color_name = serializers.SerializerMethodField()
+    size_name = serializers.SerializerMethodField()
 
     class Meta:
         model = OrderItem
         fields = ['product_name', 'color_name', 'size_name', 'quantity']
 
+    # Names come from the in-process reference data, not a join per line
+    def get_color_name(self, obj):
+        color = reference_data.color(obj.color_id)
+        return color.name if color else None
+
+    def get_size_name(self, obj):
+        size = reference_data.size(obj.size_id) if obj.size_id else None
+        return size.name if size else None
+
 # Serializer for Order
 class OrderSerializer(serializers.ModelSerializer):
     customer = CustomerProfileSerializer()  # Nested CustomerProfile serializer
@@ -201,12 +276,16 @@ class OrderSerializer(serializers.ModelSerializer):
         ]
 
 class CartItemSerializer(serializers.ModelSerializer):
-    size_name = serializers.CharField(source='size.name', read_only=True)  # NEW
+    size_name = serializers.SerializerMethodField()
 
     class Meta:
         model = CartItem
         fields = ['product', 'color', 'size_name', 'quantity']
 
+    def get_size_name(self, obj):
+        size = reference_data.size(obj.size_id) if obj.size_id else None
+        return size.name if size else None
+
     
 from decimal import Decimal, ROUND_HALF_UP
 from rest_framework import serializers
@@ -230,7 +309,7 @@ class CartSerializer(serializers.ModelSerializer):
 
 
 class WishlistSerializer(serializers.ModelSerializer):
-    products = ProductSerializer(many=True, read_only=True)
+    products = ProductCardSerializer(many=True, read_only=True)
     customer = CustomerProfileSerializer(read_only=True)
 
     class Meta:
@@ -241,54 +320,6 @@ class WishlistCreateSerializer(serializers.ModelSerializer):
     class Meta:
         model = Wishlist
         fields = ['name', 'description', 'products', 'customer']
-class BestSellingProductSerializer(serializers.ModelSerializer):
-    product_id = serializers.IntegerField(source='product.id')  
-    product_name = serializers.CharField(source='product.name')
-    description = serializers.CharField(source='product.description')
-    price = serializers.DecimalField(source='product.price', max_digits=10, decimal_places=2)
-    make_by = serializers.CharField(source='product.make_by')
-    color = serializers.StringRelatedField(many=True, source='product.color.all')  
-    rating = serializers.DecimalField(source='product.rating', max_digits=2, decimal_places=1)
-    discount = serializers.DecimalField(source='product.discount', max_digits=5, decimal_places=2)
-    stock = serializers.IntegerField(source='product.stock')  
-    total_quantity_sold = serializers.IntegerField()  
-    image1 = serializers.SerializerMethodField()
-    image2 = serializers.SerializerMethodField()
-    image3 = serializers.SerializerMethodField()
-    final_price = serializers.SerializerMethodField()  
-    category = CategorySerializer(source='product.category')  # Nested serializer for category
-    brand = BrandSerializer(source='product.brand')  # Nested serializer for brand
-    device_model = DeviceModelSerializer(source='product.device_model')  # Nested serializer for device model
-    
-    def get_image1(self, obj):
-        return self.build_image_url(obj, 'image1')
-
-    def get_image2(self, obj):
-        return self.build_image_url(obj, 'image2')
-
-    def get_image3(self, obj):
-        return self.build_image_url(obj, 'image3')
-
-    def build_image_url(self, obj, image_field):
-        """Helper method to build the full image URL."""
-        image = getattr(obj['product'], image_field, None)
-        if image:
-            return self.context['request'].build_absolute_uri(image.url)
-        return None
-
-    def get_final_price(self, obj):
-        price = obj['product'].price
-        discount = obj['product'].discount
-        final_price = price - (price * (discount / 100))
-        return final_price
-
-    class Meta:
-        model = Product
-        fields = [
-            'product_id', 'product_name', 'description', 'price', 'make_by', 'color', 'rating', 'discount', 'stock',
-            'total_quantity_sold', 'image1', 'image2', 'image3', 'final_price', 'category', 'brand', 'device_model',
-        ]
-
 class LogoSerializer(serializers.ModelSerializer):
     image_url = serializers.SerializerMethodField()
 
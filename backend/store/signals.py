@@ -53,31 +53,242 @@ import requests
 #     else:
 #         print(f"Error sending notification for order ID {order.id}: {response.text}")
 
-from django.db.models import Sum
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from .models import Product, ProductColorImage, ProductColorSize
+from .stock_rollups import schedule_product_stock_rollup, schedule_stock_rollup
 
+# Color and product stock totals are summed once per transaction, after
+# commit (store/stock_rollups.py)
 @receiver([post_save, post_delete], sender=ProductColorSize)
 def update_color_stock(sender, instance, **kwargs):
-    color_image = instance.product_color_image
-
-    # Calculate total stock for this color from all sizes
-    total_color_stock = color_image.sizes.aggregate(total=Sum('stock'))['total'] or 0
-
-    # Update color image stock
-    ProductColorImage.objects.filter(pk=color_image.pk).update(stock=total_color_stock)
-
-    # Update product stock as well
-    product = color_image.product
-    total_product_stock = ProductColorImage.objects.filter(product=product).aggregate(total=Sum('stock'))['total'] or 0
-    Product.objects.filter(pk=product.pk).update(stock=total_product_stock)
+    schedule_stock_rollup(instance.product_color_image_id)
 
 @receiver([post_save, post_delete], sender=ProductColorImage)
 def update_product_stock(sender, instance, **kwargs):
     """
     Updates the main Product.stock whenever a ProductColorImage is changed.
     """
-    product = instance.product
-    total_product_stock = ProductColorImage.objects.filter(product=product).aggregate(total=Sum('stock'))['total'] or 0
-    Product.objects.filter(pk=product.pk).update(stock=total_product_stock)
\ No newline at end of file
+    schedule_product_stock_rollup(instance.product_id)
+
+from .ledger import record as record_stock_movements
+from .models import StockMovement
+
+@receiver(post_save, sender=ProductColorSize)
+def record_stock_edit(sender, instance, created, **kwargs):
+    """
+    Stock set through save() (admin, imports) goes to the stock ledger;
+    checkout and stock holds record their own movements (store/stock.py).
+    """
+    # _stock_before is the stored stock, read under a lock by ProductColorSize.save()
+    before = 0 if created else getattr(instance, '_stock_before', None)
+    if before is None or instance.stock == before:
+        return
+    reason = StockMovement.Reason.RESTOCK if created else StockMovement.Reason.ADJUSTMENT
+    record_stock_movements({(instance.product_color_image_id, instance.pk): instance.stock - before}, reason)
+
+# ---------------- Product read-model ----------------
+from django.db.models.signals import m2m_changed, pre_delete
+from .documents import invalidate_documents, schedule_document_refresh
+from .models import Brand, Category, Color, DeviceModel, Reply, Review, Size
+
+@receiver(post_save, sender=Product)
+def refresh_document_for_product(sender, instance, **kwargs):
+    # Deleting a product removes its document through the cascade.
+    schedule_document_refresh(instance.pk)
+
+@receiver([post_save, post_delete], sender=ProductColorImage)
+def refresh_document_for_color_image(sender, instance, **kwargs):
+    schedule_document_refresh(instance.product_id)
+
+# Size rows are refreshed through their stock rollup (store/stock_rollups.py),
+# which knows their product without a query per row.
+
+@receiver([post_save, post_delete], sender=Review)
+def refresh_document_for_review(sender, instance, **kwargs):
+    schedule_document_refresh(instance.product_id)
+
+@receiver([post_save, post_delete], sender=Reply)
+def refresh_document_for_reply(sender, instance, **kwargs):
+    product_id = Review.objects.filter(pk=instance.review_id).values_list('product_id', flat=True).first()
+    schedule_document_refresh(product_id)
+
+@receiver(m2m_changed, sender=Review.liked_by.through)
+def refresh_document_for_review_like(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        schedule_document_refresh(instance.product_id)
+    elif pk_set:
+        for product_id in Review.objects.filter(pk__in=pk_set).values_list('product_id', flat=True):
+            schedule_document_refresh(product_id)
+
+# Shared rows use pre_delete: on delete the products still point at them.
+@receiver([post_save, pre_delete], sender=Category)
+def invalidate_documents_for_category(sender, instance, **kwargs):
+    invalidate_documents(category_id=instance.pk)
+
+@receiver([post_save, pre_delete], sender=Brand)
+def invalidate_documents_for_brand(sender, instance, **kwargs):
+    invalidate_documents(brand_id=instance.pk)
+
+@receiver([post_save, pre_delete], sender=DeviceModel)
+def invalidate_documents_for_device_model(sender, instance, **kwargs):
+    invalidate_documents(device_model_id=instance.pk)
+
+@receiver([post_save, pre_delete], sender=Color)
+def invalidate_documents_for_color(sender, instance, **kwargs):
+    invalidate_documents(color_images__color_id=instance.pk)
+
+@receiver([post_save, pre_delete], sender=Size)
+def invalidate_documents_for_size(sender, instance, **kwargs):
+    invalidate_documents(color_images__sizes__size_id=instance.pk)
+
+
+# ---------------- Full-text search index ----------------
+from .search import index_product_on_commit, remove_product as remove_product_from_search
+
+@receiver(post_save, sender=Product)
+def index_product_for_search(sender, instance, **kwargs):
+    index_product_on_commit(instance.pk)
+
+@receiver(post_delete, sender=Product)
+def remove_product_from_search_index(sender, instance, **kwargs):
+    remove_product_from_search(instance.pk)
+
+
+# ---------------- Facet index ----------------
+from .facets import drop_facet, relabel_facet, schedule_facet_refresh
+
+@receiver(post_save, sender=Product)
+def refresh_facets_for_product(sender, instance, **kwargs):
+    schedule_facet_refresh(instance.pk)
+
+@receiver([post_save, post_delete], sender=ProductColorImage)
+def refresh_facets_for_color_image(sender, instance, **kwargs):
+    schedule_facet_refresh(instance.product_id)
+
+# Size rows: see the stock rollups.
+
+FACET_LABELS = {
+    Category: ('category', 'name'),
+    Brand: ('brand', 'name'),
+    DeviceModel: ('device_model', 'name'),
+    Color: ('color', 'color_name'),
+    Size: ('size', 'name'),
+}
+
+def relabel_facets_for_instance(sender, instance, created, **kwargs):
+    if not created:
+        facet, label_field = FACET_LABELS[sender]
+        relabel_facet(facet, instance.pk, getattr(instance, label_field))
+
+def drop_facets_for_instance(sender, instance, **kwargs):
+    # Products are detached with SET_NULL (an UPDATE, no signals), so drop the
+    # rows here. Colors and sizes go through the cascades above.
+    drop_facet(FACET_LABELS[sender][0], instance.pk)
+
+for model in FACET_LABELS:
+    post_save.connect(relabel_facets_for_instance, sender=model, dispatch_uid=f'relabel_facets_{model.__name__}')
+for model in (Category, Brand, DeviceModel):
+    post_delete.connect(drop_facets_for_instance, sender=model, dispatch_uid=f'drop_facets_{model.__name__}')
+
+
+# ---------------- Autocomplete index ----------------
+from .autocomplete import COLOR_IMAGE_FIELDS, PRODUCT_FIELDS, schedule_autocomplete_update, touches_index
+
+@receiver([post_save, post_delete], sender=Product)
+def update_autocomplete_for_product(sender, instance, update_fields=None, **kwargs):
+    if touches_index(update_fields, PRODUCT_FIELDS):
+        schedule_autocomplete_update(instance.pk)
+
+@receiver([post_save, post_delete], sender=ProductColorImage)
+def update_autocomplete_for_color_image(sender, instance, update_fields=None, **kwargs):
+    # The thumbnail is the first color image.
+    if touches_index(update_fields, COLOR_IMAGE_FIELDS):
+        schedule_autocomplete_update(instance.product_id)
+
+@receiver([post_save, pre_delete], sender=Category)
+def update_autocomplete_for_category(sender, instance, created=False, **kwargs):
+    if not created:
+        for product_id in Product.objects.filter(category=instance).values_list('pk', flat=True):
+            schedule_autocomplete_update(product_id)
+
+@receiver([post_save, pre_delete], sender=Brand)
+def update_autocomplete_for_brand(sender, instance, created=False, **kwargs):
+    if not created:
+        for product_id in Product.objects.filter(brand=instance).values_list('pk', flat=True):
+            schedule_autocomplete_update(product_id)
+
+
+# ---------------- Reference data ----------------
+from .reference_data import invalidate_reference_data_on_commit
+
+def invalidate_reference_data(sender, **kwargs):
+    invalidate_reference_data_on_commit()
+
+for model in (Color, Size, Category, Brand, DeviceModel):
+    post_save.connect(invalidate_reference_data, sender=model, dispatch_uid=f'reference_data_{model.__name__}')
+    post_delete.connect(invalidate_reference_data, sender=model, dispatch_uid=f'reference_data_{model.__name__}')
+
+
+# ---------------- Pricing ----------------
+from .models import ShopInventory
+from .pricing import forget_prices
+
+def forget_memoized_prices(sender, **kwargs):
+    forget_prices()
+
+for model in (Product, ShopInventory):
+    post_save.connect(forget_memoized_prices, sender=model, dispatch_uid=f'forget_prices_{model.__name__}')
+    post_delete.connect(forget_memoized_prices, sender=model, dispatch_uid=f'forget_prices_{model.__name__}')
+
+@receiver([post_save, post_delete], sender=ShopInventory)
+def refresh_document_for_shop_inventory(sender, instance, **kwargs):
+    # Documents carry the price, discount and stock, which the override changes
+    schedule_document_refresh(instance.product_id)
+
+@receiver([post_save, post_delete], sender=ShopInventory)
+def refresh_facets_for_shop_inventory(sender, instance, **kwargs):
+    # The price bucket follows the override
+    schedule_facet_refresh(instance.product_id)
+
+
+# ---------------- Response cache invalidation ----------------
+# Connected last: on-commit callbacks run in the order they were registered, so
+# the indexes above are updated before the bump lets readers cache new responses.
+from .models import AboutPageContent, Banner, BannerImage, Blog, Logo, OrderItem, Partner
+from .response_cache import bump_cache_tags_on_commit
+
+CACHE_TAGS_BY_MODEL = {
+    Product: ('products',),
+    ProductColorImage: ('products',),
+    ProductColorSize: ('products',),
+    Review: ('products', 'reviews'),
+    Reply: ('products', 'reviews'),
+    Category: ('categories',),
+    Brand: ('brands',),
+    DeviceModel: ('device_models',),
+    Color: ('colors',),
+    Size: ('sizes',),
+    Banner: ('banners',),
+    BannerImage: ('banners',),
+    Logo: ('logos',),
+    AboutPageContent: ('about',),
+    Blog: ('about',),
+    Partner: ('about',),
+    OrderItem: ('orders',),
+    ShopInventory: ('products',),
+}
+
+def bump_cache_tags_for_instance(sender, **kwargs):
+    bump_cache_tags_on_commit(*CACHE_TAGS_BY_MODEL[sender])
+
+for model in CACHE_TAGS_BY_MODEL:
+    post_save.connect(bump_cache_tags_for_instance, sender=model, dispatch_uid=f'bump_cache_tags_{model.__name__}')
+    post_delete.connect(bump_cache_tags_for_instance, sender=model, dispatch_uid=f'bump_cache_tags_{model.__name__}')
+
+@receiver(m2m_changed, sender=Review.liked_by.through)
+def bump_cache_tags_for_review_like(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_cache_tags_on_commit('products', 'reviews')
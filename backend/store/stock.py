@@ -0,0 +1,100 @@
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+
+from .ledger import record
+from .models import ProductColorImage, ProductColorSize
+from .response_cache import bump_cache_tags_on_commit
+from .stock_rollups import schedule_stock_rollup
+
+# Stock writes for checkout and stock holds. Stock is only ever taken with a
+# conditional UPDATE (stock >= quantity) whose row count is checked, so
+# nothing is oversold without holding row locks, on SQLite (where
+# select_for_update does nothing) as on Postgres. The stock columns are
+# PositiveIntegerFields, whose column CHECK (stock >= 0) backs it up. Every
+# change is also added to the stock ledger (store/ledger.py) with its reason.
+#
+# A SKU is (product_color_image_id, product_color_size_id): sized SKUs keep
+# their stock on the size row, the others on the color image.
+
+
+class _Short(Exception):
+    pass
+
+
+def _by_model(quantities):
+    """{model: {pk: quantity}} for the rows holding the SKUs' stock."""
+    by_model = {}
+    for (image_id, size_row_id), quantity in quantities.items():
+        if size_row_id:
+            by_model.setdefault(ProductColorSize, {})[size_row_id] = quantity
+        else:
+            by_model.setdefault(ProductColorImage, {})[image_id] = quantity
+    return by_model
+
+
+def _per_row(rows):
+    return Case(
+        *(When(pk=pk, then=Value(quantity)) for pk, quantity in rows.items()),
+        default=Value(0), output_field=IntegerField(),
+    )
+
+
+def _stock_changed(skus):
+    for image_id, size_row_id in skus:
+        schedule_stock_rollup(image_id, sized=bool(size_row_id))
+    bump_cache_tags_on_commit('products')
+
+
+def stock_levels(skus):
+    """{sku: stock}, one query per stock table; SKUs that are gone have 0."""
+    levels = {}
+    for model, rows in _by_model(dict.fromkeys(skus, 0)).items():
+        levels[model] = dict(model.objects.filter(pk__in=rows).values_list('pk', 'stock'))
+    return {
+        (image_id, size_row_id): (
+            levels[ProductColorSize].get(size_row_id, 0) if size_row_id else levels[ProductColorImage].get(image_id, 0)
+        )
+        for image_id, size_row_id in skus
+    }
+
+
+def take(quantities, reason, attempts=3):
+    """
+    Take {sku: quantity} off the stock, all or nothing, with one conditional
+    UPDATE per stock table; `reason` is a StockMovement.Reason. Returns {}
+    when done, else {sku: stock left} for the SKUs short of stock (nothing
+    taken).
+    """
+    quantities = {sku: quantity for sku, quantity in quantities.items() if quantity}
+    if not quantities:
+        return {}
+    for _ in range(attempts):
+        try:
+            with transaction.atomic():
+                for model, rows in _by_model(quantities).items():
+                    taken = model.objects.filter(pk__in=rows, stock__gte=_per_row(rows)).update(
+                        stock=F('stock') - _per_row(rows)
+                    )
+                    if taken != len(rows):
+                        raise _Short
+        except _Short:
+            # Rolled back to the savepoint: see which rows were short
+            levels = stock_levels(quantities)
+            shortages = {sku: levels[sku] for sku, quantity in quantities.items() if levels[sku] < quantity}
+            if shortages:
+                return shortages
+            continue  # stock came back in between
+        record({sku: -quantity for sku, quantity in quantities.items()}, reason)
+        _stock_changed(quantities)
+        return {}
+    return stock_levels(quantities)
+
+
+def give_back(quantities, reason):
+    """Return {sku: quantity} to the stock, with one UPDATE per stock table."""
+    quantities = {sku: quantity for sku, quantity in quantities.items() if quantity}
+    for model, rows in _by_model(quantities).items():
+        model.objects.filter(pk__in=rows).update(stock=F('stock') + _per_row(rows))
+    if quantities:
+        record(quantities, reason)
+        _stock_changed(quantities)
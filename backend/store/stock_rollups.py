@@ -0,0 +1,59 @@
+from django.db.models import OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from .deferred import OnCommitBatch
+from .documents import schedule_document_refresh
+from .facets import schedule_facet_refresh
+from .models import Product, ProductColorImage, ProductColorSize
+
+# Stock totals kept on the parent rows: a color image with sizes holds the
+# sum of its sizes, a product the sum of its color images. Stock writes mark
+# the parents here (signals, checkout, stock holds) and every marked color
+# image and product is summed once after the transaction commits, however
+# many of its rows changed: saving a product with 10 colors x 6 sizes in the
+# nested admin costs three UPDATE/SELECT statements instead of hundreds.
+#
+# The rolled up products also get their document and facets rebuilt, which
+# the size rows cannot do without looking their product up.
+
+
+def _sum_of(rows, parent_field):
+    return Coalesce(Subquery(
+        rows.filter(**{parent_field: OuterRef('pk')}).order_by().values(parent_field)
+        .annotate(total=Sum('stock')).values('total')
+    ), Value(0))
+
+
+def refresh_stock_rollups(keys):
+    sized_image_ids = {pk for kind, pk in keys if kind == 'sizes'}
+    image_ids = sized_image_ids | {pk for kind, pk in keys if kind == 'color_image'}
+    product_ids = {pk for kind, pk in keys if kind == 'product'}
+    if image_ids:
+        product_ids.update(ProductColorImage.objects.filter(pk__in=image_ids).values_list('product_id', flat=True))
+    if sized_image_ids:
+        ProductColorImage.objects.filter(pk__in=sized_image_ids).update(
+            stock=_sum_of(ProductColorSize.objects.all(), 'product_color_image')
+        )
+    if product_ids:
+        Product.objects.filter(pk__in=product_ids).update(stock=_sum_of(ProductColorImage.objects.all(), 'product'))
+    for product_id in product_ids:
+        schedule_document_refresh(product_id)
+        schedule_facet_refresh(product_id)
+
+
+_pending_rollups = OnCommitBatch(refresh_stock_rollups)
+
+
+def schedule_stock_rollup(color_image_id, sized=True):
+    """
+    Sum the stock of a color image's product after commit. With `sized` the
+    color image is summed from its sizes first; without, its own stock
+    changed (a color sold without sizes).
+    """
+    if color_image_id is not None:
+        _pending_rollups.add(('sizes' if sized else 'color_image', color_image_id))
+
+
+def schedule_product_stock_rollup(product_id):
+    if product_id is not None:
+        _pending_rollups.add(('product', product_id))
@@ -1,4 +1,4 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
 from rest_framework.test import APIClient
 from django.contrib.auth.models import User, Group
 from rest_framework import status
@@ -69,3 +69,1652 @@ class LoginTestCase(TestCase):
 
         # Check if the role is assigned as 'admin'
         self.assertEqual(response.data['role'], 'admin')
+
+
+from decimal import Decimal
+from django.core.cache import cache, caches
+from io import StringIO
+from store.models import (
+    Brand, Category, Color, DeviceModel, Product, ProductColorImage, ProductColorSize, Review, Size,
+)
+
+
+def create_catalog(product_count=3, colors_per_product=2, sizes_per_color=2):
+    """Build a small catalog with colors, sizes and reviews for query-count tests."""
+    category = Category.objects.create(name='Phones', description='Phones')
+    brand = Brand.objects.create(name='Apple', description='Apple', category=category)
+    device_model = DeviceModel.objects.create(name='iPhone 16', brand=brand)
+    colors = [Color.objects.create(color_name=f'Color {i}', color_code='#000000') for i in range(colors_per_product)]
+    sizes = [Size.objects.create(name=f'Size {i}') for i in range(sizes_per_color)]
+    reviewer = User.objects.create_user(username='reviewer', password='password')
+
+    products = []
+    for i in range(product_count):
+        product = Product.objects.create(
+            name=f'Product {i}', description='desc', price=Decimal('100.00'), make_by='Apple',
+            rating=Decimal('4.5'), discount=Decimal('10.00'), stock=0,
+            category=category, brand=brand, device_model=device_model,
+        )
+        for color in colors:
+            color_image = ProductColorImage.objects.create(product=product, color=color)
+            for size in sizes:
+                ProductColorSize.objects.create(product_color_image=color_image, size=size, stock=5)
+        Review.objects.create(product=product, user=reviewer, rating=5, comment='great')
+        products.append(product)
+    return products
+
+
+def committing(test_case, client):
+    """
+    Run the on-commit callbacks of each request when it returns, as a real
+    commit would (TestCase never commits): CacheCartStore writes the cache
+    on commit.
+    """
+    request = client.request
+
+    def request_and_commit(**kwargs):
+        with test_case.captureOnCommitCallbacks(execute=True):
+            return request(**kwargs)
+
+    client.request = request_and_commit
+    return client
+
+
+class ProductReadPathQueryTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def _list_queries(self, url):
+        cache.clear()
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(ctx.captured_queries)
+
+    def test_product_list_query_count_is_independent_of_page_size(self):
+        products = create_catalog(product_count=2)
+        small = self._list_queries('/api/store/products/')
+        for color_image in products[0].color_images.all():
+            color_image.sizes.create(size=Size.objects.create(name=f'XL {color_image.pk}'), stock=1)
+        product_copy = Product.objects.get(pk=products[1].pk)
+        for i in range(5):
+            product_copy.pk = None
+            product_copy.name = f'Copy {i}'
+            product_copy.save()
+        large = self._list_queries('/api/store/products/')
+        self.assertEqual(small, large)
+
+    def test_product_detail_uses_prefetched_images(self):
+        from store.documents import build_product_document
+        product = create_catalog(product_count=1)[0]
+        with self.assertNumQueries(6):
+            data = build_product_document(Product.objects.with_details().get(pk=product.pk))
+        self.assertEqual(len(data['color_images']), 2)
+
+
+class KeysetPaginationTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products = create_catalog(product_count=5, colors_per_product=1, sizes_per_color=1)
+
+    def test_unpaginated_by_default(self):
+        response = self.client.get('/api/store/products/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.json()), 5)
+
+    def test_cursor_walks_every_product_once(self):
+        Product.objects.filter(pk=self.products[1].pk).update(price=Decimal('50.00'))
+        seen = []
+        url = '/api/store/products/?page_size=2&ordering=price&include_count=1'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.json()['count'], 5)
+            seen.extend(product['id'] for product in response.json()['results'])
+            url = response.json()['next']
+        self.assertEqual(seen[0], self.products[1].pk)
+        self.assertEqual(sorted(seen), sorted(p.pk for p in self.products))
+
+    def test_rating_cursor_reads_loaded_columns(self):
+        for ordering in ('rating', '-rating'):
+            # The page and its color images; the cursor needs no extra query
+            with self.assertNumQueries(2):
+                response = self.client.get(f'/api/store/products/?page_size=2&ordering={ordering}')
+            self.assertIsNotNone(response.json()['next'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/store/products/?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_search_returns_next_cursor(self):
+        response = self.client.get('/api/store/search/?q=product&page_size=3')
+        self.assertEqual(len(response.json()['products']), 3)
+        self.assertIsNotNone(response.json()['next'])
+        response = self.client.get(response.json()['next'])
+        self.assertEqual(len(response.json()['products']), 2)
+        self.assertIsNone(response.json()['next'])
+
+
+class ProductCardTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.products = create_catalog(product_count=3, colors_per_product=1, sizes_per_color=1)
+
+    def test_list_returns_cards(self):
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/store/products/')
+        self.assertEqual(
+            set(response.json()[0]),
+            {'id', 'name', 'price', 'final_price', 'discount', 'stock', 'thumbnail'},
+        )
+        self.assertEqual(response.json()[0]['final_price'], Decimal('90.00'))
+
+    def test_detail_keeps_full_product(self):
+        response = self.client.get(f'/api/store/products/{self.products[0].pk}/')
+        self.assertIn('color_images', response.json())
+        self.assertIn('reviews', response.json())
+
+
+class ProductDocumentTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.product = create_catalog(product_count=1, colors_per_product=1, sizes_per_color=1)[0]
+
+    def test_detail_is_served_from_document(self):
+        self.client.get(f'/api/store/products/{self.product.pk}/')
+        cache.clear()
+        with self.assertNumQueries(1):
+            response = self.client.get(f'/api/store/products/{self.product.pk}/')
+        self.assertEqual(response.json()['name'], 'Product 0')
+
+        response = self.client.get('/api/store/products/name/Product 0/')
+        self.assertEqual(response.json()['id'], self.product.pk)
+
+    def test_missing_product(self):
+        response = self.client.get('/api/store/products/999/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_document_refreshed_after_commit(self):
+        from store.models import ProductDocument
+        self.client.get(f'/api/store/products/{self.product.pk}/')
+        size_entry = ProductColorSize.objects.get(product_color_image__product=self.product)
+        with self.captureOnCommitCallbacks(execute=True):
+            size_entry.stock = 42
+            size_entry.save()
+        data = ProductDocument.objects.get(product=self.product).data
+        self.assertEqual(data['stock'], 42)
+        self.assertEqual(data['color_images'][0]['sizes'][0]['stock'], 42)
+
+    def test_rebuild_command(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from store.models import ProductDocument
+        call_command('rebuild_product_documents', chunk_size=1, stdout=StringIO())
+        self.assertTrue(ProductDocument.objects.filter(product=self.product).exists())
+
+
+class ResponseCacheTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.category = Category.objects.create(name='Phones', description='Phones')
+
+    def test_repeat_request_does_not_touch_database(self):
+        first = self.client.get('/api/store/categories/')
+        with self.assertNumQueries(0):
+            second = self.client.get('/api/store/categories/')
+        self.assertEqual(first.content, second.content)
+        self.assertIn('ETag', second)
+
+    def test_conditional_request_returns_304(self):
+        etag = self.client.get('/api/store/categories/')['ETag']
+        response = self.client.get('/api/store/categories/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_requests_with_credentials_skip_the_cache(self):
+        self.client.get('/api/store/categories/')
+        # Authenticated by DRF, not answered from the anonymous entry
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer not-a-token')
+        self.assertEqual(self.client.get('/api/store/categories/').status_code, status.HTTP_401_UNAUTHORIZED)
+        self.client.credentials()
+        self.client.cookies['sessionid'] = 'session'
+        response = self.client.get('/api/store/categories/')
+        self.assertNotIn('ETag', response)
+        self.assertEqual(len(response.json()), 1)
+
+    def test_write_invalidates_tag(self):
+        self.client.get('/api/store/categories/')
+        with self.captureOnCommitCallbacks(execute=True):
+            Category.objects.create(name='Tablets', description='Tablets')
+        response = self.client.get('/api/store/categories/')
+        self.assertEqual(len(response.json()), 2)
+
+
+class SearchIndexTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.in_description = Product.objects.create(
+                name='Case', description='Fits the Galaxy S24', price=Decimal('10.00'), make_by='x',
+                rating=Decimal('4.0'), discount=Decimal('0.00'), stock=1,
+            )
+            self.in_name = Product.objects.create(
+                name='Galaxy S24', description='Samsung phone', price=Decimal('900.00'), make_by='x',
+                rating=Decimal('4.0'), discount=Decimal('0.00'), stock=1,
+            )
+
+    def test_results_are_ranked_by_relevance(self):
+        response = self.client.get('/api/store/search/?q=gal&include_count=1')
+        ids = [product['id'] for product in response.json()['products']]
+        self.assertEqual(ids, [self.in_name.pk, self.in_description.pk])
+        self.assertEqual(response.json()['count'], 2)
+
+    def test_cursor_over_ranked_results(self):
+        first = self.client.get('/api/store/search/?q=galaxy&page_size=1').json()
+        second = self.client.get(first['next']).json()
+        self.assertEqual(first['products'][0]['id'], self.in_name.pk)
+        self.assertEqual(second['products'][0]['id'], self.in_description.pk)
+        self.assertIsNone(second['next'])
+
+    def test_index_follows_product_writes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.in_name.name = 'Pixel 9'
+            self.in_name.save()
+        response = self.client.get('/api/store/search/?q=pixel')
+        self.assertEqual([p['id'] for p in response.json()['products']], [self.in_name.pk])
+
+        self.in_name.delete()
+        cache.clear()
+        response = self.client.get('/api/store/search/?q=pixel')
+        self.assertEqual(response.json()['products'], [])
+
+    def test_index_is_updated_before_the_cache_bump(self):
+        from store.search import ranked_product_ids
+        seen = []
+        with patch('store.response_cache.bump_cache_tags', side_effect=lambda *tags: seen.append(ranked_product_ids('pixel', 10))):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.in_name.name = 'Pixel 9'
+                self.in_name.save()
+        self.assertEqual([product_id for product_id, _ in seen[0]], [self.in_name.pk])
+
+    def test_rebuild_command_swaps_in_the_index_and_invalidates_searches(self):
+        from django.core.management import call_command
+        self.assertEqual(self.client.get('/api/store/search/?q=pixel').json()['products'], [])
+        # Written without signals, so only the rebuild picks it up
+        Product.objects.filter(pk=self.in_name.pk).update(name='Pixel 9')
+        call_command('rebuild_search_index', chunk_size=1, stdout=StringIO())
+        response = self.client.get('/api/store/search/?q=pixel')
+        self.assertEqual([p['id'] for p in response.json()['products']], [self.in_name.pk])
+
+    def test_edits_during_a_rebuild_reach_the_new_index(self):
+        from store.search import SHADOW_TABLE, finish_rebuild, get_backend, index_products, start_rebuild
+        backend = get_backend()
+        start_rebuild(backend)
+        index_products([self.in_description.pk, self.in_name.pk], SHADOW_TABLE)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.in_name.name = 'Pixel 9'
+            self.in_name.save()
+        # Searches keep using the live table until the swap
+        self.assertEqual(len(self.client.get('/api/store/search/?q=pixel').json()['products']), 1)
+        finish_rebuild(backend)
+        cache.clear()
+        response = self.client.get('/api/store/search/?q=pixel')
+        self.assertEqual([p['id'] for p in response.json()['products']], [self.in_name.pk])
+
+
+class FacetCountTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.phones = create_catalog(product_count=2, colors_per_product=2, sizes_per_color=1)
+            self.other_category = Category.objects.create(name='Tablets', description='Tablets')
+            self.tablet = Product.objects.create(
+                name='Tablet', description='desc', price=Decimal('1500.00'), make_by='x',
+                rating=Decimal('4.0'), discount=Decimal('0.00'), stock=0, category=self.other_category,
+            )
+
+    def _counts(self, facets, name):
+        return {row['label']: row['count'] for row in facets[name]}
+
+    def test_counts_in_one_query(self):
+        from store.facets import facet_counts
+        with self.assertNumQueries(1):
+            facets = facet_counts(Product.objects.all())
+        self.assertEqual(self._counts(facets, 'category'), {'Phones': 2, 'Tablets': 1})
+        self.assertEqual(self._counts(facets, 'color'), {'Color 0': 2, 'Color 1': 2})
+        self.assertEqual(self._counts(facets, 'size'), {'Size 0': 2})
+        self.assertEqual(self._counts(facets, 'price'), {'100-250': 2, '1000-2000': 1})
+
+    def test_product_list_facets_respect_filters(self):
+        category = self.phones[0].category_id
+        data = self.client.get(f'/api/store/products/?facets=1&category_id={category}').json()
+        self.assertEqual(len(data['results']), 2)
+        self.assertEqual(self._counts(data['facets'], 'category'), {'Phones': 2})
+        self.assertEqual(self._counts(data['facets'], 'brand'), {'Apple': 2})
+
+        paginated = self.client.get('/api/store/products/?facets=1&page_size=1').json()
+        self.assertEqual(len(paginated['results']), 1)
+        self.assertEqual(self._counts(paginated['facets'], 'category'), {'Phones': 2, 'Tablets': 1})
+
+        # Without ?facets the list keeps its plain shape
+        self.assertIsInstance(self.client.get('/api/store/products/').json(), list)
+
+    def test_search_facets_cover_every_match(self):
+        data = self.client.get('/api/store/search/?q=product&facets=1&page_size=1').json()
+        self.assertEqual(len(data['products']), 1)
+        self.assertEqual(self._counts(data['facets'], 'category'), {'Phones': 2})
+
+        data = self.client.get(f'/api/store/search/?q=product&facets=1&category_id={self.other_category.pk}').json()
+        self.assertEqual(data['products'], [])
+        self.assertEqual(data['facets']['category'], [])
+
+    def test_index_follows_writes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.tablet.price = Decimal('50.00')
+            self.tablet.save()
+            ProductColorImage.objects.create(product=self.tablet, color=Color.objects.get(color_name='Color 0'))
+        self.other_category.name = 'Pads'
+        self.other_category.save()
+
+        from store.facets import facet_counts
+        facets = facet_counts(Product.objects.all())
+        self.assertEqual(self._counts(facets, 'category'), {'Phones': 2, 'Pads': 1})
+        self.assertEqual(self._counts(facets, 'color'), {'Color 0': 3, 'Color 1': 2})
+        self.assertEqual(self._counts(facets, 'price'), {'0-100': 1, '100-250': 2})
+
+        self.other_category.delete()
+        facets = facet_counts(Product.objects.all())
+        self.assertEqual(self._counts(facets, 'category'), {'Phones': 2})
+
+
+class AutocompleteTestCase(TestCase):
+
+    def setUp(self):
+        from store.autocomplete import autocomplete_index
+        cache.clear()
+        self.client = APIClient()
+        self.index = autocomplete_index
+        self.products = create_catalog(product_count=2, colors_per_product=1, sizes_per_color=1)
+        self.index.rebuild()
+
+    def _names(self, query):
+        response = self.client.get(f'/api/store/autocomplete/?q={query}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [suggestion['name'] for suggestion in response.json()['results']]
+
+    def test_prefix_lookup_without_queries(self):
+        with self.assertNumQueries(0):
+            suggestions = self.index.lookup('PROD')
+        self.assertEqual([s['name'] for s in suggestions], ['Product 0', 'Product 1'])
+        self.assertEqual(set(suggestions[0]), {'id', 'name', 'thumbnail'})
+        # Brand, category and inner words are indexed too
+        self.assertEqual(len(self.index.lookup('appl')), 2)
+        self.assertEqual(len(self.index.lookup('phon')), 2)
+        self.assertEqual([s['name'] for s in self.index.lookup('1')], ['Product 1'])
+
+    def test_ranked_by_popularity(self):
+        from store.popularity import record_sales
+        record_sales([(self.products[1].pk, None, None, 1)])
+        self.index.rebuild()
+        self.assertEqual(self._names('product'), ['Product 1', 'Product 0'])
+
+    def test_follows_product_writes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[0].name = 'Écran'
+            self.products[0].save()
+        self.assertEqual(self._names('ecr'), ['Écran'])
+        self.assertEqual(self._names('product'), ['Product 1'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[1].delete()
+        self.assertEqual(self._names('product'), [])
+
+    def _other_process(self):
+        from store.autocomplete import AutocompleteIndex
+        other = AutocompleteIndex()
+        other.rebuild()
+        return other
+
+    def test_other_processes_patch_only_the_changed_products(self):
+        other = self._other_process()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[0].name = 'Tablet'
+            self.products[0].save()
+        other._checked_at = 0
+        with patch.object(other, 'rebuild') as rebuild:
+            self.assertEqual([s['name'] for s in other.lookup('tab')], ['Tablet'])
+        rebuild.assert_not_called()
+        self.assertEqual([s['name'] for s in other.lookup('product')], ['Product 1'])
+
+    def test_gap_in_the_change_log_rebuilds(self):
+        from store.autocomplete import CHANGES_PREFIX, VERSION_KEY
+        other = self._other_process()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[0].name = 'Tablet'
+            self.products[0].save()
+        cache.delete(f'{CHANGES_PREFIX}{cache.get(VERSION_KEY)}')
+        other._checked_at = 0
+        with patch.object(other, 'rebuild', wraps=other.rebuild) as rebuild:
+            self.assertEqual([s['name'] for s in other.lookup('tab')], ['Tablet'])
+        rebuild.assert_called_once()
+
+    def test_rating_and_stock_saves_are_not_published(self):
+        from store.autocomplete import VERSION_KEY
+        version = cache.get(VERSION_KEY)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[0].rating = Decimal('3.0')
+            self.products[0].save(update_fields=['rating'])
+            self.products[0].color_images.first().update_stock()
+        self.assertEqual(cache.get(VERSION_KEY), version)
+
+class PopularityRankingTestCase(TestCase):
+
+    def setUp(self):
+        from store.models import Shop
+        cache.clear()
+        self.client = APIClient()
+        self.products = create_catalog(product_count=3, colors_per_product=1, sizes_per_color=1)
+        self.buyer = User.objects.create_user(username='buyer', password='password')
+        self.shop = Shop.objects.create(
+            name='Shop', address='x', owner=self.buyer, contact_email='shop@example.com', contact_phone='1',
+        )
+        Product.objects.update(created_by_shop=self.shop)
+        self.client.force_authenticate(self.buyer)
+
+    def _order(self, product, quantity):
+        response = self.client.post('/api/store/orders/', {
+            'user_id': self.buyer.pk,
+            'color_size_quantities': [{
+                'product_id': product.pk, 'color_name': 'Color 0', 'size_name': 'Size 0', 'quantity': quantity,
+            }],
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def _ids(self, url):
+        cache.clear()
+        return [product['id'] for product in self.client.get(url).json()]
+
+    def test_submit_cart_feeds_every_window_and_scope(self):
+        self._order(self.products[2], 1)
+        self._order(self.products[0], 3)
+        ranking = [self.products[0].pk, self.products[2].pk]
+        for window in ('24h', '7d', '30d'):
+            self.assertEqual(self._ids(f'/api/store/popular_products/?window={window}'), ranking)
+        self.assertEqual(self._ids(f'/api/store/popular_products/?shop={self.shop.pk}'), ranking)
+        category = self.products[0].category_id
+        self.assertEqual(self._ids(f'/api/store/popular_products/?category={category}'), ranking)
+        self.assertEqual(self._ids(f'/api/store/popular_products/?category={category + 1}'), [])
+        self.assertEqual(self.client.get('/api/store/popular_products/?window=1y').status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_recent_sales_outrank_older_ones(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from store.popularity import record_sales
+        now = timezone.now()
+        record_sales([(self.products[0].pk, None, None, 3)], at=now - timedelta(days=3))
+        record_sales([(self.products[1].pk, None, None, 1)], at=now)
+        self.assertEqual(self._ids('/api/store/popular_products/?window=24h')[0], self.products[1].pk)
+        self.assertEqual(self._ids('/api/store/popular_products/?window=30d')[0], self.products[0].pk)
+
+    def test_cursor_pages_and_compaction_keep_the_order(self):
+        from django.core.management import call_command
+        from store.popularity import record_sales
+        record_sales([(product.pk, None, None, index + 1) for index, product in enumerate(self.products)])
+        expected = [product.pk for product in reversed(self.products)]
+
+        first = self.client.get('/api/store/popular_products/?page_size=2').json()
+        second = self.client.get(first['next']).json()
+        self.assertEqual([p['id'] for p in first['results'] + second['results']], expected)
+
+        call_command('compact_popularity', stdout=StringIO())
+        self.assertEqual(self._ids('/api/store/popular_products/'), expected)
+
+    def test_overdue_window_is_left_for_the_command(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from store.models import PopularityEpoch, ProductPopularity
+        from store.popularity import MAX_EPOCH_AGE, get_epochs, record_sales
+        get_epochs()
+        overdue = timezone.now() - timedelta(hours=24) * (MAX_EPOCH_AGE + 1)
+        PopularityEpoch.objects.filter(window='24h').update(epoch=overdue)
+        with self.assertLogs('store.popularity', 'WARNING'):
+            record_sales([(self.products[0].pk, None, None, 1)])
+        self.assertEqual(PopularityEpoch.objects.get(window='24h').epoch, overdue)  # not compacted inline
+        self.assertEqual(set(ProductPopularity.objects.values_list('window', flat=True)), {'7d', '30d'})
+
+
+class SalesLeaderboardTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.products = create_catalog(product_count=3, colors_per_product=1, sizes_per_color=1)
+        self.category = self.products[0].category_id
+
+    def _ranking(self, query=''):
+        cache.clear()
+        response = self.client.get(f'/api/store/best_selling_products/{query}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [(product['id'], product['total_quantity_sold']) for product in response.json()]
+
+    def test_counters_per_scope_and_window(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from store.leaderboard import record_sales
+        now = timezone.now()
+        first, second, third = self.products
+        record_sales([(first.pk, 7, self.category, 2), (second.pk, 8, self.category, 1)], at=now)
+        record_sales([(second.pk, 8, self.category, 1)], at=now)
+        record_sales([(third.pk, 7, None, 9)], at=now - timedelta(days=10))
+
+        self.assertEqual(self._ranking(), [(third.pk, 9), (first.pk, 2), (second.pk, 2)])
+        self.assertEqual(self._ranking('?limit=1'), [(third.pk, 9)])
+        self.assertEqual(self._ranking('?window=7d'), [(first.pk, 2), (second.pk, 2)])
+        self.assertEqual(self._ranking('?window=30d&shop=7'), [(third.pk, 9), (first.pk, 2)])
+        self.assertEqual(self._ranking(f'?category={self.category}'), [(first.pk, 2), (second.pk, 2)])
+        self.assertEqual(self._ranking(f'?shop=7&category={self.category}'), [(first.pk, 2)])
+
+    def test_top_n_reads_a_fixed_number_of_queries(self):
+        from store.leaderboard import record_sales, top_products
+        record_sales([(product.pk, 1, self.category, 1) for product in self.products])
+        with self.assertNumQueries(3):
+            self.assertEqual(len(top_products(limit=5)), 3)
+
+    def test_bad_parameters(self):
+        self.assertEqual(self.client.get('/api/store/best_selling_products/?window=2y').status_code, 400)
+        self.assertEqual(self.client.get('/api/store/best_selling_products/?limit=x').status_code, 400)
+
+
+class CartPricingTestCase(TestCase):
+
+    def setUp(self):
+        from store.models import Shop, ShopInventory
+        cache.clear()
+        caches['carts'].clear()
+        self.client = committing(self, APIClient())
+        self.products = create_catalog(product_count=2, colors_per_product=1, sizes_per_color=1)
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.client.force_authenticate(self.user)
+        shop = Shop.objects.create(
+            name='Shop', address='x', owner=self.user, contact_email='shop@example.com', contact_phone='1',
+        )
+        Product.objects.filter(pk=self.products[1].pk).update(created_by_shop=shop)
+        ShopInventory.objects.create(shop=shop, product=self.products[1], custom_price=Decimal('80.00'))
+
+    def _add(self, product, quantity):
+        return self.client.post('/api/store/cart/', {
+            'product_id': product.pk,
+            'color_size_quantities': [{'color_name': 'Color 0', 'size_name': 'Size 0', 'quantity': quantity}],
+        }, format='json')
+
+    def _line(self, path, product):
+        return self.client.post(path, {
+            'product_id': product.pk, 'color_name': 'Color 0', 'size_name': 'Size 0',
+        }, format='json')
+
+    def test_totals_honour_discount_and_shop_override(self):
+        # 100 - 10% = 90; the shop sells the second product at 80 - 10% = 72
+        self.assertEqual(self._add(self.products[0], 2).json()['total_price'], '180.00')
+        self.assertEqual(self._add(self.products[1], 1).json()['total_price'], '252.00')
+        self.assertEqual(self._line('/api/store/cart/increment/', self.products[1]).json()['total_price'], '324.00')
+        self.assertEqual(self._line('/api/store/cart/decrement/', self.products[0]).json()['total_price'], '234.00')
+        self.assertEqual(self._line('/api/store/cart/remove/', self.products[1]).json()['total_price'], '90.00')
+
+    def test_edits_price_only_the_changed_lines(self):
+        from store.models import Cart
+        for store in ('DatabaseCartStore', 'CacheCartStore'):
+            Cart.objects.all().delete()
+            caches['carts'].clear()
+            Product.objects.filter(pk=self.products[0].pk).update(price=Decimal('100'))
+            with self.subTest(store=store), override_settings(CART_STORE=f'store.cart_store.{store}'):
+                self._add(self.products[0], 2)
+                Product.objects.filter(pk=self.products[0].pk).update(price=Decimal('200'))
+                # The first line keeps the price it was added at until the cart is read
+                self.assertEqual(self._add(self.products[1], 1).json()['total_price'], '252.00')
+                self.assertEqual(self._line('/api/store/cart/increment/', self.products[1]).json()['total_price'], '324.00')
+                self.assertEqual(self.client.get('/api/store/getcart/').json()['total_price'], '504.00')
+                self.assertEqual(self._line('/api/store/cart/decrement/', self.products[0]).json()['total_price'], '324.00')
+
+    def test_stored_total_is_one_query(self):
+        from django.core.management import call_command
+        from store.models import Cart
+        from store.pricing import cart_total
+        self._add(self.products[0], 1)
+        self._add(self.products[1], 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('persist_carts', stdout=StringIO())
+        cart = Cart.objects.get(customer__user=self.user)
+        self.assertEqual(cart.total_price, Decimal('162.00'))
+        with self.assertNumQueries(1):
+            self.assertEqual(cart_total(cart.pk), Decimal('162.00'))
+
+    def test_get_cart_picks_up_price_changes(self):
+        self._add(self.products[0], 1)
+        Product.objects.filter(pk=self.products[0].pk).update(price=Decimal('200.00'))
+        self.assertEqual(self.client.get('/api/store/getcart/').json()['total_price'], '180.00')
+
+
+class CartBatchTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        caches['carts'].clear()
+        self.client = APIClient()
+        self.products = create_catalog(product_count=2, colors_per_product=1, sizes_per_color=2)
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.client.force_authenticate(self.user)
+
+    def _batch(self, *operations):
+        return self.client.post('/api/store/cart/batch/', {'operations': list(operations)}, format='json')
+
+    def _op(self, op, product, size='Size 0', **extra):
+        return dict(op=op, product_id=product.pk, color_name='Color 0', size_name=size, **extra)
+
+    def test_operations_apply_in_order(self):
+        first, second = self.products
+        response = self._batch(
+            self._op('add', first, quantity=2),
+            self._op('increment', first),
+            self._op('add', second, size='Size 1', quantity=4),
+            self._op('decrement', second, size='Size 1'),
+            self._op('set', first, size='Size 1', quantity=1),
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        lines = {(item['product'], item['size_name']): item['quantity'] for item in data['cart_items']}
+        self.assertEqual(lines, {(first.pk, 'Size 0'): 3, (second.pk, 'Size 1'): 3, (first.pk, 'Size 1'): 1})
+        self.assertEqual(data['total_price'], '630.00')
+
+        data = self._batch(self._op('remove', first), self._op('set', second, size='Size 1', quantity=0)).json()
+        self.assertEqual([(item['product'], item['size_name']) for item in data['cart_items']], [(first.pk, 'Size 1')])
+        self.assertEqual(data['total_price'], '90.00')
+
+    def test_failed_batch_writes_nothing(self):
+        self._batch(self._op('add', self.products[0], quantity=2))
+        response = self._batch(
+            self._op('add', self.products[1], quantity=1),
+            self._op('add', self.products[0], quantity=4),
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('Not enough stock', response.json()['detail'])
+        lines = self.client.get('/api/store/getcart/').json()['cart_items']
+        self.assertEqual([(item['product'], item['quantity']) for item in lines], [(self.products[0].pk, 2)])
+
+        response = self._batch(self._op('decrement', self.products[1]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response.json()['operation'], 0)
+        self.assertEqual(self._batch(self._op('explode', self.products[1])).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_query_count_does_not_grow_with_operations(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        def queries(*operations):
+            with CaptureQueriesContext(connection) as ctx:
+                self.assertEqual(self._batch(*operations).status_code, status.HTTP_200_OK)
+            return len(ctx.captured_queries)
+
+        every_line = [(product, size) for product in self.products for size in ('Size 0', 'Size 1')]
+        queries(*[self._op('add', product, size=size) for product, size in every_line])
+        small = queries(self._op('set', self.products[0], quantity=2))
+        large = queries(*[self._op('set', product, size=size, quantity=2) for product, size in every_line])
+        self.assertEqual(small, large)
+
+
+@override_settings(CART_STORE='store.cart_store.CacheCartStore')
+class CartPruningTestCase(TestCase):
+
+    def setUp(self):
+        from store.models import Cart, CartItem
+        cache.clear()
+        caches['carts'].clear()
+        self.client = committing(self, APIClient())
+        self.products = create_catalog(product_count=10, colors_per_product=1, sizes_per_color=1)
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.client.force_authenticate(self.user)
+        cart = Cart.objects.create(customer=self.user.customerprofile, total_price=0)
+        color, size = Color.objects.get(), Size.objects.get()
+        CartItem.objects.bulk_create([
+            CartItem(cart=cart, product=product, color=color, size=size, quantity=2) for product in self.products
+        ])
+
+    def _stock(self, product, stock):
+        ProductColorSize.objects.filter(product_color_image__product=product).update(stock=stock)
+
+    def test_out_of_stock_lines_are_dropped_and_others_clamped(self):
+        self._stock(self.products[0], 0)
+        self._stock(self.products[1], 1)
+        ProductColorSize.objects.filter(product_color_image__product=self.products[2]).delete()
+
+        data = self.client.get('/api/store/getcart/').json()
+        lines = {item['product']: item['quantity'] for item in data['cart_items']}
+        self.assertEqual(len(lines), 8)
+        self.assertNotIn(self.products[0].pk, lines)
+        self.assertNotIn(self.products[2].pk, lines)
+        self.assertEqual(lines[self.products[1].pk], 1)
+        self.assertEqual(data['total_price'], '1350.00')  # 15 units at 90
+
+    def test_query_count_does_not_depend_on_cart_size(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        for product in self.products:
+            self._stock(product, 1)
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get('/api/store/getcart/')
+        self.assertLess(len(ctx.captured_queries), 12)
+
+
+@override_settings(CART_STORE='store.cart_store.CacheCartStore')
+class CartStoreTestCase(TestCase):
+
+    def setUp(self):
+        from store.models import Shop
+        cache.clear()
+        caches['carts'].clear()
+        self.client = committing(self, APIClient())
+        self.products = create_catalog(product_count=2, colors_per_product=1, sizes_per_color=1)
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.client.force_authenticate(self.user)
+        shop = Shop.objects.create(
+            name='Shop', address='x', owner=self.user, contact_email='shop@example.com', contact_phone='1',
+        )
+        Product.objects.update(created_by_shop=shop)
+
+    def _add(self, product, quantity=1):
+        return self.client.post('/api/store/cart/', {
+            'product_id': product.pk,
+            'color_size_quantities': [{'color_name': 'Color 0', 'size_name': 'Size 0', 'quantity': quantity}],
+        }, format='json')
+
+    def test_edits_stay_in_the_cache_until_persisted(self):
+        from django.core.management import call_command
+        from store.models import Cart, CartItem
+        self.assertEqual(self._add(self.products[0], 2).status_code, status.HTTP_201_CREATED)
+        self._add(self.products[1])
+        self.assertFalse(Cart.objects.exists())
+        self.assertEqual(self.client.get('/api/store/getcart/').json()['total_price'], '270.00')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('persist_carts', stdout=StringIO())
+        cart = Cart.objects.get(customer__user=self.user)
+        self.assertEqual(cart.total_price, Decimal('270.00'))
+        self.assertEqual(
+            sorted(CartItem.objects.values_list('product_id', 'quantity')),
+            [(self.products[0].pk, 2), (self.products[1].pk, 1)],
+        )
+
+        # Only carts changed since the last run are written again
+        self.client.post('/api/store/cart/remove/', {
+            'product_id': self.products[1].pk, 'color_name': 'Color 0', 'size_name': 'Size 0',
+        }, format='json')
+        self.assertEqual(CartItem.objects.count(), 2)
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('persist_carts', stdout=out)
+        self.assertIn('1 carts persisted', out.getvalue())
+        self.assertEqual(list(CartItem.objects.values_list('product_id', flat=True)), [self.products[0].pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('persist_carts', stdout=out)
+        self.assertIn('0 carts persisted', out.getvalue())
+
+    def test_checkout_persists_the_cart(self):
+        from store.models import CartItem
+        self._add(self.products[0], 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/store/orders/', {
+                'user_id': self.user.pk,
+                'color_size_quantities': [
+                    {'product_id': self.products[0].pk, 'color_name': 'Color 0', 'size_name': 'Size 0', 'quantity': 2},
+                ],
+            }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(list(CartItem.objects.values_list('quantity', flat=True)), [2])
+
+    def test_cache_miss_falls_back_to_the_tables(self):
+        from django.core.management import call_command
+        self._add(self.products[0], 3)
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('persist_carts', stdout=StringIO())
+        caches['carts'].clear()
+        lines = self.client.get('/api/store/getcart/').json()['cart_items']
+        self.assertEqual([(item['product'], item['size_name'], item['quantity']) for item in lines],
+                         [(self.products[0].pk, 'Size 0', 3)])
+
+    def test_refuses_caches_without_atomic_add_and_incr(self):
+        import tempfile
+        from django.conf import settings
+        from django.core.exceptions import ImproperlyConfigured
+        from store.cart_store import CacheCartStore, check_cart_store
+        files = {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': tempfile.mkdtemp(),
+        }
+        with override_settings(CACHES={**settings.CACHES, 'files': files}, CART_STORE_CACHE_ALIAS='files'):
+            with self.assertRaises(ImproperlyConfigured):
+                CacheCartStore()
+            self.assertEqual([error.id for error in check_cart_store(None)], ['store.E001'])
+        self.assertEqual(check_cart_store(None), [])
+
+    def test_concurrent_saves_are_all_persisted(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from store.cart_store import CacheCartStore, empty_state
+        from store.models import Cart
+        store = CacheCartStore()
+        customers = [
+            User.objects.create_user(username=f'shopper{index}', password='password').customerprofile.pk
+            for index in range(40)
+        ]
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(lambda customer_id: store.save(customer_id, empty_state()), customers))
+        # Every save got its own sequence number, none overwrote another's entry
+        self.assertEqual(store.cache.get(store.log_sequence_key), len(customers))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(store.persist_pending(batch_size=7), len(customers))
+        self.assertEqual(Cart.objects.count(), len(customers))
+
+    def test_late_run_still_persists_and_clears_the_log(self):
+        import time
+        from store.cart_store import CacheCartStore
+        from store.models import CartItem
+        store = CacheCartStore()
+        self._add(self.products[0], 2)
+        # persist_carts did not run for two days
+        with patch('django.core.cache.backends.locmem.time.time', return_value=time.time() + 2 * 24 * 3600):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(store.persist_pending(), 1)
+        self.assertEqual(list(CartItem.objects.values_list('quantity', flat=True)), [2])
+        self.assertIsNone(store.cache.get(store._log_key(1)))
+
+    def test_unwritten_log_entry_is_waited_for_once(self):
+        from store.cart_store import CacheCartStore
+        store = CacheCartStore()
+        customer_id = self.user.customerprofile.pk
+        store.cache.set(store.log_sequence_key, 2, timeout=None)  # 1 numbered, not written yet
+        store.cache.set(store._log_key(2), customer_id, timeout=None)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(store.persist_pending(), 0)
+        self.assertEqual(store.cache.get(store._log_key(2)), customer_id)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(store.persist_pending(), 1)  # the save died: skipped
+        self.assertEqual(store.cache.get(store.persisted_sequence_key), 2)
+
+    def test_database_store(self):
+        from django.test import override_settings
+        from store.models import CartItem
+        with override_settings(CART_STORE='store.cart_store.DatabaseCartStore'):
+            self._add(self.products[0], 2)
+            self.assertEqual(list(CartItem.objects.values_list('quantity', flat=True)), [2])
+            response = self.client.post('/api/store/cart/increment/', {
+                'product_id': self.products[0].pk, 'color_name': 'Color 0', 'size_name': 'Size 0',
+            }, format='json')
+            self.assertEqual(response.json()['total_price'], '270.00')
+            self.assertEqual(list(CartItem.objects.values_list('quantity', flat=True)), [3])
+            self.assertEqual(self.client.delete('/api/store/delete_cart/').status_code, status.HTTP_204_NO_CONTENT)
+            self.assertFalse(CartItem.objects.exists())
+
+
+class RefreshCartTotalsTestCase(TestCase):
+
+    def setUp(self):
+        from store.models import Cart, CartItem
+        products = create_catalog(product_count=2, colors_per_product=1, sizes_per_color=1)
+        color, size = Color.objects.get(), Size.objects.get()
+        self.carts = []
+        for index in range(3):
+            user = User.objects.create_user(username=f'buyer{index}', password='password')
+            cart = Cart.objects.create(customer=user.customerprofile, total_price=0)
+            CartItem.objects.bulk_create([
+                CartItem(cart=cart, product=products[0], color=color, size=size, quantity=3),
+                CartItem(cart=cart, product=products[1], color=color, size=size, quantity=1),
+            ])
+            self.carts.append(cart)
+
+    def test_totals_are_recomputed(self):
+        from django.core.management import call_command
+        from store.models import CommandCheckpoint
+        out = StringIO()
+        call_command('refresh_cart_totals', chunk_size=2, stdout=out)
+        self.assertIn('totals of 3 carts recomputed', out.getvalue())
+        for cart in self.carts:
+            cart.refresh_from_db()
+            self.assertEqual(cart.total_price, Decimal('360.00'))
+        self.assertFalse(CommandCheckpoint.objects.exists())
+
+    def test_resumes_after_the_checkpoint(self):
+        from django.core.management import call_command
+        from store.models import Cart, CommandCheckpoint
+        CommandCheckpoint.objects.create(name='refresh_cart_totals', position=self.carts[0].pk)
+        call_command('refresh_cart_totals', chunk_size=1, stdout=StringIO())
+        totals = list(Cart.objects.order_by('pk').values_list('total_price', flat=True))
+        self.assertEqual(totals, [Decimal('0'), Decimal('360.00'), Decimal('360.00')])
+
+    def test_duplicate_lines_are_rejected(self):
+        from django.db import IntegrityError
+        from store.models import CartItem
+        line = CartItem.objects.filter(cart=self.carts[0]).first()
+        with self.assertRaises(IntegrityError):
+            CartItem.objects.create(cart=line.cart, product=line.product, color=line.color, size=line.size)
+
+
+class CartUpsertTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.product = create_catalog(product_count=1, colors_per_product=1, sizes_per_color=1)[0]
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.client.force_authenticate(self.user)
+
+    def _add(self, quantity):
+        return self.client.post('/api/store/cart/', {
+            'product_id': self.product.pk,
+            'color_size_quantities': [{'color_name': 'Color 0', 'size_name': 'Size 0', 'quantity': quantity}],
+        }, format='json')
+
+    @override_settings(CART_STORE='store.cart_store.DatabaseCartStore')
+    def test_adds_increment_one_line_up_to_the_stock(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from store.models import CartItem
+        self.assertEqual(self._add(2).status_code, status.HTTP_201_CREATED)
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self._add(3).json()['cart_items'][0]['quantity'], 5)
+        writes = [query['sql'] for query in ctx.captured_queries if query['sql'].startswith(('UPDATE', 'INSERT'))]
+        self.assertEqual(len([sql for sql in writes if '"store_cartitem"' in sql.split(' WHERE ')[0]]), 1)
+
+        response = self._add(1)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('Available: 5, Requested: 1, In cart: 5', response.json()['detail'])
+        self.assertEqual(list(CartItem.objects.values_list('quantity', flat=True)), [5])
+
+    @override_settings(CART_STORE='store.cart_store.DatabaseCartStore')
+    def test_new_line_over_the_stock_is_refused(self):
+        from store.models import CartItem
+        self.assertEqual(self._add(6).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(CartItem.objects.exists())
+
+
+@override_settings(CART_STORE='store.cart_store.CacheCartStore')
+class CacheCartConcurrencyTestCase(TransactionTestCase):
+    """Adds from several workers at once: threads, each with its own connection."""
+
+    def setUp(self):
+        cache.clear()
+        caches['carts'].clear()
+        self.product = create_catalog(product_count=1, colors_per_product=1, sizes_per_color=1)[0]
+        self.customer_id = User.objects.create_user(username='buyer', password='password').customerprofile.pk
+        self.line_key = (self.product.pk, Color.objects.get().pk, Size.objects.get().pk)
+
+    def _add_concurrently(self, times, stock):
+        from concurrent.futures import ThreadPoolExecutor
+        from django.db import connection
+        from store.cart_store import CacheCartStore, NotEnoughStock
+        store = CacheCartStore()
+        store.load(self.customer_id)
+
+        def add(_):
+            try:
+                store.add_lines(self.customer_id, {self.line_key: {
+                    'quantity': 1, 'color_name': 'Color 0', 'size_name': 'Size 0', 'stock': stock,
+                }})
+                return True
+            except NotEnoughStock:
+                return False
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            added = sum(pool.map(add, range(times)))
+        return added, store.load(self.customer_id)
+
+    def test_no_increment_is_lost(self):
+        added, state = self._add_concurrently(40, stock=100)
+        self.assertEqual(added, 40)
+        self.assertEqual(state['lines'][self.line_key]['quantity'], 40)
+        self.assertEqual(state['total'], Decimal('3600.00'))
+
+    def test_adds_stop_at_the_stock(self):
+        added, state = self._add_concurrently(20, stock=5)
+        self.assertEqual(added, 5)
+        self.assertEqual(state['lines'][self.line_key]['quantity'], 5)
+
+
+class ReferenceDataTestCase(TestCase):
+
+    def setUp(self):
+        from store.models import Shop
+        cache.clear()
+        caches['carts'].clear()
+        self.client = APIClient()
+        self.products = create_catalog(product_count=2, colors_per_product=2, sizes_per_color=2)
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.client.force_authenticate(self.user)
+        shop = Shop.objects.create(
+            name='Shop', address='x', owner=self.user, contact_email='shop@example.com', contact_phone='1',
+        )
+        Product.objects.update(created_by_shop=shop)
+
+    def test_lookups_do_not_query_once_loaded(self):
+        from store.reference_data import reference_data
+        color, size = Color.objects.get(color_name='Color 1'), Size.objects.get(name='Size 1')
+        reference_data.get()
+        with self.assertNumQueries(0):
+            self.assertEqual(reference_data.color_ids('Color 1'), [color.pk])
+            self.assertEqual(reference_data.size_id('size 1', ignore_case=True), size.pk)
+            self.assertEqual(reference_data.color(color.pk).code, color.color_code)
+
+    def test_writes_invalidate_the_copy(self):
+        from store.reference_data import reference_data
+        reference_data.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            color = Color.objects.create(color_name='Teal', color_code='#008080')
+        self.assertEqual(reference_data.color_ids('Teal'), [color.pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            Size.objects.filter(name='Size 1').delete()
+            Size.objects.create(name='XL')
+        self.assertIsNotNone(reference_data.size_id('XL'))
+
+    def test_cart_and_checkout_do_not_read_reference_tables(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from store.reference_data import reference_data
+        line = {'color_name': 'Color 1', 'size_name': 'Size 1', 'quantity': 1}
+        reference_data.get()
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.post('/api/store/cart/', {
+                'product_id': self.products[0].pk, 'color_size_quantities': [line],
+            }, format='json')
+            self.client.post('/api/store/cart/increment/', dict(line, product_id=self.products[0].pk), format='json')
+            self.client.get('/api/store/getcart/')
+            # Read models refreshed after commit are not part of the request
+            response = self.client.post('/api/store/orders/', {
+                'user_id': self.user.pk, 'color_size_quantities': [dict(line, product_id=self.products[1].pk)],
+            }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        for table in ('store_color', 'store_size', 'store_category', 'store_brand', 'store_devicemodel'):
+            self.assertFalse(
+                [query['sql'] for query in ctx.captured_queries if f'"{table}"' in query['sql']], table
+            )
+
+
+class CartAndOrderAdminTestCase(TestCase):
+
+    def setUp(self):
+        from store.models import Cart, CartItem, Order, OrderItem
+        cache.clear()
+        self.products = create_catalog(product_count=3, colors_per_product=1, sizes_per_color=1)
+        self.admin = User.objects.create_superuser(username='admin', password='password', email='admin@example.com')
+        self.client.force_login(self.admin)
+        self.color, self.size = Color.objects.get(), Size.objects.get()
+        for index in range(3):
+            customer = User.objects.create_user(username=f'buyer{index}', password='password').customerprofile
+            cart = Cart.objects.create(customer=customer, total_price=0)
+            order = Order.objects.create(customer=customer, total_price=0)
+            for product in self.products[:index + 1]:
+                CartItem.objects.create(cart=cart, product=product, color=self.color, size=self.size)
+                OrderItem.objects.create(order=order, product=product, color=self.color, size=self.size)
+        self.cart, self.order = cart, order
+
+    def test_cart_save_reads_no_relations(self):
+        with self.assertNumQueries(1):
+            self.cart.save()
+
+    def test_line_summaries(self):
+        from store.models import Cart, Order
+        from store.reference_data import reference_data
+        reference_data.get()
+        cart = Cart.objects.prefetch_related('cart_items__product').get(pk=self.cart.pk)
+        order = Order.objects.prefetch_related('order_items').get(pk=self.order.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(cart.get_product_description(), 'Product 0, Product 1, Product 2')
+            self.assertEqual(cart.get_cart_sizes(), 'Size 0, Size 0, Size 0')
+            self.assertEqual(order.get_order_colors(), 'Color 0, Color 0, Color 0')
+            self.assertEqual(order.get_order_sizes(), 'Size 0, Size 0, Size 0')
+
+    def test_changelists_do_not_query_per_row(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        for url in ('/admin/api/store/cart/', '/admin/api/store/order/'):
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, 'Product 0, Product 1')
+            self.assertLess(len(ctx.captured_queries), 15, url)
+
+
+class CheckoutPipelineTestCase(TestCase):
+
+    def setUp(self):
+        from store.models import Shop
+        cache.clear()
+        caches['carts'].clear()
+        self.client = APIClient()
+        self.products = create_catalog(product_count=3, colors_per_product=2, sizes_per_color=2)
+        self.buyer = User.objects.create_user(username='buyer', password='password')
+        shop = Shop.objects.create(
+            name='Shop', address='x', owner=self.buyer, contact_email='shop@example.com', contact_phone='1',
+        )
+        Product.objects.update(created_by_shop=shop)
+        self.client.force_authenticate(self.buyer)
+
+    def _submit(self, lines):
+        return self.client.post('/api/store/orders/', {
+            'user_id': self.buyer.pk,
+            'color_size_quantities': [
+                {'product_id': product.pk, 'color_name': color, 'size_name': size, 'quantity': quantity}
+                for product, color, size, quantity in lines
+            ],
+        }, format='json')
+
+    def _checkout_queries(self, lines):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as ctx:
+            response = self._submit(lines)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.content)
+        return len(ctx.captured_queries)
+
+    def test_query_count_does_not_grow_with_lines(self):
+        from store.reference_data import reference_data
+        reference_data.get()
+        self._submit([(self.products[0], 'Color 0', 'Size 0', 1)])  # customer profile and order exist
+        # Both checkouts merge into an ordered line and add new ones
+        few_lines = self._checkout_queries([
+            (self.products[0], 'Color 0', 'Size 0', 1), (self.products[2], 'Color 0', 'Size 0', 1),
+        ])
+        many_lines = self._checkout_queries([
+            (product, f'Color {c}', f'Size {s}', 1)
+            for product in self.products[:2] for c in range(2) for s in range(2)
+        ] + [(self.products[2], 'Color 1', 'Size 1', 1)])
+        self.assertEqual(few_lines, many_lines)
+
+    def test_stock_and_order_lines_merge(self):
+        from store.models import OrderItem
+        product = self.products[0]
+        response = self._submit([(product, 'Color 0', 'Size 0', 2), (product, 'Color 0', 'size 0', 1)])
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.content)
+        self._submit([(product, 'Color 0', 'Size 0', 1)])
+        self.assertEqual(ProductColorSize.objects.get(
+            product_color_image__product=product, product_color_image__color__color_name='Color 0', size__name='Size 0',
+        ).stock, 1)
+        item = OrderItem.objects.get(order__customer__user=self.buyer)
+        self.assertEqual(item.quantity, 4)
+        self.assertEqual(item.order.total_price, Decimal('90.00'))
+
+    def test_shortage_writes_nothing(self):
+        from store.models import Order
+        response = self._submit([
+            (self.products[0], 'Color 0', 'Size 0', 1), (self.products[1], 'Color 0', 'Size 0', 6),
+        ])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('Available: 5, requested: 6', response.json()['detail'])
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(set(ProductColorSize.objects.values_list('stock', flat=True)), {5})
+
+
+class StockReservationTestCase(TestCase):
+
+    def setUp(self):
+        from store.models import Shop
+        cache.clear()
+        caches['carts'].clear()
+        self.client = APIClient()
+        self.product = create_catalog(product_count=1, colors_per_product=1, sizes_per_color=1)[0]
+        self.buyer = User.objects.create_user(username='buyer', password='password')
+        shop = Shop.objects.create(
+            name='Shop', address='x', owner=self.buyer, contact_email='shop@example.com', contact_phone='1',
+        )
+        Product.objects.update(created_by_shop=shop)
+        self.client.force_authenticate(self.buyer)
+
+    def _items(self, quantity):
+        return [{'product_id': self.product.pk, 'color_name': 'Color 0', 'size_name': 'Size 0', 'quantity': quantity}]
+
+    def _start(self, quantity, client=None):
+        return (client or self.client).post(
+            '/api/store/checkout/start/', {'color_size_quantities': self._items(quantity)}, format='json',
+        )
+
+    def _stock(self):
+        return ProductColorSize.objects.get().stock
+
+    def test_holds_take_stock_until_checkout(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from store.models import StockReservation
+        self.assertEqual(self._start(3).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self._stock(), 2)
+
+        other = APIClient()
+        other.force_authenticate(User.objects.create_user(username='other', password='password'))
+        response = self._start(3, other)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('Available: 2, requested: 3', response.json()['detail'])
+
+        # Starting again only takes or gives back the difference
+        self._start(4)
+        self.assertEqual(self._stock(), 1)
+        self._start(2)
+        self.assertEqual(self._stock(), 3)
+
+        # The checkout uses the hold and leaves the stock rows alone
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(
+                '/api/store/orders/', {'user_id': self.buyer.pk, 'color_size_quantities': self._items(2)}, format='json',
+            )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertFalse([q for q in ctx.captured_queries if q['sql'].startswith('UPDATE "store_productcolorsize"')])
+        self.assertEqual(self._stock(), 3)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_checkout_beyond_the_hold_takes_the_rest_from_stock(self):
+        self._start(1)
+        response = self.client.post(
+            '/api/store/orders/', {'user_id': self.buyer.pk, 'color_size_quantities': self._items(3)}, format='json',
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self._stock(), 2)
+
+    def test_expired_and_abandoned_holds_go_back(self):
+        from datetime import timedelta
+        from django.core.management import call_command
+        from django.utils import timezone
+        from store.models import StockReservation
+        self._start(3)
+        call_command('release_stock_reservations', stdout=StringIO())
+        self.assertEqual(self._stock(), 2)
+        StockReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        call_command('release_stock_reservations', stdout=StringIO())
+        self.assertEqual(self._stock(), 5)
+        self.assertFalse(StockReservation.objects.exists())
+
+        self._start(5)
+        self.assertEqual(self.client.delete('/api/store/checkout/start/').status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self._stock(), 5)
+
+
+class StockRollupTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.product = create_catalog(product_count=1, colors_per_product=1, sizes_per_color=1)[0]
+
+    def test_each_parent_is_summed_once_after_commit(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        colors = [Color.objects.create(color_name=f'Extra {i}', color_code='#ffffff') for i in range(3)]
+        sizes = [Size.objects.create(name=f'Extra {i}') for i in range(4)]
+        with CaptureQueriesContext(connection) as ctx:
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                for color in colors:
+                    color_image = ProductColorImage.objects.create(product=self.product, color=color)
+                    for size in sizes:
+                        ProductColorSize.objects.create(product_color_image=color_image, size=size, stock=2)
+                # Nothing is summed before the commit
+                self.assertEqual(Product.objects.get(pk=self.product.pk).stock, 0)
+        self.assertTrue(callbacks)
+
+        rollups = [q['sql'] for q in ctx.captured_queries
+                   if q['sql'].startswith(('UPDATE "store_product" ', 'UPDATE "store_productcolorimage" '))]
+        self.assertEqual(len(rollups), 2)
+        self.assertEqual(set(ProductColorImage.objects.filter(color__in=colors).values_list('stock', flat=True)), {8})
+        self.assertEqual(Product.objects.get(pk=self.product.pk).stock, 5 + 24)
+
+    def test_checkout_rolls_stock_up(self):
+        from store.models import Shop
+        buyer = User.objects.create_user(username='buyer', password='password')
+        shop = Shop.objects.create(
+            name='Shop', address='x', owner=buyer, contact_email='shop@example.com', contact_phone='1',
+        )
+        Product.objects.update(created_by_shop=shop)
+        client = APIClient()
+        client.force_authenticate(buyer)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post('/api/store/orders/', {'user_id': buyer.pk, 'color_size_quantities': [
+                {'product_id': self.product.pk, 'color_name': 'Color 0', 'size_name': 'Size 0', 'quantity': 2},
+            ]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(ProductColorImage.objects.get(product=self.product).stock, 3)
+        self.assertEqual(Product.objects.get(pk=self.product.pk).stock, 3)
+
+
+class IdempotencyKeyTestCase(TestCase):
+
+    def setUp(self):
+        from store.models import Shop
+        cache.clear()
+        caches['carts'].clear()
+        self.client = APIClient()
+        self.product = create_catalog(product_count=1, colors_per_product=1, sizes_per_color=1)[0]
+        self.buyer = User.objects.create_user(username='buyer', password='password')
+        shop = Shop.objects.create(
+            name='Shop', address='x', owner=self.buyer, contact_email='shop@example.com', contact_phone='1',
+        )
+        Product.objects.update(created_by_shop=shop)
+        self.client.force_authenticate(self.buyer)
+
+    def _submit(self, quantity, key):
+        return self.client.post('/api/store/orders/', {'user_id': self.buyer.pk, 'color_size_quantities': [
+            {'product_id': self.product.pk, 'color_name': 'Color 0', 'size_name': 'Size 0', 'quantity': quantity},
+        ]}, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retried_checkout_is_replayed(self):
+        from store.models import OrderItem
+        first = self._submit(2, 'checkout-1')
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        with self.assertNumQueries(1):
+            retry = self._submit(2, 'checkout-1')
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(ProductColorSize.objects.get().stock, 3)
+        self.assertEqual(OrderItem.objects.get().quantity, 2)
+
+        self.assertEqual(self._submit(1, 'checkout-1').status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(self._submit(1, 'checkout-2').status_code, status.HTTP_201_CREATED)
+        self.assertEqual(OrderItem.objects.get().quantity, 3)
+
+    def test_failed_request_gives_the_key_back(self):
+        self.assertEqual(self._submit(6, 'checkout-1').status_code, status.HTTP_400_BAD_REQUEST)
+        ProductColorSize.objects.update(stock=6)
+        self.assertEqual(self._submit(6, 'checkout-1').status_code, status.HTTP_201_CREATED)
+
+    def test_cart_edits_and_expiry(self):
+        from datetime import timedelta
+        from django.core.management import call_command
+        from django.utils import timezone
+        from store.models import IdempotencyKey
+        add = {'product_id': self.product.pk, 'color_size_quantities': [
+            {'color_name': 'Color 0', 'size_name': 'Size 0', 'quantity': 1},
+        ]}
+        for _ in range(2):
+            response = self.client.post('/api/store/cart/', add, format='json', HTTP_IDEMPOTENCY_KEY='add-1')
+        self.assertEqual(response.json()['cart_items'][0]['quantity'], 1)
+        # Without a key every request runs
+        response = self.client.post('/api/store/cart/', add, format='json')
+        self.assertEqual(response.json()['cart_items'][0]['quantity'], 2)
+
+        IdempotencyKey.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        call_command('purge_idempotency_keys', stdout=StringIO())
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+
+@override_settings(CART_STORE='store.cart_store.CacheCartStore')
+class IdempotentCacheCartTestCase(TransactionTestCase):
+    """Cart edits through CacheCartStore when storing the idempotent response fails."""
+
+    def setUp(self):
+        cache.clear()
+        caches['carts'].clear()
+        self.client = APIClient(raise_request_exception=False)
+        self.product = create_catalog(product_count=1, colors_per_product=1, sizes_per_color=1)[0]
+        self.buyer = User.objects.create_user(username='buyer', password='password')
+        self.client.force_authenticate(self.buyer)
+
+    def _add(self, key):
+        return self.client.post('/api/store/cart/', {'product_id': self.product.pk, 'color_size_quantities': [
+            {'color_name': 'Color 0', 'size_name': 'Size 0', 'quantity': 1},
+        ]}, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def _failing_saves(self, count):
+        from django.db import OperationalError
+        from store.models import IdempotencyKey
+        save = IdempotencyKey.save
+        failures = [OperationalError('database is locked')] * count
+
+        def failing_save(record, *args, **kwargs):
+            if kwargs.get('update_fields') and failures:
+                raise failures.pop()
+            return save(record, *args, **kwargs)
+        return patch.object(IdempotencyKey, 'save', failing_save)
+
+    def _quantity(self):
+        from store.cart_store import CacheCartStore
+        lines = CacheCartStore().load(self.buyer.customerprofile.pk)['lines']
+        return sum(line['quantity'] for line in lines.values())
+
+    @patch('store.cart_store.CacheCartStore.lock_timeout', 0.2)
+    def test_rerun_after_a_conflict_applies_the_edit_once(self):
+        with self._failing_saves(1), patch('store.retry.time.sleep'):
+            response = self._add('add-1')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self._quantity(), 1)
+        self.assertEqual(self._add('add-1')['Idempotent-Replayed'], 'true')
+        self.assertEqual(self._quantity(), 1)
+
+    @patch('store.cart_store.CacheCartStore.lock_timeout', 0.2)
+    def test_retry_after_a_failed_save_applies_the_edit_once(self):
+        from store.retry import ATTEMPTS
+        with self._failing_saves(ATTEMPTS), patch('store.retry.time.sleep'):
+            self.assertEqual(self._add('add-1').status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertEqual(self._quantity(), 0)
+        self.assertEqual(self._add('add-1').status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self._quantity(), 1)
+
+
+class ConditionalStockTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        create_catalog(product_count=1, colors_per_product=1, sizes_per_color=2)
+        self.skus = [(row.product_color_image_id, row.pk) for row in ProductColorSize.objects.order_by('pk')]
+
+    def test_take_is_all_or_nothing(self):
+        from store.models import StockMovement
+        from store.stock import take
+        with self.assertNumQueries(4):  # savepoint, UPDATE, release, ledger INSERT
+            self.assertEqual(take({self.skus[0]: 2, self.skus[1]: 5}, StockMovement.Reason.SALE), {})
+        self.assertEqual(take({self.skus[0]: 1, self.skus[1]: 1}, StockMovement.Reason.SALE), {self.skus[1]: 0})
+        self.assertEqual(list(ProductColorSize.objects.order_by('pk').values_list('stock', flat=True)), [3, 0])
+
+    def test_negative_stock_is_refused_by_the_database(self):
+        from django.db import IntegrityError, transaction
+        from django.db.models import F
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            ProductColorSize.objects.update(stock=F('stock') - 6)
+
+    def test_conflicts_are_retried_with_backoff(self):
+        from django.db import OperationalError
+        from store.retry import retry_on_conflict
+        calls = []
+
+        @retry_on_conflict
+        def checkout():
+            calls.append(1)
+            if len(calls) < 3:
+                raise OperationalError('database is locked')
+            return 'done'
+
+        with patch('store.retry.time.sleep') as sleep, \
+                patch('store.retry.transaction.get_connection') as get_connection:
+            get_connection.return_value.in_atomic_block = False
+            self.assertEqual(checkout(), 'done')
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(sleep.call_count, 2)
+
+        # Inside a transaction the caller owns, nothing is retried
+        calls.clear()
+        with self.assertRaises(OperationalError):
+            checkout()
+        self.assertEqual(len(calls), 1)
+
+
+class StockLedgerTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        create_catalog(product_count=1, colors_per_product=1, sizes_per_color=2)
+        self.rows = list(ProductColorSize.objects.order_by('pk'))
+        self.skus = [(row.product_color_image_id, row.pk) for row in self.rows]
+
+    def test_every_stock_change_is_recorded(self):
+        from store.ledger import ledger_stock
+        from store.models import StockMovement
+        from store.stock import give_back, take
+        row = ProductColorSize.objects.get(pk=self.rows[0].pk)
+        row.stock = 8
+        row.save()
+        take({self.skus[0]: 3, self.skus[1]: 1}, StockMovement.Reason.SALE)
+        give_back({self.skus[1]: 1}, StockMovement.Reason.RETURN)
+
+        self.assertEqual(
+            list(StockMovement.objects.filter(product_color_size=row).order_by('pk').values_list('reason', 'change')),
+            [('restock', 5), ('adjustment', 3), ('sale', -3)],
+        )
+        stock = dict(ProductColorSize.objects.values_list('pk', 'stock'))
+        self.assertEqual(ledger_stock(self.skus), {sku: stock[sku[1]] for sku in self.skus})
+
+    def test_edit_after_a_sale_records_the_actual_change(self):
+        from store.ledger import ledger_stock
+        from store.models import StockMovement
+        from store.stock import take
+        row = ProductColorSize.objects.get(pk=self.rows[0].pk)  # loaded with stock 5
+        take({self.skus[0]: 2}, StockMovement.Reason.SALE)
+        row.stock = 8
+        row.save()
+        self.assertEqual(
+            list(StockMovement.objects.filter(product_color_size=row).order_by('pk').values_list('reason', 'change')),
+            [('restock', 5), ('sale', -2), ('adjustment', 5)],
+        )
+        self.assertEqual(ledger_stock([self.skus[0]]), {self.skus[0]: 8})
+
+    def test_latest_snapshot_lookup_uses_the_index(self):
+        from django.db import connection
+        from django.db.models import OuterRef, Subquery
+        from store.models import StockSnapshot
+        if connection.vendor != 'sqlite':
+            self.skipTest('SQLite query plan')
+        latest = StockSnapshot.objects.filter(
+            product_color_size=OuterRef('product_color_size'),
+        ).order_by('-last_movement_id').values('pk')[:1]
+        plan = StockSnapshot.objects.filter(product_color_size__in=[self.skus[0][1]], pk=Subquery(latest)).explain()
+        self.assertIn('snapshot_size_latest', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_snapshots_and_point_in_time(self):
+        from datetime import timedelta
+        from django.core.management import call_command
+        from django.utils import timezone
+        from store.ledger import compact, ledger_stock, record
+        from store.models import StockMovement, StockSnapshot
+        sku = self.skus[0]
+        now = timezone.now()
+        StockMovement.objects.update(created_at=now - timedelta(days=3))
+        record({sku: -2}, StockMovement.Reason.SALE, at=now - timedelta(days=2))
+        record({sku: 4}, StockMovement.Reason.RESTOCK, at=now - timedelta(days=1))
+
+        self.assertEqual(compact(), 2)
+        self.assertEqual(compact(), 0)  # nothing new
+        record({sku: -1}, StockMovement.Reason.SALE)
+
+        with self.assertNumQueries(2):  # one snapshot lookup for sized SKUs, one tail sum
+            self.assertEqual(ledger_stock([sku]), {sku: 6})
+        self.assertEqual(ledger_stock([sku], at=now - timedelta(hours=36)), {sku: 3})
+        self.assertEqual(ledger_stock([sku], at=now - timedelta(days=4)), {sku: 0})
+
+        record({sku: 2}, StockMovement.Reason.RESTOCK, at=now - timedelta(minutes=5))
+        call_command('compact_stock_ledger', stdout=StringIO())
+        self.assertEqual(StockSnapshot.objects.filter(product_color_size_id=sku[1]).count(), 2)
+        self.assertEqual(ledger_stock([sku]), {sku: 8})
+
+        call_command('compact_stock_ledger', '--rebuild', stdout=StringIO())
+        self.assertEqual(ledger_stock([sku]), {sku: 8})
+        self.assertEqual(ledger_stock([sku], at=now - timedelta(hours=36)), {sku: 3})
+
+
+class EffectivePriceTestCase(TestCase):
+
+    def setUp(self):
+        from store.models import Shop, ShopInventory
+        cache.clear()
+        caches['carts'].clear()
+        self.client = APIClient()
+        self.products = create_catalog(product_count=3, colors_per_product=1, sizes_per_color=1)
+        self.buyer = User.objects.create_user(username='buyer', password='password')
+        self.shop = Shop.objects.create(
+            name='Shop', address='x', owner=self.buyer, contact_email='shop@example.com', contact_phone='1',
+        )
+        Product.objects.update(created_by_shop=self.shop)
+        self.inventory = ShopInventory.objects.create(
+            shop=self.shop, product=self.products[0], custom_price=Decimal('200'), custom_discount=Decimal('50'),
+        )
+
+    def test_one_query_for_many_products_and_memoized(self):
+        from store.pricing import effective_prices, price_memo
+        pks = [product.pk for product in self.products]
+        with price_memo():
+            with self.assertNumQueries(1):
+                prices = effective_prices(pks)
+            with self.assertNumQueries(0):
+                self.assertEqual(effective_prices(pks), prices)
+            self.inventory.custom_discount = Decimal('25')
+            self.inventory.save()
+            with self.assertNumQueries(1):  # the save dropped the memo
+                self.assertEqual(effective_prices(pks[:1])[pks[0]].final_price, Decimal('150.00'))
+        self.assertEqual(prices[pks[0]].final_price, Decimal('100.00'))
+        self.assertEqual(prices[pks[0]].stock, Product.objects.get(pk=pks[0]).stock)  # no stock override
+        self.assertEqual(prices[pks[1]].final_price, Decimal('90.00'))
+
+    def test_catalog_and_checkout_use_overrides(self):
+        from store.models import Order
+        cards = {card['id']: card for card in self.client.get('/api/store/products/').json()}
+        self.assertEqual(Decimal(cards[self.products[0].pk]['final_price']), Decimal('100.00'))
+        self.assertEqual(Decimal(cards[self.products[1].pk]['final_price']), Decimal('90.00'))
+
+        self.client.force_authenticate(self.buyer)
+        response = self.client.post('/api/store/orders/', {
+            'user_id': self.buyer.pk,
+            'color_size_quantities': [
+                {'product_id': product.pk, 'color_name': 'Color 0', 'size_name': 'Size 0', 'quantity': 1}
+                for product in self.products[:2]
+            ],
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.content)
+        self.assertEqual(Order.objects.get().total_price, Decimal('190.00'))
+
+    def test_cards_documents_facets_and_ordering_use_overrides(self):
+        from store.models import ProductFacet
+        self.inventory.custom_price = Decimal('300')
+        self.inventory.custom_stock = 7
+        with self.captureOnCommitCallbacks(execute=True):
+            self.inventory.save()
+        pk = self.products[0].pk
+        expected = (Decimal('300.00'), Decimal('50.00'), 7, Decimal('150.00'))
+
+        card = {card['id']: card for card in self.client.get('/api/store/products/').json()}[pk]
+        detail = self.client.get(f'/api/store/products/{pk}/').json()
+        for data in (card, detail):
+            self.assertEqual(
+                (Decimal(data['price']), Decimal(data['discount']), data['stock'], Decimal(data['final_price'])),
+                expected,
+            )
+
+        response = self.client.get('/api/store/products/?ordering=-price&page_size=1').json()
+        self.assertEqual(response['results'][0]['id'], pk)
+        second = self.client.get(response['next']).json()
+        self.assertNotEqual(second['results'][0]['id'], pk)
+        self.assertEqual(ProductFacet.objects.get(product_id=pk, name='price').value, 250)
+
+    def test_cart_total_uses_overrides(self):
+        from store.models import Cart, CartItem
+        from store.pricing import cart_total
+        cart = Cart.objects.create(customer=self.buyer.customerprofile, total_price=0)
+        for product in self.products[:2]:
+            CartItem.objects.create(cart=cart, product=product, color=product.color_images.first().color, quantity=2)
+        self.assertEqual(cart_total(cart.pk), Decimal('380.00'))
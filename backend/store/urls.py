@@ -40,13 +40,16 @@ urlpatterns = [
     path('cart/remove/', views.remove_from_cart, name='remove-from-cart'),
     path('cart/increment/', views.increment_quantity, name='increment-quantity'),
     path('cart/decrement/', views.decrement_quantity, name='decrement-quantity'),
+    path('cart/batch/', views.cart_batch, name='cart-batch'),
     path('delete_cart/', views.delete_cart, name='delete_cart'),
+    path('checkout/start/', views.start_checkout, name='start_checkout'),
     path('orders/', submit_cart, name='submit_cart'),
     path('popular_products/', views.popular_products, name='popular-products'),
     path('wishlists/', WishlistList.as_view(), name='wishlist-list'),
     path('wishlists/user/<int:user_id>/', WishlistDetail.as_view(), name='wishlist-detail'),
     path('best_selling_products/', views.best_selling_products, name='best_selling_products'),
     path('search/', views.search_products, name='search_product'),
+    path('autocomplete/', views.autocomplete_products, name='autocomplete_products'),
     path('checkorder/', views.order_history, name='order_history'),
     path('checkorder/<int:order_id>/', OrderDetailView.as_view(), name='checkorder'),
     path('products/<int:product_id>/color-images/', ProductColorImagesView.as_view(), name='product-color-images'),
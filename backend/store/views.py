@@ -1,7 +1,6 @@
 # products/views.py
 from contextvars import Token
 from decimal import Decimal
-from itertools import count
 import logging
 from django.forms import DecimalField
 from django.views.decorators.csrf import csrf_exempt
@@ -14,7 +13,7 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.generics import ListCreateAPIView, RetrieveAPIView
 from .models import Banner, Brand, Cart, CartItem, Category, Color, CustomerProfile, DeviceModel, Order, OrderItem, Product, ProductColorImage, ProductColorSize, Reply, Review, Size, Wishlist
-from .serializers import BannerSerializer, BestSellingProductSerializer, BrandSerializer, CartItemSerializer, CartSerializer, CategorySerializer, ColorSerializer, CustomerProfileSerializer, DeviceModelSerializer, OrderSerializer, ProductColorImageSerializer, ProductSerializer, ReplySerializer, ReviewSerializer, SizeSerializer, UserRegistrationSerializer, WishlistSerializer
+from .serializers import BannerSerializer, BestSellingProductSerializer, BrandSerializer, CartItemSerializer, CartSerializer, CategorySerializer, ColorSerializer, CustomerProfileSerializer, DeviceModelSerializer, OrderSerializer, ProductCardSerializer, ProductColorImageSerializer, ProductSerializer, ReplySerializer, ReviewSerializer, SizeSerializer, UserRegistrationSerializer, WishlistSerializer
 from django.http import JsonResponse
 from rest_framework import viewsets
 from rest_framework.decorators import action
@@ -28,8 +27,21 @@ from django.contrib.auth import authenticate
 from rest_framework.test import APIClient
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.exceptions import TokenError, InvalidToken
-from django.core.paginator import Paginator
-from django.db.models import Sum, F, ExpressionWrapper, DecimalField
+from .documents import get_product_document
+from .response_cache import PRODUCT_TAGS, CachedResponseMixin, cache_response
+from .search import matching_products, search_index_available
+from .facets import catalog_filters, facet_counts, facets_requested
+from .autocomplete import autocomplete_index
+from .cart_store import CartBusy, get_cart_store
+from .checkout import CheckoutError, place_orders, reserve_checkout
+from .idempotency import idempotent
+from . import reservations
+from .carts import CartOperationError, apply_cart_operations, cart_snapshot, current_cart
+from .popularity import CATEGORY, DEFAULT_WINDOW, GLOBAL, SHOP, WINDOWS as POPULARITY_WINDOWS, ranked_products
+from . import leaderboard
+from .leaderboard import DEFAULT_WINDOW as LEADERBOARD_DEFAULT_WINDOW, WINDOWS as LEADERBOARD_WINDOWS
+from .pagination import PopularProductPagination, ProductKeysetPagination, ReviewKeysetPagination, SearchPagination
+from django.db.models import Prefetch, Sum, F, ExpressionWrapper, DecimalField
 class TokenVerifyView(APIView):   
     permission_classes = [IsAuthenticated]
 
@@ -239,10 +251,12 @@ def refresh_token_view(request):
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework import status
-class SizeViewSet(viewsets.ModelViewSet):
+class SizeViewSet(CachedResponseMixin, viewsets.ModelViewSet):
+    cache_tags = ('sizes',)
     queryset = Size.objects.all()
     serializer_class = SizeSerializer
-class ColorViewSet(viewsets.ModelViewSet):
+class ColorViewSet(CachedResponseMixin, viewsets.ModelViewSet):
+    cache_tags = ('colors',)
     queryset = Color.objects.all()
     serializer_class = ColorSerializer
 
@@ -259,16 +273,19 @@ class ColorViewSet(viewsets.ModelViewSet):
             return Response(serializer.data, status=status.HTTP_200_OK)
         except Color.DoesNotExist:
             return Response({"detail": "Color not found."}, status=status.HTTP_404_NOT_FOUND)
-class ProductColorImagesView(APIView):
+class ProductColorImagesView(CachedResponseMixin, APIView):
+    cache_tags = PRODUCT_TAGS
     def get(self, request, product_id):
         color_images = ProductColorImage.objects.filter(product_id=product_id)
         serializer = ProductColorImageSerializer(color_images, many=True, context={'request': request})
         return Response(serializer.data)
-class CategoryViewSet(viewsets.ModelViewSet):
+class CategoryViewSet(CachedResponseMixin, viewsets.ModelViewSet):
+    cache_tags = ('categories',)
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
 
-class BrandViewSet(viewsets.ModelViewSet):
+class BrandViewSet(CachedResponseMixin, viewsets.ModelViewSet):
+    cache_tags = ('brands', 'categories')
     queryset = Brand.objects.all()
     serializer_class = BrandSerializer
 
@@ -282,7 +299,8 @@ class BrandViewSet(viewsets.ModelViewSet):
                 return Brand.objects.none()
         return Brand.objects.all()
 
-class DeviceModelViewSet(viewsets.ModelViewSet):
+class DeviceModelViewSet(CachedResponseMixin, viewsets.ModelViewSet):
+    cache_tags = ('device_models',)
     queryset = DeviceModel.objects.all()
     serializer_class = DeviceModelSerializer
 
@@ -292,76 +310,125 @@ class DeviceModelViewSet(viewsets.ModelViewSet):
             return DeviceModel.objects.filter(brand_id=brand_id)
         return DeviceModel.objects.all()
 
-class ProductViewSet(viewsets.ModelViewSet):
+class ProductViewSet(CachedResponseMixin, viewsets.ModelViewSet):
+    cache_tags = PRODUCT_TAGS
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
+    pagination_class = ProductKeysetPagination
 
-    def get_queryset(self):
-        queryset = Product.objects.all()
-
-        category_id = self.request.query_params.get('category_id', None)
-        brand_id = self.request.query_params.get('brand_id', None)
-        device_model_id = self.request.query_params.get('device_model_id', None)
+    def get_serializer_class(self):
+        # Lists get the compact card, detail routes keep the full nested product.
+        if self.action == 'list':
+            return ProductCardSerializer
+        return ProductSerializer
 
-        if category_id and category_id != 'All':
-            queryset = queryset.filter(category_id=category_id)
-
-        if brand_id and brand_id != 'All':
-            queryset = queryset.filter(brand_id=brand_id)
-
-        if device_model_id and device_model_id != 'All':
-            queryset = queryset.filter(device_model_id=device_model_id)
+    def get_queryset(self):
+        if self.action == 'list':
+            queryset = Product.objects.for_cards()
+        else:
+            queryset = Product.objects.with_details()
+
+        # category_id, brand_id and device_model_id ('All' means no filter)
+        return queryset.filter(**catalog_filters(self.request.query_params))
+
+    def list(self, request, *args, **kwargs):
+        response = super().list(request, *args, **kwargs)
+        if facets_requested(request):
+            # ?facets=1 adds counts per category, brand, ... for the current filters
+            facets = facet_counts(self.get_queryset())
+            if isinstance(response.data, dict):
+                response.data['facets'] = facets
+            else:
+                response.data = {'results': response.data, 'facets': facets}
+        return response
 
-        return queryset
+    def retrieve(self, request, *args, **kwargs):
+        # Served from the precomputed product document (store/documents.py)
+        data = get_product_document(request, pk=kwargs['pk'])
+        if data is None:
+            return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+        return Response(data)
 
 
 # Retrieve Product View (for a single product)
-class ProductRetrieveView(RetrieveAPIView):
-    queryset = Product.objects.all()
+class ProductRetrieveView(CachedResponseMixin, RetrieveAPIView):
+    cache_tags = PRODUCT_TAGS
+    queryset = Product.objects.with_details()
     serializer_class = ProductSerializer
     lookup_field = 'id'  # We will be looking up products by 'id'
-class ProductRetrieveByNameView(APIView):
+
+    def retrieve(self, request, *args, **kwargs):
+        data = get_product_document(request, pk=kwargs['id'])
+        if data is None:
+            return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+        return Response(data)
+class ProductRetrieveByNameView(CachedResponseMixin, APIView):
+    cache_tags = PRODUCT_TAGS
     def get(self, request, name, format=None):
-        try:
-            product = Product.objects.get(name=name)
-            serializer = ProductSerializer(product)
-            return Response(serializer.data)
-        except Product.DoesNotExist:
+        data = get_product_document(request, name=name)
+        if data is None:
             return Response({"error": "Product not found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(data)
+@cache_response(*PRODUCT_TAGS)
 @api_view(['GET'])
 def search_products(request):
     """
-    API endpoint for searching products based on query prefix.
-    Returns products that start with the query letters.
+    API endpoint for searching products.
+    Uses the full-text index (store/search.py) when available and returns
+    products by relevance, with prefix matching on every word.
+    Paginated with a keyset cursor (`cursor`, `page_size`), no COUNT(*) unless
+    `include_count` is passed. Accepts the category_id/brand_id/device_model_id
+    filters, and `facets=1` adds facet counts over every match.
     """
     query = request.GET.get('q', '').strip().lower()  # normalize input
-    page_number = request.GET.get('page', 1)
 
     if not query:
         return Response({'error': 'Search query cannot be empty.'}, status=status.HTTP_400_BAD_REQUEST)
 
-    try:
-        page_number = int(page_number)
-    except ValueError:
-        page_number = 1
+    filters = catalog_filters(request.query_params)
+    paginator = SearchPagination()
+    if search_index_available():
+        within = Product.objects.filter(**filters) if filters else None
+        page = paginator.paginate_search(query, Product.objects.for_cards(), request, within=within)
+        matches = matching_products(query, within=within)
+    else:
+        # No text index on this database, fall back to a prefix scan
+        products = Product.objects.for_cards().filter(
+            Q(name__istartswith=query) | Q(description__icontains=query), **filters
+        )
+        page = paginator.paginate_queryset(products, request)
+        matches = products
 
-    # Use startswith for prefix search
-    products = Product.objects.filter(
-        Q(name__istartswith=query) | Q(description__icontains=query)
-    ).only('id', 'name', 'description', 'price', 'image1')
+    serializer = ProductCardSerializer(page, many=True, context={'request': request})
 
-    paginator = Paginator(products, 10)
-    page_obj = paginator.get_page(page_number)
+    response_data = {'products': serializer.data, 'next': paginator.get_next_link()}
+    if paginator.count is not None:
+        response_data['count'] = paginator.count
+    if facets_requested(request):
+        response_data['facets'] = facet_counts(matches)
+    return Response(response_data, status=status.HTTP_200_OK)
+    
+@api_view(['GET'])
+def autocomplete_products(request):
+    """
+    Type-ahead suggestions: products whose name, brand or category has a word
+    starting with `q`, most popular first. Served from the in-process index
+    in store/autocomplete.py, no database query.
+    """
+    query = request.GET.get('q', '')
+    try:
+        limit = max(1, min(int(request.GET.get('limit', 10)), 50))
+    except ValueError:
+        limit = 10
 
-    serializer = ProductSerializer(page_obj.object_list, many=True, context={'request': request})
+    suggestions = autocomplete_index.lookup(query, limit=limit)
+    for suggestion in suggestions:
+        if suggestion['thumbnail']:
+            suggestion['thumbnail'] = request.build_absolute_uri(suggestion['thumbnail'])
+    return Response({'results': suggestions}, status=status.HTTP_200_OK)
 
-    return Response({
-        'products': serializer.data,
-        'total_pages': paginator.num_pages,
-        'current_page': page_number
-    }, status=status.HTTP_200_OK)
-    
-class BannerViewSet(viewsets.ModelViewSet):
+class BannerViewSet(CachedResponseMixin, viewsets.ModelViewSet):
+    cache_tags = ('banners',)
     queryset = Banner.objects.all()
     serializer_class = BannerSerializer
 
@@ -369,13 +436,15 @@ class ReviewViewSet(viewsets.ModelViewSet):
     queryset = Review.objects.all()
     serializer_class = ReviewSerializer
 
-class ReviewListCreateView(generics.ListCreateAPIView):
+class ReviewListCreateView(CachedResponseMixin, generics.ListCreateAPIView):
+    cache_tags = ('reviews',)
     serializer_class = ReviewSerializer
+    pagination_class = ReviewKeysetPagination
     # permission_classes = [IsAuthenticated]  # Ensure the user is authenticated
 
     def get_queryset(self):
         product_id = self.kwargs['product_id']  # Extract product ID from URL
-        return Review.objects.filter(product_id=product_id)
+        return Review.objects.filter(product_id=product_id).prefetch_related('liked_by', 'replies')
 
     def perform_create(self, serializer):
         # Get the product from the URL parameter
@@ -509,7 +578,7 @@ def submit_review(request, product_id):
     if average_rating is not None:
         # Update the product's rating with the new average rating
         product.rating = round(average_rating, 1)  # Ensure it has one decimal place
-        product.save()  # Save the updated product rating
+        product.save(update_fields=['rating'])  # Save the updated product rating
         logger.info(f"Product {product.name} rating updated to: {product.rating}")
     else:
         # If no reviews yet, handle gracefully
@@ -533,6 +602,7 @@ from rest_framework import status
 from django.db.models import F
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@idempotent('cart')
 def add_to_cart(request):
     """
     Add a product to the cart, or increment quantity if it already exists.
@@ -555,73 +625,55 @@ def add_to_cart(request):
         return Response({"detail": "Invalid user"}, status=status.HTTP_400_BAD_REQUEST)
 
     # Get product
-    try:
-        product = Product.objects.get(id=product_id)
-    except Product.DoesNotExist:
+    if not Product.objects.filter(id=product_id).exists():
         return Response({"detail": "Invalid product"}, status=status.HTTP_400_BAD_REQUEST)
 
-    # Get or create cart
-    cart, _ = Cart.objects.get_or_create(customer=customer, defaults={'total_price': 0})
+    operations = []
+    for item_data in color_size_quantities:
+        color_name = item_data.get('color_name')
+        size_name = item_data.get('size_name')
+        requested_qty = item_data.get('quantity', 1)
+
+        if not color_name or not size_name or not isinstance(requested_qty, int) or requested_qty <= 0:
+            return Response({"detail": "Invalid color_name, size_name, or quantity"}, status=status.HTTP_400_BAD_REQUEST)
 
+        operations.append({
+            'op': 'add', 'product_id': product_id, 'color_name': color_name, 'size_name': size_name,
+            'quantity': requested_qty,
+        })
+
+    # All lines are checked against stock together; nothing is added if one fails
+    return _cart_operations_response(customer, operations, status.HTTP_201_CREATED)
+
+
+def _cart_operations_response(customer, operations, success_status=status.HTTP_200_OK):
+    """Apply cart operations (store/carts.py) and answer with the resulting cart."""
     try:
-        with transaction.atomic():
-            for item_data in color_size_quantities:
-                color_name = item_data.get('color_name')
-                size_name = item_data.get('size_name')
-                requested_qty = item_data.get('quantity', 1)
-
-                if not color_name or not size_name or not isinstance(requested_qty, int) or requested_qty <= 0:
-                    return Response({"detail": "Invalid color_name, size_name, or quantity"}, status=status.HTTP_400_BAD_REQUEST)
-
-                # Get color object
-                try:
-                    color = Color.objects.get(color_name=color_name)
-                except Color.DoesNotExist:
-                    return Response({"detail": f"Invalid color: {color_name}"}, status=status.HTTP_400_BAD_REQUEST)
-
-                # Check stock at color + size level
-                try:
-                    color_image = ProductColorImage.objects.get(product=product, color=color)
-                    color_size_entry = ProductColorSize.objects.get(product_color_image=color_image, size__name=size_name)
-                    available_stock = color_size_entry.stock
-                except ProductColorSize.DoesNotExist:
-                    return Response({"detail": f"No stock record available for {product.name} - {color_name} - {size_name}"}, status=status.HTTP_400_BAD_REQUEST)
-
-                # Check existing cart item
-                current_cart_item = CartItem.objects.filter(cart=cart, product=product, color=color, size=color_size_entry.size).first()
-                current_qty_in_cart = current_cart_item.quantity if current_cart_item else 0
-
-                total_qty_after_add = current_qty_in_cart + requested_qty
-
-                # Enforce stock limits
-                if total_qty_after_add > available_stock:
-                    return Response({
-                        "detail": f"Not enough stock for {color_name} ({size_name}). "
-                                  f"Available: {available_stock}, Requested: {requested_qty}, In cart: {current_qty_in_cart}"
-                    }, status=status.HTTP_400_BAD_REQUEST)
-
-                # Add or update cart item
-                if current_cart_item:
-                    current_cart_item.quantity += requested_qty
-                    current_cart_item.save()
-                else:
-                    CartItem.objects.create(
-                        cart=cart,
-                        product=product,
-                        color=color,
-                        size=color_size_entry.size,
-                        quantity=requested_qty
-                    )
-
-            # Recalculate total price
-            cart.total_price = sum(item.product.price * item.quantity for item in cart.cart_items.all())
-            cart.save()
+        state = apply_cart_operations(customer, operations)
+    except CartOperationError as error:
+        return Response(error.as_dict(), status=error.status_code)
+    return Response(cart_snapshot(customer.pk, state), status=success_status)
+
+
+def _cart_line_operation(request, op):
+    """Shared body of the single-line endpoints (remove, increment, decrement)."""
+    product_id = request.data.get('product_id')
+    color_name = request.data.get('color_name')
+    size_name = request.data.get('size_name')
+
+    if not product_id or not color_name or not size_name:
+        return Response({"detail": "Missing product_id, color_name, or size_name"}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        customer = CustomerProfile.objects.get(user=request.user)
+    except CustomerProfile.DoesNotExist:
+        return Response({"detail": "Invalid user"}, status=status.HTTP_400_BAD_REQUEST)
+
+    return _cart_operations_response(customer, [{
+        'op': op, 'product_id': product_id, 'color_name': color_name, 'size_name': size_name,
+    }])
 
-    except Exception as e:
-        return Response({"detail": f"Error while adding to cart: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    serializer = CartSerializer(cart, context={'request': request})
-    return Response(serializer.data, status=status.HTTP_201_CREATED)
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
@@ -632,7 +684,8 @@ from .serializers import CartSerializer
 def get_cart(request):
     """
     Retrieve the current cart for the authenticated customer.
-    Automatically remove items that are out of stock.
+    Automatically remove items that are out of stock, and lower quantities
+    that exceed the stock left.
     """
     user = request.user
 
@@ -641,80 +694,34 @@ def get_cart(request):
     except CustomerProfile.DoesNotExist:
         return Response({"detail": "User profile not found."}, status=400)
 
-    # Retrieve or create cart
-    cart, _ = Cart.objects.get_or_create(customer=customer, defaults={'total_price': 0})
-
-    # Remove cart items with 0 stock
-    for item in cart.cart_items.all():
-        # Get the stock for this product-color-size combination
-        try:
-            color_image = ProductColorImage.objects.get(product=item.product, color=item.color)
-            color_size_entry = ProductColorSize.objects.get(product_color_image=color_image, size=item.size)
-            if color_size_entry.stock <= 0:
-                item.delete()  # Remove item from cart
-        except ProductColorSize.DoesNotExist:
-            # If stock record is missing, also remove the item
-            item.delete()
-
-    # Recalculate cart total price
-    cart.total_price = sum(i.product.price * i.quantity for i in cart.cart_items.all())
-    cart.save()
-
-    serializer = CartSerializer(cart, context={'request': request})
-    return Response(serializer.data, status=200)
+    # Remove cart items with 0 stock (or no stock record) and clamp the rest to
+    # the stock left; the total is priced from the current prices
+    state = current_cart(customer)
+    return Response(cart_snapshot(customer.pk, state), status=200)
 
 from django.db.models import Sum
 from django.db import transaction
 from decimal import Decimal
 
-# This is a standalone script block, NOT part of a view.
-# Use with caution.
-from django.db import transaction
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+@idempotent('cart_batch')
+def cart_batch(request):
+    """
+    Apply several cart edits in one round trip.
+    Body: {"operations": [{"op": "add" | "set" | "increment" | "decrement" | "remove",
+    "product_id": ..., "color_name": ..., "size_name": ..., "quantity": ...}, ...]}
+    Operations run in order; 'add' and 'set' create missing lines, the others
+    need the line to be in the cart. If any of them fails (invalid, or more
+    than the stock) none is applied.
+    Returns the resulting cart.
+    """
+    try:
+        customer = CustomerProfile.objects.get(user=request.user)
+    except CustomerProfile.DoesNotExist:
+        return Response({"detail": "Invalid user"}, status=status.HTTP_400_BAD_REQUEST)
 
-with transaction.atomic():
-    for cart in Cart.objects.all():
-        items_to_process = list(cart.cart_items.all())  # iterate over copy
-        aggregated_items = {}
-
-        for item in items_to_process:
-            key = (item.product_id, item.color_id, item.size_id)
-            if key not in aggregated_items:
-                aggregated_items[key] = {
-                    'item': item,
-                    'total_quantity': item.quantity
-                }
-            else:
-                aggregated_items[key]['total_quantity'] += item.quantity
-                item.delete()  # remove duplicate
-
-        # Update remaining items with correct total quantity
-        for data in aggregated_items.values():
-            item = data['item']
-            total_qty = data['total_quantity']
-            if item.quantity != total_qty:
-                item.quantity = total_qty
-                item.save()
-
-    # Recalculate cart total prices
-    for cart in Cart.objects.all():
-        total_price = Decimal("0.00")
-        for item in cart.cart_items.all():
-            product = item.product
-            unit_price = product.price
-            
-            # Apply discount if it exists
-            if getattr(product, 'discount', None):
-                try:
-                    unit_price = (Decimal(product.price) * (Decimal('1.0') - Decimal(product.discount) / Decimal('100'))).quantize(Decimal('0.01'))
-                except Exception:
-                    unit_price = Decimal(product.price)
-            
-            total_price += (unit_price * Decimal(item.quantity))
-
-        cart.total_price = total_price
-        cart.save()
-
-print("Cart items deduplicated and quantities updated.")
+    return _cart_operations_response(customer, request.data.get('operations'))
 
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
@@ -726,58 +733,12 @@ from .serializers import CartSerializer
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@idempotent('cart_remove')
 def remove_from_cart(request):
     """
     Remove a specific cart item (product, color, and size) from the cart.
     """
-    product_id = request.data.get('product_id')
-    color_name = request.data.get('color_name')
-    size_name = request.data.get('size_name')  # New: size
-
-    if not product_id or not color_name or not size_name:
-        return Response({"detail": "Missing product_id, color_name, or size_name"}, status=status.HTTP_400_BAD_REQUEST)
-
-    user = request.user
-    try:
-        cart = Cart.objects.get(customer__user=user)
-    except Cart.DoesNotExist:
-        return Response({"detail": "No cart found for this user"}, status=status.HTTP_404_NOT_FOUND)
-
-    try:
-        product = Product.objects.get(id=product_id)
-    except Product.DoesNotExist:
-        return Response({"detail": "Invalid product"}, status=status.HTTP_400_BAD_REQUEST)
-
-    try:
-        color = Color.objects.get(color_name=color_name)
-    except Color.DoesNotExist:
-        return Response({"detail": f"Invalid color: {color_name}"}, status=status.HTTP_400_BAD_REQUEST)
-
-    try:
-        cart_item = CartItem.objects.get(cart=cart, product=product, color=color, size__name=size_name)
-    except CartItem.DoesNotExist:
-        return Response({"detail": "Cart item not found for this product, color, and size"}, status=status.HTTP_404_NOT_FOUND)
-
-    with transaction.atomic():
-        # Optional: adjust color-size stock if you are tracking stock in real-time
-        try:
-            color_image = ProductColorImage.objects.get(product=cart_item.product, color=cart_item.color)
-            color_size_entry = cart_item.size  # Assuming size is linked to ProductColorSize
-            # If you want to return stock, uncomment the line below:
-            # color_size_entry.stock += cart_item.quantity
-            color_size_entry.save()
-        except ProductColorImage.DoesNotExist:
-            pass
-
-        # Delete the cart item
-        cart_item.delete()
-
-        # Recalculate total price
-        cart.total_price = sum(item.product.price * item.quantity for item in cart.cart_items.all())
-        cart.save()
-
-    serializer = CartSerializer(cart, context={'request': request})
-    return Response(serializer.data, status=status.HTTP_200_OK)
+    return _cart_line_operation(request, 'remove')
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
@@ -787,56 +748,12 @@ from .models import Cart, CartItem, Product, Color, ProductColorImage
 from .serializers import CartSerializer
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@idempotent('cart_increment')
 def increment_quantity(request):
     """
     Increment a cart item's quantity with color & size, enforcing stock limits.
     """
-    product_id = request.data.get('product_id')
-    color_name = request.data.get('color_name')
-    size_name = request.data.get('size_name')
-
-    if not product_id or not color_name or not size_name:
-        return Response(
-            {"detail": "Missing product_id, color_name, or size_name"},
-            status=status.HTTP_400_BAD_REQUEST
-        )
-
-    user = request.user
-
-    try:
-        cart = Cart.objects.get(customer__user=user)
-        product = Product.objects.get(id=product_id)
-        color = Color.objects.get(color_name=color_name)
-
-        # Find size stock entry
-        color_image = ProductColorImage.objects.get(product=product, color=color)
-        size_entry = ProductColorSize.objects.get(product_color_image=color_image, size__name=size_name)
-
-        # Find cart item
-        cart_item = CartItem.objects.get(cart=cart, product=product, color=color, size=size_entry.size)
-
-    except (Cart.DoesNotExist, Product.DoesNotExist, Color.DoesNotExist,
-            ProductColorImage.DoesNotExist, ProductColorSize.DoesNotExist,
-            CartItem.DoesNotExist) as e:
-        return Response({"detail": str(e)}, status=status.HTTP_404_NOT_FOUND)
-
-    with transaction.atomic():
-        # Check stock limit at size level
-        if cart_item.quantity + 1 > size_entry.stock:
-            return Response({
-                "detail": f"Not enough stock for {color.color_name} ({size_name}). "
-                          f"Only {size_entry.stock - cart_item.quantity} more can be added."
-            }, status=status.HTTP_400_BAD_REQUEST)
-
-        cart_item.quantity += 1
-        cart_item.save()
-
-        # Recalculate total price
-        cart.total_price = sum(item.product.price * item.quantity for item in cart.cart_items.all())
-        cart.save()
-
-    serializer = CartSerializer(cart, context={'request': request})
-    return Response(serializer.data, status=status.HTTP_200_OK)
+    return _cart_line_operation(request, 'increment')
 
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
@@ -847,47 +764,13 @@ from .serializers import CartSerializer
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@idempotent('cart_decrement')
 def decrement_quantity(request):
     """
     Decrement the quantity of a specific cart item (product, color, and size).
     If quantity becomes 0, remove the item.
     """
-    product_id = request.data.get('product_id')
-    color_name = request.data.get('color_name')
-    size_name = request.data.get('size_name')  # New: size
-
-    if not product_id or not color_name or not size_name:
-        return Response({"detail": "Missing product_id, color_name, or size_name"}, status=400)
-
-    user = request.user
-
-    try:
-        cart = Cart.objects.get(customer__user=user)
-        product = Product.objects.get(id=product_id)
-        color = Color.objects.get(color_name=color_name)
-        cart_item = CartItem.objects.get(cart=cart, product=product, color=color, size__name=size_name)
-    except Cart.DoesNotExist:
-        return Response({"detail": "No cart found for this user"}, status=404)
-    except Product.DoesNotExist:
-        return Response({"detail": "Invalid product"}, status=400)
-    except Color.DoesNotExist:
-        return Response({"detail": f"Invalid color: {color_name}"}, status=400)
-    except CartItem.DoesNotExist:
-        return Response({"detail": "Cart item not found for this product, color, and size"}, status=404)
-
-    with transaction.atomic():
-        if cart_item.quantity > 1:
-            cart_item.quantity -= 1
-            cart_item.save()
-        else:
-            cart_item.delete()  # Remove if quantity reaches 0
-
-        # Recalculate total price
-        cart.total_price = sum(item.product.price * item.quantity for item in cart.cart_items.all())
-        cart.save()
-
-    serializer = CartSerializer(cart, context={'request': request})
-    return Response(serializer.data, status=200)
+    return _cart_line_operation(request, 'decrement')
 from decimal import Decimal
 from django.db import transaction
 from django.db.models import F, Sum, DecimalField
@@ -907,21 +790,11 @@ from rest_framework.response import Response
 from rest_framework import status
 from .models import CustomerProfile, Product, Color, ProductColorImage, Order, OrderItem
 # ... (all imports and setup remain the same)
-@api_view(['POST'])
-@permission_classes([IsAuthenticated])
-def submit_cart(request):
+def _aggregate_checkout_items(items_in):
     """
-    Checkout/merge cart into pending orders.
-    Supports product + color + optional size (uses ProductColorSize when size present).
-    Handles multiple shops by creating separate pending orders per shop.
+    {(product_id, color_name, size_name or None): quantity} from checkout
+    items, duplicates added up; None when an item is malformed.
     """
-    user_id = request.data.get('user_id')
-    items_in = request.data.get('color_size_quantities') or request.data.get('color_quantities') or []
-
-    if not user_id or not items_in:
-        return Response({"detail": "Missing required data (user_id or items)."}, status=status.HTTP_400_BAD_REQUEST)
-
-    # Aggregate items to handle duplicates
     aggregated = defaultdict(int)
     for it in items_in:
         prod_id = it.get('product_id')
@@ -930,127 +803,83 @@ def submit_cart(request):
         qty = it.get('quantity', 0)
 
         if not prod_id or not color_name or not isinstance(qty, int) or qty <= 0:
-            return Response({"detail": "Invalid item format (product_id/color_name/quantity)."}, status=status.HTTP_400_BAD_REQUEST)
+            return None
 
         size_name = size_name.strip() if size_name and size_name.strip() != "" else None
         key = (int(prod_id), str(color_name).strip(), size_name)
         aggregated[key] += qty
+    return aggregated
 
+
+@api_view(['POST', 'DELETE'])
+@permission_classes([IsAuthenticated])
+@idempotent('start_checkout')
+def start_checkout(request):
+    """
+    Hold the stock of the checkout items for a few minutes
+    (STOCK_RESERVATION_TTL) so submit_cart cannot run out of it.
+    Body: {"color_size_quantities": [{"product_id": ..., "color_name": ...,
+    "size_name": ..., "quantity": ...}, ...]}, as for submit_cart. Starting
+    again replaces the previous holds; DELETE gives them back.
+    """
     try:
-        customer = CustomerProfile.objects.get(user__id=user_id)
+        customer = CustomerProfile.objects.get(user=request.user)
     except CustomerProfile.DoesNotExist:
         return Response({"detail": "Invalid user."}, status=status.HTTP_400_BAD_REQUEST)
 
-    with transaction.atomic():
-        # Dictionary to store items per shop
-        processed_per_shop = defaultdict(list)
+    if request.method == 'DELETE':
+        reservations.release(customer)
+        return Response(status=status.HTTP_204_NO_CONTENT)
 
-        for (product_id, color_name, size_name), total_qty in aggregated.items():
-            try:
-                product = Product.objects.select_for_update().get(id=product_id)
-            except Product.DoesNotExist:
-                return Response({"detail": f"Product {product_id} not found."}, status=status.HTTP_400_BAD_REQUEST)
+    items_in = request.data.get('color_size_quantities') or request.data.get('color_quantities') or []
+    aggregated = _aggregate_checkout_items(items_in)
+    if not aggregated:
+        return Response({"detail": "Invalid item format (product_id/color_name/quantity)."}, status=status.HTTP_400_BAD_REQUEST)
 
-            try:
-                color = Color.objects.get(color_name=color_name)
-            except Color.DoesNotExist:
-                return Response({"detail": f"Color {color_name} not found."}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        expires_at = reserve_checkout(customer, aggregated)
+    except CheckoutError as error:
+        return Response({"detail": error.detail}, status=status.HTTP_400_BAD_REQUEST)
+    return Response({"detail": "Stock reserved.", "expires_at": expires_at}, status=status.HTTP_201_CREATED)
 
-            try:
-                color_image = ProductColorImage.objects.select_for_update().get(product=product, color=color)
-            except ProductColorImage.DoesNotExist:
-                return Response({"detail": f"No stock entry for {product.name} - {color_name}."}, status=status.HTTP_400_BAD_REQUEST)
-
-            # Handle size
-            size_entry = None
-            size_obj = None
-            if ProductColorSize.objects.filter(product_color_image=color_image).exists():
-                if not size_name:
-                    return Response({"detail": f"Size required for {product.name} - {color_name}."}, status=status.HTTP_400_BAD_REQUEST)
-                try:
-                    size_entry = ProductColorSize.objects.select_for_update().get(
-                        product_color_image=color_image,
-                        size__name__iexact=size_name
-                    )
-                    size_obj = size_entry.size
-                    available_stock = size_entry.stock
-                except ProductColorSize.DoesNotExist:
-                    return Response({"detail": f"No size '{size_name}' for {product.name} - {color_name}."}, status=status.HTTP_400_BAD_REQUEST)
-            else:
-                available_stock = color_image.stock
-
-            if available_stock < total_qty:
-                return Response({
-                    "detail": f"Not enough stock for {product.name} ({color_name}{' - ' + size_name if size_name else ''}). "
-                              f"Available: {available_stock}, requested: {total_qty}."
-                }, status=status.HTTP_400_BAD_REQUEST)
-
-            if not product.created_by_shop:
-                return Response({"detail": f"Product '{product.name}' is not linked to a shop."}, status=status.HTTP_400_BAD_REQUEST)
-
-            # Calculate final price
-            final_price = product.price
-            if getattr(product, 'discount', None):
-                try:
-                    final_price = (Decimal(product.price) * (Decimal('1.0') - Decimal(product.discount) / Decimal('100'))).quantize(Decimal('0.01'))
-                except Exception:
-                    final_price = Decimal(product.price)
-
-            # Add to shop-specific list
-            shop = product.created_by_shop
-            processed_per_shop[shop].append({
-                "product": product,
-                "color": color,
-                "size": size_obj,
-                "color_image": color_image,
-                "size_entry": size_entry,
-                "quantity": total_qty,
-                "final_price": final_price,
-            })
 
-        if not processed_per_shop:
-            return Response({"detail": "No valid items to add to the order."}, status=status.HTTP_400_BAD_REQUEST)
-
-        # Process orders per shop
-        orders_created = []
-        for shop, items in processed_per_shop.items():
-            order, created = Order.objects.select_for_update().get_or_create(
-                customer=customer,
-                shop=shop,
-                status=Order.Status.PENDING,
-                defaults={"total_price": Decimal("0.00")}
-            )
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+@idempotent('submit_cart')
+def submit_cart(request):
+    """
+    Checkout/merge cart into pending orders.
+    Supports product + color + optional size (uses ProductColorSize when size present).
+    Handles multiple shops by creating separate pending orders per shop.
+    """
+    user_id = request.data.get('user_id')
+    items_in = request.data.get('color_size_quantities') or request.data.get('color_quantities') or []
 
-            total_price = Decimal("0.00")
-            for p in items:
-                product = p["product"]
-                color = p["color"]
-                size_obj = p["size"]
-                size_entry = p["size_entry"]
-                qty = p["quantity"]
-
-                order_item, oi_created = OrderItem.objects.get_or_create(
-                    order=order,
-                    product=product,
-                    color=color,
-                    size=size_obj,
-                    defaults={"quantity": qty}
-                )
-
-                if not oi_created:
-                    OrderItem.objects.filter(pk=order_item.pk).update(quantity=F('quantity') + qty)
-
-                # decrement stock
-                if size_entry:
-                    ProductColorSize.objects.filter(pk=size_entry.pk).update(stock=F('stock') - qty)
-                else:
-                    ProductColorImage.objects.filter(pk=p["color_image"].pk).update(stock=F('stock') - qty)
-
-                total_price += p["final_price"] * qty
-
-            order.total_price = total_price
-            order.save(update_fields=["total_price"])
-            orders_created.append(order)
+    if not user_id or not items_in:
+        return Response({"detail": "Missing required data (user_id or items)."}, status=status.HTTP_400_BAD_REQUEST)
+
+    aggregated = _aggregate_checkout_items(items_in)
+    if aggregated is None:
+        return Response({"detail": "Invalid item format (product_id/color_name/quantity)."}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        customer = CustomerProfile.objects.get(user__id=user_id)
+    except CustomerProfile.DoesNotExist:
+        return Response({"detail": "Invalid user."}, status=status.HTTP_400_BAD_REQUEST)
+
+    # Checkout is one of the points where the stored cart reaches the tables
+    cart_store = get_cart_store()
+    try:
+        with cart_store.locked(customer.pk):
+            cart_store.persist(customer.pk)
+    except CartBusy:
+        pass  # Written by the next persist_carts run
+
+    # Resolve, lock, validate and write in bulk (store/checkout.py)
+    try:
+        orders_created = place_orders(customer, aggregated)
+    except CheckoutError as error:
+        return Response({"detail": error.detail}, status=status.HTTP_400_BAD_REQUEST)
 
     return Response({
         "detail": "Orders placed/updated successfully.",
@@ -1066,6 +895,7 @@ from .models import CustomerProfile, Cart, CartItem, ProductColorImage
 
 @api_view(['DELETE'])
 @permission_classes([IsAuthenticated])
+@idempotent('delete_cart')
 def delete_cart(request):
     """
     Delete the cart for the authenticated customer.
@@ -1077,26 +907,14 @@ def delete_cart(request):
     except CustomerProfile.DoesNotExist:
         return Response({"detail": "Invalid user"}, status=status.HTTP_400_BAD_REQUEST)
 
-    cart = Cart.objects.filter(customer=customer).first()
+    store = get_cart_store()
+    state = store.load(customer.pk)
 
-    if not cart:
+    if state['cart_id'] is None and not state['lines']:
         return Response({"detail": "No cart found for this user"}, status=status.HTTP_204_NO_CONTENT)
 
-    with transaction.atomic():
-        # Optional: Restore stock before deletion (uncomment if needed)
-        # for item in cart.cart_items.select_related("product", "color"):
-        #     try:
-        #         color_stock = ProductColorImage.objects.select_for_update().get(
-        #             product=item.product,
-        #             color=item.color
-        #         )
-        #         color_stock.stock = F("stock") + item.quantity
-        #         color_stock.save(update_fields=["stock"])
-        #     except ProductColorImage.DoesNotExist:
-        #         pass
-
-        # Delete cart and its items
-        cart.delete()
+    # Delete cart and its items
+    store.delete(customer.pk)
 
     return Response({"detail": "Cart deleted successfully"}, status=status.HTTP_204_NO_CONTENT)
 class WishlistList(APIView):
@@ -1128,25 +946,54 @@ class WishlistList(APIView):
         wishlist.products.set(products)
         wishlist.save()
 
+        # Reload with the product read path so the embedded products don't fan out
+        wishlist = Wishlist.objects.select_related('customer__user').prefetch_related(
+            Prefetch('products', queryset=Product.objects.for_cards())
+        ).get(pk=wishlist.pk)
+
         # Return the serialized wishlist data as a response
-        serializer = WishlistSerializer(wishlist)
+        serializer = WishlistSerializer(wishlist, context={'request': request})
         return Response(serializer.data, status=status.HTTP_201_CREATED)  
 class OrderViewSet(viewsets.ModelViewSet):
     queryset = Order.objects.all()
     serializer_class = OrderSerializer
 
 
+@cache_response(*PRODUCT_TAGS, 'orders')
 @api_view(['GET'])
 def popular_products(request):
     """
-    Return products ordered by popularity (number of times they appear in orders).
+    Return products ordered by popularity: units sold with time decay, from
+    the ranking table in store/popularity.py.
+    Optional `window` (24h, 7d, 30d) and `shop` or `category` to rank within
+    one shop or category.
     """
-    # Annotate products with order count and order by descending popularity
-    popular_products = Product.objects.annotate(
-        order_count=count('order_items')
-    ).order_by('-order_count')  # Most popular first
+    window = request.GET.get('window', DEFAULT_WINDOW)
+    if window not in POPULARITY_WINDOWS:
+        return Response({"detail": f"window must be one of {', '.join(POPULARITY_WINDOWS)}."}, status=status.HTTP_400_BAD_REQUEST)
+
+    shop_id = request.GET.get('shop')
+    category_id = request.GET.get('category')
+    if shop_id and category_id:
+        return Response({"detail": "Pass either shop or category, not both."}, status=status.HTTP_400_BAD_REQUEST)
+    scope, scope_id = GLOBAL, 0
+    try:
+        if shop_id:
+            scope, scope_id = SHOP, int(shop_id)
+        elif category_id:
+            scope, scope_id = CATEGORY, int(category_id)
+    except ValueError:
+        return Response({"detail": "shop and category must be ids."}, status=status.HTTP_400_BAD_REQUEST)
 
-    serializer = ProductSerializer(popular_products, many=True, context={'request': request})
+    popular_products = ranked_products(window, scope, scope_id)  # Most popular first
+
+    paginator = PopularProductPagination()
+    page = paginator.paginate_queryset(popular_products, request)
+    if page is not None:
+        serializer = ProductCardSerializer(page, many=True, context={'request': request})
+        return paginator.get_paginated_response(serializer.data)
+
+    serializer = ProductCardSerializer(popular_products, many=True, context={'request': request})
     return Response(serializer.data)
 class WishlistDetail(APIView):
     def get(self, request, user_id):
@@ -1155,7 +1002,11 @@ class WishlistDetail(APIView):
 
         try:
             # Fetch the user's wishlists
-            wishlists = Wishlist.objects.filter(customer__user=request.user)
+            wishlists = Wishlist.objects.filter(customer__user=request.user).select_related(
+                'customer__user'
+            ).prefetch_related(
+                Prefetch('products', queryset=Product.objects.for_cards())
+            )
             if not wishlists:
                 return Response({"detail": "No wishlists found."}, status=status.HTTP_404_NOT_FOUND)
 
@@ -1167,44 +1018,35 @@ class WishlistDetail(APIView):
             return Response({"detail": "No wishlists found."}, status=status.HTTP_404_NOT_FOUND)
 
 from django.db.models import Sum
-def get_best_selling_products(limit=5):
+def get_best_selling_products(limit=5, shop_id=0, category_id=0, window=LEADERBOARD_DEFAULT_WINDOW):
     """
     Get the top-selling products based on total quantity sold.
+    Read from the sales counters kept by store/leaderboard.py.
     :param limit: Number of top-selling products to return.
-    :return: List of dictionaries containing product instances and total quantity sold.
+    :return: List of products, each annotated with total_quantity_sold.
     """
-    # Aggregate total quantity sold per product
-    best_selling_items = (
-        OrderItem.objects
-        .values('product')
-        .annotate(total_quantity_sold=Sum('quantity'))
-        .order_by('-total_quantity_sold')[:limit]
-    )
-
-    # Prefetch related product objects efficiently
-    product_ids = [item['product'] for item in best_selling_items]
-    products = Product.objects.filter(id__in=product_ids).select_related('category', 'brand', 'device_model')
-
-    # Build list for serializer
-    product_map = {p.id: p for p in products}
-    best_selling_list = []
-    for item in best_selling_items:
-        product = product_map.get(item['product'])
-        if product:
-            best_selling_list.append({
-                'product': product,
-                'total_quantity_sold': item['total_quantity_sold']
-            })
-
-    return best_selling_list
+    return leaderboard.top_products(limit=limit, shop_id=shop_id, category_id=category_id, window=window)
 
 
+@cache_response(*PRODUCT_TAGS, 'orders')
 @api_view(['GET'])
 def best_selling_products(request):
     """
     API endpoint to get top-selling products with details.
+    Optional `limit` (default 5, at most 50), `shop`, `category` and
+    `window` (1d, 7d, 30d or all).
     """
-    top_products = get_best_selling_products(limit=5)
+    window = request.GET.get('window', LEADERBOARD_DEFAULT_WINDOW)
+    if window not in LEADERBOARD_WINDOWS:
+        return Response({"detail": f"window must be one of {', '.join(LEADERBOARD_WINDOWS)}."}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        limit = max(1, min(int(request.GET.get('limit', 5)), 50))
+        shop_id = int(request.GET.get('shop') or 0)
+        category_id = int(request.GET.get('category') or 0)
+    except ValueError:
+        return Response({"detail": "limit, shop and category must be integers."}, status=status.HTTP_400_BAD_REQUEST)
+
+    top_products = get_best_selling_products(limit=limit, shop_id=shop_id, category_id=category_id, window=window)
     serializer = BestSellingProductSerializer(top_products, many=True, context={'request': request})
     return Response(serializer.data, status=status.HTTP_200_OK)
 from rest_framework.decorators import api_view, permission_classes
@@ -1293,7 +1135,8 @@ class OrderDetailView(APIView):
 from .models import Logo
 from .serializers import LogoSerializer
 
-class LogoView(APIView):
+class LogoView(CachedResponseMixin, APIView):
+    cache_tags = ('logos',)
     def get(self, request):
         logo = Logo.objects.last()  # get latest logo
         serializer = LogoSerializer(logo, context={'request': request})
@@ -1304,7 +1147,8 @@ class LogoView(APIView):
 from .models import AboutPageContent, Blog, Partner
 from .serializers import AboutPageContentSerializer, BlogSerializer, PartnerSerializer
 
-class AboutPageAPIView(APIView):
+class AboutPageAPIView(CachedResponseMixin, APIView):
+    cache_tags = ('about',)
     def get(self, request):
         try:
             content = AboutPageContent.objects.first()  # Assuming only one About page